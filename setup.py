@@ -25,6 +25,7 @@ setuptools.setup(
     entry_points={
         "octoprint.plugin": ["psucontrol_meross = octoprint_psucontrol_meross"]
     },
-    install_requires=["OctoPrint>=1.7.3", "meross-iot>=0.4.8.0"],
+    install_requires=["OctoPrint>=1.7.3", "meross-iot>=0.4.10,<0.4.11"],
+    extras_require={"uvloop": ["uvloop"]},
     python_requires=">=3.9.0",
 )
@@ -0,0 +1,560 @@
+"""Local session broker: a single Meross cloud session for all the OctoPrint instances of a host.
+
+The broker process (`python -m octoprint_psucontrol_meross.broker --socket <path>`)
+owns the `_OctoprintPsuMerossClientAsync` (its login, MQTT connection, device
+registry and cache file). The plugin instances configured with its socket
+forward their calls to it and fall back to an in-process client when the
+broker is not running.
+
+Protocol: one compact JSON object per line over a Unix socket.
+
+    -> {"id": 1, "method": "is_on", "params": {"dev_ids": [..], "timeout": 20}}
+    <- {"id": 1, "result": true}    (or {"id": 1, "error": "<message>"})
+    <- {"event": {"states": {..}, "devices": [..]}}    (after "subscribe")
+
+Events are the `StatePushPublisher` messages of the broker's client.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import socket
+
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Callable, Dict, Sequence, Set
+
+from .device_registry import DeviceIndex, MerossDeviceHandle
+from .device_state import DeviceStateTable, StateSource
+from .exc import BrokerError
+from .metrics import MetricsRegistry
+from .resilience import CommandResult, Deadline, DEFAULT_CALL_BUDGET, DeviceResult
+
+# Max length of a single message (the device list of large accounts included)
+STREAM_LIMIT = 4 * 1024 * 1024
+# Max time to wait for the broker to accept a connection (seconds)
+BROKER_CONNECT_TIMEOUT = 1.0
+
+
+def encode(message: dict) -> bytes:
+    return json.dumps(message, separators=(",", ":")).encode("utf-8") + b"\n"
+
+
+def broker_available(
+    socket_path: Path, timeout: float = BROKER_CONNECT_TIMEOUT
+) -> bool:
+    """True if something accepts connections on the `socket_path`."""
+    if not socket_path or not Path(socket_path).is_socket():
+        return False
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        try:
+            sock.connect(str(socket_path))
+        except OSError:
+            return False
+    return True
+
+
+def _index_from_dict(data: dict) -> DeviceIndex:
+    handle_dicts = tuple(data["devices"])
+    return DeviceIndex(
+        generation=data["generation"],
+        devices={},
+        channels={},
+        handles=tuple(MerossDeviceHandle(**el) for el in handle_dicts),
+        handle_dicts=handle_dicts,
+        handle_jsons=tuple(json.dumps(el) for el in handle_dicts),
+        etag=data["etag"],
+    )
+
+
+def _command_result_from_list(data: Sequence[dict]) -> CommandResult:
+    return CommandResult(devices=tuple(DeviceResult(**el) for el in data))
+
+
+class BrokerServer:
+    """Serves the calls of the plugin instances with a single async client.
+
+    Lives on the broker's event loop.
+    """
+
+    def __init__(self, socket_path: Path, logger, client=None):
+        self.socket_path = Path(socket_path)
+        self.client = client  # `_OctoprintPsuMerossClientAsync`
+        self._logger = logger
+        self._connections: Set[asyncio.StreamWriter] = set()
+        self._subscribers: Set[asyncio.StreamWriter] = set()
+        self._server = None
+
+    async def start(self):
+        if self.socket_path.is_socket():
+            if broker_available(self.socket_path):
+                raise BrokerError(
+                    f"A broker is already listening on {self.socket_path}"
+                )
+            self.socket_path.unlink()  # Left behind by a dead broker
+        # Only the broker's user may connect (the socket is created with 0600)
+        old_umask = os.umask(0o177)
+        try:
+            self._server = await asyncio.start_unix_server(
+                self._on_connection, path=str(self.socket_path), limit=STREAM_LIMIT
+            )
+        finally:
+            os.umask(old_umask)
+        self._logger.info(f"Listening on {self.socket_path}.")
+
+    async def close(self):
+        if self._server is None:
+            return
+        self._server.close()
+        for writer in tuple(self._connections):
+            writer.close()
+        await self._server.wait_closed()
+        self._server = None
+
+    def broadcast(self, event: dict):
+        """Send a state change message to the subscribed instances."""
+        data = encode({"event": event})
+        for writer in tuple(self._subscribers):
+            if writer.is_closing():
+                self._subscribers.discard(writer)
+            else:
+                writer.write(data)
+
+    async def _on_connection(self, reader, writer):
+        self._connections.add(writer)
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                task = asyncio.ensure_future(self._handle(json.loads(line), writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (ConnectionError, ValueError) as err:
+            self._logger.warning(f"Dropping a broken connection: {err!r}")
+        finally:
+            self._connections.discard(writer)
+            self._subscribers.discard(writer)
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    async def _handle(self, request: dict, writer):
+        try:
+            method = getattr(self, f"_rpc_{request['method']}")
+            result = await method(writer, **request.get("params", {}))
+        except asyncio.CancelledError:  # An `Exception` on python 3.7
+            raise
+        except Exception as err:
+            response = {"id": request.get("id"), "error": str(err) or repr(err)}
+        else:
+            response = {"id": request.get("id"), "result": result}
+        if not writer.is_closing():
+            writer.write(encode(response))
+
+    async def _rpc_subscribe(self, writer) -> dict:
+        """Subscribe to the state changes, returns the current state."""
+        self._subscribers.add(writer)
+        dev_ids = sorted(self.client.state_table.dump())
+        return {
+            "states": self.client._describe_channels(dev_ids),
+            "devices": self.client.device_registry.index.handle_dicts,
+        }
+
+    async def _rpc_login(
+        self, writer, api_base_url, user: str, password: str, raise_exc: bool
+    ) -> bool:
+        session_user = self.client._session_user
+        if self.client.is_authenticated and session_user is not None:
+            # A new login would log every other instance out of the shared session
+            if session_user.lower() != user.lower():
+                raise BrokerError(
+                    f"The broker is logged in to another account ({session_user!r})."
+                )
+            if password != self.client._session_password:
+                raise BrokerError(
+                    f"Wrong password for the broker's account ({session_user!r})."
+                )
+        return await self.client.login(api_base_url, user, password, raise_exc)
+
+    async def _rpc_warm_up(self, writer, dev_ids: Sequence[str]) -> dict:
+        login = Future()
+        login.set_result(self.client.is_authenticated)
+        try:
+            result = await self.client.warm_up(login, dev_ids)
+        except asyncio.CancelledError:  # An `Exception` on python 3.7
+            raise
+        except Exception as err:
+            # Reported along with the phase it failed in
+            return {
+                "result": False,
+                "timings": self.client.warm_up_timings,
+                "failed_phase": self.client.warm_up_failed_phase,
+                "error": str(err) or repr(err),
+            }
+        return {"result": result, "timings": self.client.warm_up_timings}
+
+    async def _rpc_device_index(self, writer, timeout: float) -> dict:
+        index = await self.client.device_index(Deadline(timeout))
+        return {
+            "generation": index.generation,
+            "etag": index.etag,
+            "devices": index.handle_dicts,
+        }
+
+    async def _rpc_is_on(
+        self, writer, dev_ids: Sequence[str], timeout: float, max_age: float = None
+    ) -> bool:
+        kwargs = {} if max_age is None else {"max_age": max_age}
+        return await self.client.is_on(dev_ids, Deadline(timeout), **kwargs)
+
+    async def _rpc_get_states(
+        self, writer, dev_ids: Sequence[str], max_age: float, timeout: float
+    ) -> Dict[str, dict]:
+        return await self.client.get_states(dev_ids, max_age, Deadline(timeout))
+
+    async def _rpc_set_devices_states(
+        self, writer, dev_ids: Sequence[str], state: bool, timeout: float
+    ):
+        rv = await self.client.set_devices_states(dev_ids, state, Deadline(timeout))
+        return [el.asdict() for el in rv.devices]
+
+    async def _rpc_toggle_devices(self, writer, dev_ids: Sequence[str], timeout: float):
+        rv = await self.client.toggle_devices(dev_ids, Deadline(timeout))
+        return [el.asdict() for el in rv.devices]
+
+    async def _rpc_transport_stats(self, writer) -> Dict[str, dict]:
+        return self.client.transport.asdict()
+
+    async def _rpc_set_lan_control(self, writer, enabled: bool):
+        """Applies to every attached instance (they share the broker's transport)."""
+        if self.client.transport.lan_enabled != enabled:
+            self._logger.info(f"LAN control {'enabled' if enabled else 'disabled'}.")
+        self.client.transport.lan_enabled = bool(enabled)
+
+
+class _RemoteTransport:
+    """`DeviceTransport` stand-in (the LAN control is up to the broker).
+
+    Setting `lan_enabled` forwards it to the broker (on every (re)connect too).
+    """
+
+    def __init__(self, client: "BrokerAsyncClient", lan_enabled: bool = None):
+        self._client = client
+        # `None` leaves the broker's own setting (`--no-lan`) in place
+        self._lan_enabled = lan_enabled
+
+    @property
+    def lan_enabled(self) -> bool:
+        return self._lan_enabled is None or self._lan_enabled
+
+    @lan_enabled.setter
+    def lan_enabled(self, value: bool):
+        self._lan_enabled = bool(value)
+        if self._client.loop is not None:
+            # Otherwise sent once connected
+            asyncio.run_coroutine_threadsafe(
+                self._client.send_lan_control(), self._client.loop
+            )
+
+    def asdict(self) -> Dict[str, dict]:
+        """Blocks the (flask) thread until the broker answers.
+
+        Raises `DeadlineExceededError` if it does not within the call budget.
+        """
+        if self._client.loop is None:
+            return {}
+        return Deadline(DEFAULT_CALL_BUDGET).result(
+            asyncio.run_coroutine_threadsafe(
+                self._client.call("transport_stats"), self._client.loop
+            )
+        )
+
+
+class BrokerAsyncClient:
+    """Stands in for `_OctoprintPsuMerossClientAsync`, forwarding the calls to the broker.
+
+    The broker's state changes are mirrored to the local `state_table`
+    (and passed on to `on_state_push`).
+
+    Lives on the worker loop.
+    """
+
+    is_authenticated: bool = False
+    is_warmed_up: bool = False
+    warm_up_timings: Dict[str, float] = None
+    warm_up_failed_phase: str = None
+    loop: asyncio.AbstractEventLoop = None
+
+    def __init__(
+        self,
+        socket_path: Path,
+        logger,
+        on_state_push: Callable[[dict], None] = None,
+        on_unreachable: Callable[[], None] = None,
+        lan_control: bool = None,
+    ):
+        self.socket_path = Path(socket_path)
+        self._logger = logger
+        self.on_state_push = on_state_push
+        # Called (on the worker loop) when the broker can not be (re)connected to
+        self.on_unreachable = on_unreachable
+        self.metrics = MetricsRegistry(prefix="psucontrol_meross_")
+        self.broker_calls_total = self.metrics.counter(
+            "broker_calls_total",
+            "Calls forwarded to the session broker.",
+            ["method", "result"],
+        )
+        self.broker_connections_total = self.metrics.counter(
+            "broker_connections_total", "Connections made to the session broker."
+        )
+        self.state_table = DeviceStateTable()
+        self.transport = _RemoteTransport(self, lan_enabled=lan_control)
+        self._reader = self._writer = None
+        self._connect_lock: asyncio.Lock = None
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._next_id = 0
+
+    async def _connect(self):
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+        async with self._connect_lock:
+            if self._writer is not None:
+                return
+            self.loop = asyncio.get_running_loop()
+            try:
+                self._reader, self._writer = await asyncio.wait_for(
+                    asyncio.open_unix_connection(
+                        str(self.socket_path), limit=STREAM_LIMIT
+                    ),
+                    BROKER_CONNECT_TIMEOUT,
+                )
+            except (OSError, asyncio.TimeoutError) as err:
+                if self.on_unreachable is not None:
+                    self.on_unreachable()
+                raise BrokerError(f"Unable to reach the broker: {err!r}") from None
+            self.broker_connections_total.inc()
+            asyncio.ensure_future(self._read_loop(self._reader, self._writer))
+            self._apply_event(await self._send("subscribe", {}))
+            if self.transport._lan_enabled is not None:
+                await self._send(
+                    "set_lan_control", {"enabled": self.transport._lan_enabled}
+                )
+
+    async def send_lan_control(self):
+        """Forward the LAN control setting (if connected, `_connect()` sends it otherwise)."""
+        if self._writer is None:
+            return
+        try:
+            await self.call("set_lan_control", enabled=self.transport.lan_enabled)
+        except BrokerError as err:
+            self._logger.warning(f"Unable to forward the LAN control setting: {err}")
+
+    async def _read_loop(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                if "event" in message:
+                    self._apply_event(message["event"])
+                    continue
+                future = self._pending.pop(message.get("id"), None)
+                if future is None or future.done():
+                    continue
+                if "error" in message:
+                    future.set_exception(BrokerError(message["error"]))
+                else:
+                    future.set_result(message.get("result"))
+        except (ConnectionError, ValueError) as err:
+            self._logger.warning(f"Broker connection broken: {err!r}")
+        finally:
+            self._on_disconnected(writer)
+
+    def _on_disconnected(self, writer):
+        writer.close()
+        if self._writer is writer:
+            self._reader = self._writer = None
+            # The broker session (if the broker restarts) has to be re-established
+            self.is_authenticated = self.is_warmed_up = False
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(BrokerError("Lost the connection to the broker."))
+        self._pending.clear()
+
+    def _apply_event(self, event: dict):
+        for dev_id, description in (event.get("states") or {}).items():
+            if description["state"] is None:
+                self.state_table.discard(dev_id)
+                continue
+            dev_uuid, channel = dev_id.split("::")
+            self.state_table.update(
+                dev_uuid,
+                int(channel),
+                description["state"] == "on",
+                StateSource(description["source"]),
+                age=description["age"],
+            )
+        if self.on_state_push is not None and event:
+            try:
+                self.on_state_push(event)
+            except Exception:
+                self._logger.exception("Unable to send the state update.")
+
+    async def _send(self, method: str, params: dict):
+        self._next_id += 1
+        request_id = self._next_id
+        future = self._pending[request_id] = asyncio.get_running_loop().create_future()
+        self._writer.write(
+            encode({"id": request_id, "method": method, "params": params})
+        )
+        return await future
+
+    async def call(self, method: str, deadline: Deadline = None, **params):
+        """Call the broker's `method` (within the `deadline`, if given)."""
+        try:
+            await self._connect()
+            if deadline is None:
+                out = await self._send(method, params)
+            else:
+                params["timeout"] = deadline.remaining()
+                out = await deadline.wait_for(self._send(method, params))
+        except Exception:
+            self.broker_calls_total.inc(method=method, result="failure")
+            raise
+        self.broker_calls_total.inc(method=method, result="success")
+        return out
+
+    async def close(self):
+        """Disconnect from the broker (which keeps its session)."""
+        if self._writer is not None:
+            self._on_disconnected(self._writer)
+        self._connect_lock = None  # Bound to the loop on python < 3.10
+
+    async def login(self, api_base_url, user: str, password: str, raise_exc: bool):
+        try:
+            out = await self.call(
+                "login",
+                api_base_url=api_base_url,
+                user=user,
+                password=password,
+                raise_exc=raise_exc,
+            )
+        except BrokerError:
+            if raise_exc:
+                raise
+            self._logger.exception("Login through the broker failed.")
+            out = False
+        self.is_authenticated = bool(out)
+        return out
+
+    async def warm_up(self, login: Future, dev_ids: Sequence[str]) -> bool:
+        if not await asyncio.wrap_future(login):
+            self._logger.info("Warm-up skipped: not logged in.")
+            return False
+        out = await self.call("warm_up", dev_ids=list(dev_ids))
+        self.warm_up_timings = out["timings"]
+        self.warm_up_failed_phase = out.get("failed_phase")
+        if out.get("error"):
+            raise BrokerError(f"Broker warm-up failed: {out['error']}")
+        self.is_warmed_up = out["result"]
+        return self.is_warmed_up
+
+    async def device_index(self, deadline: Deadline = None) -> DeviceIndex:
+        return _index_from_dict(
+            await self.call("device_index", Deadline.coerce(deadline))
+        )
+
+    async def list_devices(self, asdict: bool = False, deadline: Deadline = None):
+        index = await self.device_index(deadline)
+        return index.handle_dicts if asdict else index.handles
+
+    async def is_on(
+        self, dev_ids: Sequence[str], deadline: Deadline = None, max_age: float = None
+    ) -> bool:
+        return await self.call(
+            "is_on", Deadline.coerce(deadline), dev_ids=list(dev_ids), max_age=max_age
+        )
+
+    async def get_states(
+        self, dev_ids: Sequence[str], max_age: float, deadline: Deadline = None
+    ) -> Dict[str, dict]:
+        return await self.call(
+            "get_states",
+            Deadline.coerce(deadline),
+            dev_ids=list(dev_ids),
+            max_age=max_age,
+        )
+
+    async def set_devices_states(
+        self, dev_ids: Sequence[str], state: bool, deadline: Deadline = None
+    ) -> CommandResult:
+        return _command_result_from_list(
+            await self.call(
+                "set_devices_states",
+                Deadline.coerce(deadline),
+                dev_ids=list(dev_ids),
+                state=state,
+            )
+        )
+
+    async def toggle_devices(
+        self, dev_ids: Sequence[str], deadline: Deadline = None
+    ) -> CommandResult:
+        return _command_result_from_list(
+            await self.call(
+                "toggle_devices", Deadline.coerce(deadline), dev_ids=list(dev_ids)
+            )
+        )
+
+
+async def serve(socket_path: Path, cache_file: Path, lan_control: bool, logger):
+    from .meross_client import _OctoprintPsuMerossClientAsync
+
+    server = BrokerServer(socket_path, logger=logger)
+    server.client = _OctoprintPsuMerossClientAsync(
+        cache_file=cache_file,
+        logger=logger.getChild("client"),
+        lan_control=lan_control,
+        on_state_push=server.broadcast,
+    )
+    await server.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.close()
+        await server.client.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--socket", type=Path, required=True)
+    parser.add_argument(
+        "--cache-file", type=Path, default=Path("meross_cloud_broker.sqlite3")
+    )
+    parser.add_argument(
+        "--no-lan", action="store_true", help="Cloud-only device control"
+    )
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    try:
+        asyncio.run(
+            serve(
+                args.socket,
+                args.cache_file,
+                lan_control=not args.no_lan,
+                logger=logging.getLogger("psucontrol_meross.broker"),
+            )
+        )
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
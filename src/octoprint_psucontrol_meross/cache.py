@@ -1,11 +1,18 @@
+import asyncio
+import contextlib
+import functools
 import hashlib
 import inspect
 import logging
 import os
+import pickle
+import random
 import shelve
+import sqlite3
 import threading
 import time
 
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Callable
 
@@ -15,35 +22,183 @@ logger = logging.getLogger(__name__)
 
 
 class MerossCache:
-    """Wrapper around shelf's cache file."""
+    """SQLite (WAL mode) key-value cache file.
 
-    _shelve: dict = None  # shelve cache
+    Safe to share between threads (each one gets its own connection) and
+    between processes. Values are pickled and can have an expiry time.
 
-    def __init__(self, cache_file: Path, logger):
+    Async code calls it through `run_in_executor()`, on a dedicated thread.
+    """
+
+    # Version 1 was the (now migrated) shelve-based cache file
+    SCHEMA_VERSION = 2
+    SESSION_KEY_PREFIX = "_meross_token_"
+    INVENTORY_KEY_PREFIX = "_meross_inventory_"
+
+    def __init__(self, cache_file: Path, logger, legacy_shelve_file: Path = None):
         self._logger = logger
-        self.mutex = threading.Lock()
+        self.cache_file = Path(cache_file)
+        self._local = threading.local()
+        self._executor: ThreadPoolExecutor = None
         try:
-            self._shelve = shelve.open(os.fspath(cache_file))
-        except Exception:
+            self._init_db()
+        except sqlite3.DatabaseError:
             self._logger.exception(f"Error while opening {cache_file!r} cache")
-            if cache_file.exists():
-                os.unlink(cache_file)
+            self._close_connection()
+            for path in self._get_db_files():
+                _unlink(path)
             # Attempt one more time
-            self._shelve = shelve.open(os.fspath(cache_file))
+            self._init_db()
         else:
             self._logger.debug(f"Sucessfully opened {cache_file!r} cache.")
-        if self._shelve is None:
-            raise MerossCacheError("Unable to open shelve cache.")
-        self._check_cache_version()
-
-    def _check_cache_version(self):
-        """Confirm version of the cache file."""
-        with self.mutex:
-            key = "__CACHE_VERSION__"
-            self._shelve.setdefault(key, 1)
-            if self._shelve[key] != 1:
+        if legacy_shelve_file is not None:
+            self._migrate_shelve(Path(legacy_shelve_file))
+
+    def _get_db_files(self):
+        return [
+            self.cache_file.with_name(self.cache_file.name + suffix)
+            for suffix in ("", "-wal", "-shm")
+        ]
+
+    def _get_connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "connection", None)
+        if conn is None:
+            conn = sqlite3.connect(
+                os.fspath(self.cache_file), timeout=10, isolation_level=None
+            )
+            # Every commit is durable (there are very few writes)
+            conn.execute("PRAGMA synchronous=FULL")
+            self._local.connection = conn
+        return conn
+
+    def _close_connection(self):
+        conn = getattr(self._local, "connection", None)
+        if conn is not None:
+            conn.close()
+            self._local.connection = None
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        conn = self._get_connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+
+    def _init_db(self):
+        """Create the tables and confirm version of the cache file."""
+        conn = self._get_connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        with self._transaction() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                " key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL"
+                ")"
+            )
+            row = conn.execute("SELECT version FROM schema_version").fetchone()
+            if row is None:
+                conn.execute(
+                    "INSERT INTO schema_version (version) VALUES (?)",
+                    (self.SCHEMA_VERSION,),
+                )
+            elif row[0] != self.SCHEMA_VERSION:
                 raise MerossCacheError("Cache file version mismatch")
 
+    def _migrate_shelve(self, shelve_file: Path):
+        """Move session tokens from the legacy shelve cache file (and remove it)."""
+        # dbm backends add their own suffixes to the file name
+        legacy_files = sorted(shelve_file.parent.glob(f"{shelve_file.name}*"))
+        if not legacy_files:
+            return
+        items = {}
+        try:
+            with shelve.open(os.fspath(shelve_file), flag="r") as old_cache:
+                for key in old_cache.keys():
+                    if key.startswith(self.SESSION_KEY_PREFIX):
+                        items[key] = old_cache[key]
+        except Exception:
+            self._logger.exception(f"Unable to migrate {shelve_file!r}, discarding it.")
+        else:
+            self.set_many(items)
+            self._logger.info(f"Migrated {len(items)} entries from {shelve_file!r}.")
+        for path in legacy_files:
+            _unlink(path)
+
+    async def run_in_executor(self, fn: Callable, *args, **kwargs):
+        """Run the (blocking) cache call `fn(*args, **kwargs)` off the event loop.
+
+        The calls are serialised on the cache's own thread, so a slow disk
+        never stalls the loop (nor waits behind the DNS lookups).
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="psucontrol_meross_cache"
+            )
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, functools.partial(fn, *args, **kwargs)
+        )
+
+    def shutdown_executor(self):
+        """Stop the cache thread (once its queued calls are done)."""
+        executor = self._executor
+        if executor is not None:
+            self._executor = None
+            executor.submit(self._close_connection)
+            executor.shutdown(wait=False)
+
+    def get(self, key: str, default=None):
+        """Return value stored under `key` (unless it has expired)."""
+        row = (
+            self._get_connection()
+            .execute("SELECT value, expires_at FROM cache WHERE key = ?", (key,))
+            .fetchone()
+        )
+        if row is None:
+            return default
+        value, expires_at = row
+        if expires_at is not None and expires_at <= time.time():
+            self.delete(key)
+            return default
+        try:
+            return pickle.loads(value)
+        except Exception:
+            self._logger.exception(f"Unable to unpickle cached {key!r}.")
+            return default
+
+    def set(self, key: str, value, ttl: float = None):
+        """Store the `value` (for `ttl` seconds if provided)."""
+        self.set_many({key: value}, ttl=ttl)
+
+    def set_many(self, items: dict, ttl: float = None):
+        """Store all `items` in a single transaction."""
+        expires_at = None if ttl is None else time.time() + ttl
+        rows = [
+            (key, pickle.dumps(value), expires_at) for (key, value) in items.items()
+        ]
+        with self._transaction() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+                rows,
+            )
+
+    def delete(self, key: str):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def purge_expired(self) -> int:
+        """Delete all expired entries, returns their count."""
+        with self._transaction() as conn:
+            return conn.execute(
+                "DELETE FROM cache WHERE expires_at <= ?", (time.time(),)
+            ).rowcount
+
     @classmethod
     def hash_auth_pair(cls, user: str, password: str) -> str:
         return hashlib.sha256(f"{user}:{password}".encode("utf8")).hexdigest()
@@ -51,25 +206,39 @@ class MerossCache:
     @classmethod
     def get_session_name_key(cls, user: str, password: str):
         hashval = cls.hash_auth_pair(user, password)
-        return f"_meross_token_{hashval}"
+        return f"{cls.SESSION_KEY_PREFIX}{hashval}"
 
     def get_cloud_session_token(self, user: str, password: str):
         """Returns a cloud token for user/password combination (if exists) or `None`"""
-        key = self.get_session_name_key(user, password)
-        with self.mutex:
-            return self._shelve.get(key, None)
+        return self.get(self.get_session_name_key(user, password))
 
-    def set_cloud_session_token(self, user: str, password: str, value):
-        """Returns a cloud token for user/password combination (if exists) or `None`"""
+    def set_cloud_session_token(self, user: str, password: str, value, ttl=None):
+        """Store a cloud token for user/password combination, returns its cache key."""
         key = self.get_session_name_key(user, password)
-        with self.mutex:
-            self._shelve[key] = value
+        self.set(key, value, ttl=ttl)
         return key
 
     def delete_cloud_session_token(self, user: str, password: str):
-        key = self.get_session_name_key(user, password)
-        with self.mutex:
-            self._shelve.pop(key, None)
+        self.delete(self.get_session_name_key(user, password))
+
+    @classmethod
+    def get_inventory_key(cls, user: str):
+        hashval = hashlib.sha256(user.encode("utf8")).hexdigest()
+        return f"{cls.INVENTORY_KEY_PREFIX}{hashval}"
+
+    def get_device_inventory(self, user: str):
+        """Returns the device inventory snapshot of the user's account (or `None`)."""
+        return self.get(self.get_inventory_key(user))
+
+    def set_device_inventory(self, user: str, value):
+        self.set(self.get_inventory_key(user), value)
+
+
+def _unlink(path: Path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
 
 
 NO_VALUE = object()
@@ -82,15 +251,35 @@ class AsyncCachedObject:
         - the generated key is changed
         - timeout (in seconds) is reached.
 
+    Once the (optional) `soft_timeout` is reached, the cached instance is still
+    returned but a refresh is started in the background (stale-while-revalidate).
+    Both timeouts are measured with a monotonic clock and randomly spread by
+    +/- `jitter` (a fraction of the timeout) so that caches created at the
+    same time don't all expire at once.
+
     The get() function either raises an exception or returns the `default` value
     if the `enabled` callable returns false
 
     The value generated by `get_key()` function has to be immutable
+
+    Concurrent cache misses are coalesced: only the first caller runs
+    `get_object()`, the rest await the same in-flight load (and receive
+    its exception if it fails).
     """
 
-    timeout = None
+    timeout = soft_timeout = None
+    jitter = 0.1
     _cached_key = _cached_value = NO_VALUE
     _cache_time = 0
+    _expires_at = _refresh_at = None  # `time.monotonic()` deadlines
+    _inflight: asyncio.Future = None
+    _generation = 0  # Incremented by `flush()` to discard in-flight loads
+
+    # Calls served from the cache (including stale values) and calls that
+    #  needed a load (including the ones that joined an in-flight load)
+    hits = misses = 0
+    # Number of `get_object()` calls avoided by joining an in-flight load
+    coalesced_loads = 0
 
     def __init__(
         self,
@@ -98,11 +287,18 @@ class AsyncCachedObject:
         get_key: Callable,
         get_object: Callable,
         timeout: int = None,
+        soft_timeout: int = None,
+        jitter: float = None,
+        name: str = None,
     ):
+        self.name = name  # Used in the metrics
         self.enabled = enabled
         self.get_key = get_key
         self.get_object = get_object
         self.timeout = timeout
+        self.soft_timeout = soft_timeout
+        if jitter is not None:
+            self.jitter = jitter
 
     async def __call__(self, default=NO_VALUE):
         if not await self._call(self.enabled):
@@ -111,9 +307,11 @@ class AsyncCachedObject:
             else:
                 return default
 
+        value = self._cached_value
         if await self._cache_update_needed():
+            self.misses += 1
             try:
-                self._cached_value = await self._call(self.get_object)
+                value = await self._load_shared()
             except CacheGetError as err:
                 logger.error(f"Unable to get cache value: {err}.")
                 self.flush()
@@ -122,30 +320,95 @@ class AsyncCachedObject:
                     raise
                 else:
                     return default
-            else:
-                if self._cached_value is not NO_VALUE:
-                    self._cached_key = await self._call(self.get_key)
-                    self._cache_time = time.time()
+        else:
+            self.hits += 1
+            if self._refresh_due():
+                self._refresh_in_background()
 
-        for maybe_rv in (self._cached_value, default):
+        for maybe_rv in (value, default):
             if maybe_rv is not NO_VALUE:
                 return maybe_rv
         return None  # final fallback
 
+    async def prime(self, value):
+        """Pre-populate the cache with a possibly outdated value.
+
+        The value is returned straight away, and refreshed on the first access
+        (in the background if `soft_timeout` is set).
+        """
+        self._cached_value = value
+        self._cached_key = await self._call(self.get_key)
+        now = time.monotonic()
+        self._cache_time = now
+        self._expires_at = self._get_deadline(now, self.timeout)
+        self._refresh_at = now if self.soft_timeout else None
+
+    async def _load_shared(self):
+        """Run `get_object()` or join the load that is already in flight."""
+        if self._inflight is None:
+            self._inflight = asyncio.ensure_future(self._load(self._generation))
+        else:
+            self.coalesced_loads += 1
+        # Shielded so that a cancelled caller doesn't cancel the load for everyone else
+        return await asyncio.shield(self._inflight)
+
+    async def _load(self, generation: int):
+        try:
+            value = await self._call(self.get_object)
+            if generation == self._generation:
+                self._cached_value = value
+                if value is not NO_VALUE:
+                    self._cached_key = await self._call(self.get_key)
+                    now = time.monotonic()
+                    self._cache_time = now
+                    self._expires_at = self._get_deadline(now, self.timeout)
+                    self._refresh_at = self._get_deadline(now, self.soft_timeout)
+            return value
+        finally:
+            if generation == self._generation:
+                self._inflight = None
+
+    def _get_deadline(self, now: float, timeout: int):
+        if not timeout or timeout <= 0:
+            return None
+        spread = random.uniform(-self.jitter, self.jitter)
+        return now + timeout * (1 + spread)
+
+    def _refresh_due(self) -> bool:
+        return self._refresh_at is not None and self._refresh_at <= time.monotonic()
+
+    def _refresh_in_background(self):
+        """Start a refresh of a stale (but not yet expired) value."""
+        if self._inflight is not None:
+            return  # Already refreshing
+        self._inflight = asyncio.ensure_future(self._load(self._generation))
+        self._inflight.add_done_callback(self._on_background_refresh_done)
+
+    def _on_background_refresh_done(self, future: asyncio.Future):
+        if future.cancelled() or future.exception() is None:
+            return
+        logger.warning(f"Background cache refresh failed: {future.exception()!r}.")
+        if self._refresh_at is not None:
+            # Keep serving the stale value, retry later (the hard timeout still applies)
+            self._refresh_at = self._get_deadline(time.monotonic(), self.soft_timeout)
+
     def flush(self):
         """Flush cache."""
         self._cached_value = self._cached_key = NO_VALUE
         self._cache_time = 0
+        self._expires_at = self._refresh_at = None
+        # Results of the loads started before the flush are stale
+        self._generation += 1
+        self._inflight = None
 
     def cache_key(self):
         """Non-async function whose value changes every time the cached object changes."""
         return f"{self._cached_key}_{self._cache_time}"
 
     async def _cache_update_needed(self):
-        if self.timeout and self.timeout > 0:
-            if (self._cache_time + self.timeout) < time.time():
-                # Cache refresh required due to timeout
-                return True
+        if self._expires_at is not None and self._expires_at < time.monotonic():
+            # Cache refresh required due to timeout
+            return True
         if self._cached_key is NO_VALUE:
             # No cached key
             return True
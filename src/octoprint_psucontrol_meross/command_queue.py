@@ -0,0 +1,111 @@
+"""Per-channel command queue (on/off: last write wins, toggles: in order)."""
+
+import asyncio
+import collections
+
+from typing import Awaitable, Callable, Deque, Dict, Union
+
+# `submit()` state that flips the channel (never coalesced nor skipped)
+TOGGLE = "toggle"
+
+
+class _Command:
+    """A queued command (and the future all of its submitters wait for)."""
+
+    def __init__(self, state: Union[bool, str], future: asyncio.Future):
+        self.state = state
+        self.future = future
+
+
+class _ChannelQueue:
+    """State of a single device channel's queue."""
+
+    def __init__(self):
+        # Drains the queue (while there is something to do)
+        self.task: asyncio.Task = None
+        self.running: bool = False  # A command is being sent to the device
+        # The commands to send next, in order
+        self.pending: Deque[_Command] = collections.deque()
+
+
+class CommandQueue:
+    """Serialises the commands of each `uuid::channel`.
+
+    Only one command per channel is sent to the device at a time. An on/off
+    command submitted meanwhile replaces the on/off command queued last
+    (its submitters get the outcome of the newer command), and on/off
+    commands that would not change the known channel state are skipped.
+    Toggles are always sent, in order with the other commands.
+
+    Lives on the worker loop.
+    """
+
+    def __init__(
+        self,
+        execute: Callable[[str, Union[bool, str]], Awaitable],
+        state_matches: Callable[[str, bool], bool],
+        logger,
+    ):
+        self.execute = execute
+        self.state_matches = state_matches
+        self._logger = logger
+        self._channels: Dict[str, _ChannelQueue] = {}
+        self.coalesced = 0  # Queued commands replaced by a newer one
+        self.skipped = 0  # Commands not sent as the channel was already in that state
+
+    @property
+    def depth(self) -> int:
+        """Number of commands that are being sent or waiting to be sent."""
+        return sum(
+            int(channel.running) + len(channel.pending)
+            for channel in tuple(self._channels.values())
+        )
+
+    def close(self):
+        """Cancel the queued and running commands."""
+        for channel in self._channels.values():
+            for command in channel.pending:
+                command.future.cancel()
+            if channel.task is not None:
+                channel.task.cancel()
+        self._channels.clear()
+
+    async def submit(self, dev_id: str, state: Union[bool, str]):
+        """Send `state` (on/off or `TOGGLE`) once the previously submitted commands are done."""
+        channel = self._channels.setdefault(dev_id, _ChannelQueue())
+        pending = channel.pending
+        if state != TOGGLE and pending and pending[-1].state != TOGGLE:
+            self.coalesced += 1
+            self._logger.debug(
+                f"{dev_id}: queued {pending[-1].state!r} replaced by {state!r}."
+            )
+            pending[-1].state = state
+        else:
+            pending.append(_Command(state, asyncio.get_running_loop().create_future()))
+        future = pending[-1].future
+        if channel.task is None or channel.task.done():
+            channel.task = asyncio.ensure_future(self._drain(dev_id, channel))
+        # Shielded, so that a cancelled submitter doesn't cancel the command of others
+        return await asyncio.shield(future)
+
+    async def _drain(self, dev_id: str, channel: _ChannelQueue):
+        while channel.pending:
+            command = channel.pending.popleft()
+            state, future = (command.state, command.future)
+            if state != TOGGLE and self.state_matches(dev_id, state):
+                self.skipped += 1
+                self._logger.debug(f"{dev_id}: already {state!r}, command skipped.")
+                future.set_result(None)
+                continue
+            channel.running = True
+            try:
+                await self.execute(dev_id, state)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as err:
+                future.set_exception(err)
+            else:
+                future.set_result(None)
+            finally:
+                channel.running = False
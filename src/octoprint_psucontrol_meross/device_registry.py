@@ -0,0 +1,173 @@
+"""Registry of the discovered meross devices, keyed by device uuid."""
+
+import dataclasses
+import hashlib
+import json
+
+from typing import Callable, Dict, Iterable, Mapping, Optional, Set, Tuple
+
+from .device_state import make_dev_id
+
+
+@dataclasses.dataclass
+class MerossDeviceHandle:
+    """A simplified thread-safe meross device ID."""
+
+    name: str
+    dev_id: str
+
+    def asdict(self) -> dict:
+        return dataclasses.asdict(self)
+
+
+@dataclasses.dataclass(frozen=True)
+class DeviceIndex:
+    """Lookup tables built once per registry generation.
+
+    Shared by all readers, so none of its members are to be modified.
+    """
+
+    generation: int
+    devices: Mapping[str, object]  # uuid -> device
+    channels: Mapping[str, object]  # <uuid>::<channel idx> -> channel info
+    handles: Tuple[MerossDeviceHandle]  # sorted by name
+    handle_dicts: Tuple[dict]  # `handles`, serialised
+    handle_jsons: Tuple[str]  # `handle_dicts`, JSON-encoded
+    etag: str  # Identifies the device list of this generation
+
+    @classmethod
+    def build(cls, generation: int, devices: Iterable[object]) -> "DeviceIndex":
+        devices = {device.uuid: device for device in devices}
+        channels = {}
+        handles = []
+        for device in devices.values():
+            for channel in device.channels:
+                dev_id = make_dev_id(device.uuid, channel.index)
+                if channel.is_master_channel:
+                    # Use plain device name for master channel
+                    merged_name = device.name
+                else:
+                    merged_name = f"{device.name}: {channel.name}"
+                channels[dev_id] = channel
+                handles.append(MerossDeviceHandle(name=merged_name, dev_id=dev_id))
+        handles.sort(key=lambda el: el.name)
+        handle_dicts = tuple(el.asdict() for el in handles)
+        handle_jsons = tuple(json.dumps(el) for el in handle_dicts)
+        digest = hashlib.sha1("\n".join(handle_jsons).encode("utf-8")).hexdigest()
+        return cls(
+            generation=generation,
+            devices=devices,
+            channels=channels,
+            handles=tuple(handles),
+            handle_dicts=handle_dicts,
+            handle_jsons=handle_jsons,
+            # The digest tells apart the generations of different registries (and runs)
+            etag=f"{generation}-{digest[:16]}",
+        )
+
+    def select(
+        self, query: str = None, offset: int = 0, limit: int = None
+    ) -> Tuple[int, Tuple[str]]:
+        """Return (number of matches, JSON-encoded handles of the page).
+
+        `query` matches (case-insensitively) a part of the name or the ID.
+        """
+        matches = self.handle_jsons
+        if query:
+            query = query.lower()
+            matches = tuple(
+                encoded
+                for (handle, encoded) in zip(self.handles, self.handle_jsons)
+                if query in handle.name.lower() or query in handle.dev_id.lower()
+            )
+        end = None if limit is None else offset + limit
+        return (len(matches), matches[offset:end])
+
+
+class DeviceRegistry:
+    """uuid -> meross device registry.
+
+    Filled by full discovery sweeps and updated one device at a time from
+    push notifications. Every change of a device bumps its version (and the
+    registry-wide `generation`) so that the caches that depend on a device
+    can be invalidated without touching the rest.
+
+    Only accessed from the worker loop.
+    """
+
+    generation = 0
+    _index: DeviceIndex = None
+    # Called with the uuids of the changed devices
+    on_change: Callable[[Tuple[str]], None] = None
+
+    def __init__(self):
+        self._devices: Dict[str, object] = {}
+        # Last online status seen by the registry (it is updated from push
+        #  notifications and timeouts, the device objects may lag behind)
+        self._online_status: Dict[str, object] = {}
+        self._versions: Dict[str, int] = {}
+
+    def __contains__(self, dev_uuid: str) -> bool:
+        return dev_uuid in self._devices
+
+    def __len__(self) -> int:
+        return len(self._devices)
+
+    def get(self, dev_uuid: str):
+        return self._devices.get(dev_uuid)
+
+    def devices(self) -> Tuple[object]:
+        return tuple(self._devices.values())
+
+    @property
+    def index(self) -> DeviceIndex:
+        """Lookup index of the current registry generation."""
+        if self._index is None or self._index.generation != self.generation:
+            self._index = DeviceIndex.build(self.generation, self._devices.values())
+        return self._index
+
+    def device_version(self, dev_uuid: str) -> int:
+        return self._versions.get(dev_uuid, 0)
+
+    def online_status(self, dev_uuid: str) -> Optional[object]:
+        """Return the device's online status (or `None` for unknown devices)."""
+        return self._online_status.get(dev_uuid)
+
+    def sync(self, devices: Iterable[object]) -> Set[str]:
+        """Apply a full discovery sweep result.
+
+        Returns uuids of the added, removed, replaced and re-connected devices.
+        """
+        new_devices = {device.uuid: device for device in devices}
+        new_online_status = {
+            dev_uuid: device.online_status for (dev_uuid, device) in new_devices.items()
+        }
+        changed = {
+            dev_uuid
+            for dev_uuid in set(self._devices) | set(new_devices)
+            if self._devices.get(dev_uuid) is not new_devices.get(dev_uuid)
+            or self._online_status.get(dev_uuid) != new_online_status.get(dev_uuid)
+        }
+        self._devices = new_devices
+        self._online_status = new_online_status
+        self._touch(changed)
+        return changed
+
+    def set_online_status(self, dev_uuid: str, status) -> bool:
+        """Record an online status change of a known device (returns True if it changed)."""
+        if dev_uuid not in self._devices:
+            return False
+        if self._online_status.get(dev_uuid) == status:
+            return False
+        self._online_status[dev_uuid] = status
+        self._touch([dev_uuid])
+        return True
+
+    def _touch(self, dev_uuids: Iterable[str]):
+        dev_uuids = tuple(dev_uuids)
+        for dev_uuid in dev_uuids:
+            self._versions[dev_uuid] = self._versions.get(dev_uuid, 0) + 1
+        if dev_uuids:
+            self.generation += 1
+            if self.on_change is not None:
+                self.on_change(dev_uuids)
@@ -0,0 +1,181 @@
+"""Thread-safe table of the last known on/off state of every device channel."""
+
+import dataclasses
+import enum
+import threading
+import time
+
+from typing import Callable, Dict, FrozenSet, Iterable, Optional, Tuple
+
+
+class StateSource(str, enum.Enum):
+    """Where a channel state entry came from."""
+
+    PUSH = "push"  # MQTT push notification
+    POLL = "poll"  # Explicit device query
+    COMMAND = "command"  # Acknowledged on/off/toggle command
+    SNAPSHOT = "snapshot"  # Restored from the previous run
+
+
+@dataclasses.dataclass(frozen=True)
+class ChannelState:
+    is_on: bool
+    source: StateSource
+    updated_at: float  # `time.monotonic()` timestamp
+
+    @property
+    def age(self) -> float:
+        """Seconds since this state was recorded."""
+        return time.monotonic() - self.updated_at
+
+
+@dataclasses.dataclass(frozen=True)
+class GroupState:
+    """On/off state of a set of channels (on only if all of them are on)."""
+
+    is_on: bool
+    # `time.monotonic()` of the oldest channel state it is derived from
+    updated_at: float
+    computed_at: float  # `time.monotonic()` of the derivation
+
+    @property
+    def age(self) -> float:
+        """Seconds since the oldest channel state was recorded."""
+        return time.monotonic() - self.updated_at
+
+
+def make_dev_id(dev_uuid: str, channel: int) -> str:
+    """Build this plugin's device ID (<meross uuid>::<channel idx>)."""
+    return f"{dev_uuid}::{channel}"
+
+
+class DeviceStateTable:
+    """Per `uuid::channel` state table.
+
+    Written to from the worker loop (push notifications, command acks, polls)
+    and read from the flask/PSUControl threads, hence the mutex.
+
+    Group (target set) states are derived from the channel states on read;
+    the last one derived for each set is kept as the fallback for when some
+    of its channel states are gone (e.g. the device was re-discovered).
+    """
+
+    # Called (outside of the mutex) with the IDs of the updated or removed entries
+    on_change: Callable[[Tuple[str]], None] = None
+
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self._states: Dict[str, ChannelState] = {}
+        self._groups: Dict[FrozenSet[str], GroupState] = {}
+
+    def update(
+        self,
+        dev_uuid: str,
+        channel: int,
+        is_on: bool,
+        source: StateSource,
+        age: float = 0,
+    ) -> ChannelState:
+        out = ChannelState(
+            is_on=bool(is_on),
+            source=StateSource(source),
+            updated_at=time.monotonic() - age,
+        )
+        dev_id = make_dev_id(dev_uuid, channel)
+        with self.mutex:
+            self._states[dev_id] = out
+        self._notify((dev_id,))
+        return out
+
+    def update_from_togglex(self, dev_uuid: str, payload, source: StateSource) -> int:
+        """Apply a `togglex` payload (a dict for plugs, a list for power strips).
+
+        Returns the number of updated channels.
+        """
+        if isinstance(payload, dict):
+            payload = [payload]
+        elif not isinstance(payload, (list, tuple)):
+            return 0
+        updated = 0
+        for el in payload:
+            try:
+                channel = int(el["channel"])
+                is_on = el["onoff"] == 1
+            except (KeyError, TypeError, ValueError):
+                continue
+            self.update(dev_uuid, channel, is_on, source)
+            updated += 1
+        return updated
+
+    def get(self, dev_id: str) -> Optional[ChannelState]:
+        with self.mutex:
+            return self._states.get(dev_id)
+
+    def get_many(self, dev_ids: Iterable[str]) -> Tuple[Optional[ChannelState]]:
+        with self.mutex:
+            return tuple(self._states.get(dev_id) for dev_id in dev_ids)
+
+    def get_fresh(
+        self, dev_ids: Iterable[str], max_age: float
+    ) -> Optional[Tuple[ChannelState]]:
+        """Return states for all `dev_ids` or `None` if any of them is missing or older than `max_age`."""
+        out = self.get_many(dev_ids)
+        if any(el is None or el.age > max_age for el in out):
+            return None
+        return out
+
+    def group_state(self, dev_ids: Iterable[str]) -> Optional[GroupState]:
+        """Derive the state of the `dev_ids` group (`None` if any channel state is missing)."""
+        key = frozenset(dev_ids)
+        with self.mutex:
+            states = tuple(self._states.get(dev_id) for dev_id in key)
+            if not states or any(el is None for el in states):
+                return None
+            out = GroupState(
+                is_on=all(el.is_on for el in states),
+                updated_at=min(el.updated_at for el in states),
+                computed_at=time.monotonic(),
+            )
+            self._groups[key] = out
+        return out
+
+    def last_group_state(self, dev_ids: Iterable[str]) -> Optional[GroupState]:
+        """The state last derived for the `dev_ids` group (however old)."""
+        with self.mutex:
+            return self._groups.get(frozenset(dev_ids))
+
+    def dump(self) -> Dict[str, Tuple[bool, float]]:
+        """Return {dev_id: (is_on, `time.time()` of the update)} of all entries."""
+        now = time.time()
+        with self.mutex:
+            return {
+                dev_id: (state.is_on, now - state.age)
+                for (dev_id, state) in self._states.items()
+            }
+
+    def discard(self, dev_id: str):
+        """Forget the state of a single channel."""
+        with self.mutex:
+            removed = self._states.pop(dev_id, None)
+        if removed is not None:
+            self._notify((dev_id,))
+
+    def invalidate_device(self, dev_uuid: str):
+        """Forget all channel states of the device."""
+        prefix = make_dev_id(dev_uuid, "")
+        with self.mutex:
+            removed = tuple(key for key in self._states if key.startswith(prefix))
+            for key in removed:
+                del self._states[key]
+        self._notify(removed)
+
+    def clear(self):
+        with self.mutex:
+            removed = tuple(self._states)
+            self._states.clear()
+            self._groups.clear()
+        self._notify(removed)
+
+    def _notify(self, dev_ids: Tuple[str]):
+        if dev_ids and self.on_change is not None:
+            self.on_change(dev_ids)
@@ -12,3 +12,19 @@ class CacheGetError(MerossCacheError):
 
 class MerossClientError(MerossPSUControlError):
     """Meross cloud-related error."""
+
+
+class LanCommandError(MerossClientError):
+    """The device did not execute a command sent over the local network."""
+
+
+class DeadlineExceededError(MerossClientError):
+    """The call did not finish within its time budget."""
+
+
+class CircuitOpenError(MerossClientError):
+    """The device failed too many times recently, the call was not attempted."""
+
+
+class BrokerError(MerossClientError):
+    """The session broker is unreachable (or failed the call)."""
@@ -1,45 +1,161 @@
 """This module converts async meross-iot library to synchronous bindings flask handle can use."""
+
 import asyncio
-import dataclasses
+import functools
+import threading
+import time
 
 from concurrent.futures import Future
 from pathlib import Path
-from typing import Sequence, Tuple
-
-from meross_iot.http_api import MerossHttpClient
-from meross_iot.manager import MerossManager
-from meross_iot.model.enums import Namespace as MerossEvtNamespace, OnlineStatus
-from meross_iot.model.exception import (
-    CommandError,
-    CommandTimeoutError,
-    MqttError,
-    UnconnectedError,
-    UnknownDeviceType,
+from typing import (
+    Awaitable,
+    Callable,
+    Dict,
+    FrozenSet,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
 )
 
+from . import broker, tracing
 from .cache import AsyncCachedObject, MerossCache, NO_VALUE
-from .exc import CacheGetError, MerossClientError
-from .threaded_worker import ThreadedWorker
+from .command_queue import CommandQueue, TOGGLE
+from .device_registry import DeviceIndex, DeviceRegistry, MerossDeviceHandle
+from .device_state import ChannelState, DeviceStateTable, StateSource
+from .exc import CacheGetError, DeadlineExceededError, MerossClientError
+from .metrics import MetricsRegistry
+from .region import RegionSelector
+from .resilience import (
+    CircuitBreaker,
+    CommandResult,
+    Deadline,
+    DEFAULT_CALL_BUDGET,
+    run_device_call,
+)
+from .session_supervisor import SessionSupervisor
+from .state_push import StatePushPublisher
+from .threaded_worker import (
+    DEFAULT_EXECUTOR_WORKERS,
+    EVENT_LOOP_AUTO,
+    STOP_TIMEOUT,
+    ThreadedWorker,
+)
+from .transport import DeviceTransport
 
+# meross_iot (and the paho-mqtt/aiohttp stack under it) is slow to import,
+#  so it is only loaded by `import_meross_iot()` on the first login, which
+#  runs on the worker thread. Until then all of these names are `None`.
+ANY_MEROSS_IOT_EXC = None
+BAD_CREDENTIALS_EXC = None
+CommandTimeoutError = None
+GenericSubDevice = None
+HttpDeviceInfo = None
+MerossEvtNamespace = None
+MerossHttpClient = None
+MerossManager = None
+OnlineStatus = None
+SESSION_REJECTED_EXC = None
+build_meross_device_from_abilities = None
 
-ANY_MEROSS_IOT_EXC = (
-    UnconnectedError,
-    CommandTimeoutError,
-    MqttError,
-    CommandError,
-    UnknownDeviceType,
+_LAZY_MEROSS_IOT_NAMES = (
+    "ANY_MEROSS_IOT_EXC",
+    "BAD_CREDENTIALS_EXC",
+    "CommandTimeoutError",
+    "GenericSubDevice",
+    "HttpDeviceInfo",
+    "MerossEvtNamespace",
+    "MerossHttpClient",
+    "MerossManager",
+    "OnlineStatus",
+    "SESSION_REJECTED_EXC",
+    "build_meross_device_from_abilities",
 )
 
 
-@dataclasses.dataclass
-class MerossDeviceHandle:
-    """A simplified thread-safe meross device ID."""
+def import_meross_iot():
+    """Import meross_iot into this module's namespace.
+
+    Names that are already set (e.g. patched by the tests) are kept.
+    """
+    module_globals = globals()
+    if all(module_globals[name] is not None for name in _LAZY_MEROSS_IOT_NAMES):
+        return
+
+    from meross_iot.controller.device import GenericSubDevice
+    from meross_iot.device_factory import build_meross_device_from_abilities
+    from meross_iot.http_api import MerossHttpClient
+    from meross_iot.manager import MerossManager
+    from meross_iot.model.enums import Namespace as MerossEvtNamespace, OnlineStatus
+    from meross_iot.model.exception import (
+        CommandError,
+        CommandTimeoutError,
+        MqttError,
+        UnconnectedError,
+        UnknownDeviceType,
+    )
+    from meross_iot.model.http.device import HttpDeviceInfo
+    from meross_iot.model.http.exception import (
+        BadLoginException,
+        TokenExpiredException,
+        UnauthorizedException,
+    )
+
+    imported = {
+        "ANY_MEROSS_IOT_EXC": (
+            UnconnectedError,
+            CommandTimeoutError,
+            MqttError,
+            CommandError,
+            UnknownDeviceType,
+        ),
+        # The account is wrong, there is no point trying other regions
+        "BAD_CREDENTIALS_EXC": (BadLoginException, UnauthorizedException),
+        "CommandTimeoutError": CommandTimeoutError,
+        "GenericSubDevice": GenericSubDevice,
+        "HttpDeviceInfo": HttpDeviceInfo,
+        "MerossEvtNamespace": MerossEvtNamespace,
+        "MerossHttpClient": MerossHttpClient,
+        "MerossManager": MerossManager,
+        "OnlineStatus": OnlineStatus,
+        # The cloud no longer accepts the session token
+        "SESSION_REJECTED_EXC": (TokenExpiredException, UnauthorizedException),
+        "build_meross_device_from_abilities": build_meross_device_from_abilities,
+    }
+    for name in _LAZY_MEROSS_IOT_NAMES:
+        if module_globals[name] is None:
+            module_globals[name] = imported[name]
+
+
+# Default max age (in seconds) of a `DeviceStateTable` entry
+#  before `is_on()` schedules a device query.
+DEFAULT_STATE_MAX_AGE = 60
+# Max delay (in seconds) of an inventory save after a command,
+#  the state changes of the commands in between are saved in a single write
+INVENTORY_SAVE_DELAY = 30
+
 
-    name: str
-    dev_id: str
+def _measured_command(command: str):
+    """Record the duration (and failures) of an async client command (and its span)."""
 
-    def asdict(self) -> dict:
-        return dataclasses.asdict(self)
+    def _decorator(fn):
+        @functools.wraps(fn)
+        async def _wrapper(self, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                with tracing.span(command):
+                    return await fn(self, *args, **kwargs)
+            except Exception:
+                self.command_errors_total.inc(command=command)
+                raise
+            finally:
+                self.command_duration.observe(
+                    time.perf_counter() - start, command=command
+                )
+
+        return _wrapper
+
+    return _decorator
 
 
 class _OctoprintPsuMerossClientAsync:
@@ -48,64 +164,369 @@ class _OctoprintPsuMerossClientAsync:
     # a Key that identifies currently active session
     #  (used to deduplicate login())
     _current_session_key: str = None
-    api_client: MerossHttpClient = None
-    is_on_cache: bool = None
+    _session_user: str = None
+    _session_password: str = None  # For the background token refreshes
+    # Incremented by every login/logout (but not by the token refreshes),
+    #  a new session gets a new manager
+    _session_generation: int = 0
+    api_client: "MerossHttpClient" = None
+    manager: "MerossManager" = None
+    is_warmed_up: bool = False
+    # Duration (in seconds) of each warm-up phase of the last warm-up
+    warm_up_timings: Dict[str, float] = None
+    # Phase the last warm-up failed in (`None` if it did not fail)
+    warm_up_failed_phase: str = None
+    # Pending (delayed) inventory save
+    _inventory_save_handle: asyncio.TimerHandle = None
 
-    def __init__(self, cache_file: Path, logger):
+    def __init__(
+        self,
+        cache_file: Path,
+        logger,
+        legacy_cache_file: Path = None,
+        manager_kwargs: dict = None,
+        lan_control: bool = True,
+        on_state_push: Callable[[dict], None] = None,
+    ):
         super().__init__()
         self._logger = logger
-        self._cache = MerossCache(cache_file, logger=logger.getChild("cache"))
+        # Extra `MerossManager` arguments (e.g. a custom MQTT server)
+        self._manager_kwargs = dict(manager_kwargs or {})
+        self.metrics = MetricsRegistry(prefix="psucontrol_meross_")
+        self._init_metrics()
+        self.transport = DeviceTransport(
+            logger=logger.getChild("transport"),
+            lan_enabled=lan_control,
+            on_command=(
+                lambda path, success: self.transport_commands_total.inc(
+                    path=path.value, result="success" if success else "failure"
+                )
+            ),
+        )
+        self._cache = MerossCache(
+            cache_file,
+            logger=logger.getChild("cache"),
+            legacy_shelve_file=legacy_cache_file,
+        )
 
         # Configure awaitable caches
         async def _get_manager_fn():
-            manager = MerossManager(http_client=self.api_client)
+            manager = MerossManager(http_client=self.api_client, **self._manager_kwargs)
+            # Cloud (MQTT) command latencies tell the region selector when to re-probe
+            cloud_execute = manager.async_execute_cmd
+
+            async def _timed_cloud_execute(*args, **kwargs):
+                start = time.perf_counter()
+                out = await cloud_execute(*args, **kwargs)
+                self.region_selector.observe(time.perf_counter() - start)
+                return out
+
+            manager.async_execute_cmd = _timed_cloud_execute
+            self.transport.install(manager)
             await manager.async_init()
             manager.register_push_notification_handler_coroutine(self._on_manager_event)
+            self.manager = manager
             return manager
 
         self.get_manager = AsyncCachedObject(
             enabled=(lambda: self.is_authenticated),
-            get_key=(lambda: id(self.api_client)),
+            get_key=(lambda: self._session_generation),
             get_object=_get_manager_fn,
+            name="manager",
         )
 
         async def _async_device_discovery():
             self._logger.debug("Running async device discovery...")
-            manager = await self.get_manager()
-            out = await manager.async_device_discovery()
-            return tuple(el for el in out if el is not None)
+            with tracing.span("get_manager"):
+                manager = await self.get_manager()
+            self.discoveries_total.inc()
+            with self.cloud_call_duration.time(call="discovery"), tracing.span(
+                "discovery"
+            ):
+                out = await manager.async_device_discovery()
+            devices = tuple(el for el in out if el is not None)
+            changed = self.device_registry.sync(devices)
+            self._logger.debug(f"Discovery changed devices: {sorted(changed)!r}")
+            if changed:
+                self._save_inventory()
+            return devices
 
         self.async_device_discovery = AsyncCachedObject(
             enabled=(lambda: self.is_authenticated),
             get_key=self.get_manager.cache_key,
             get_object=_async_device_discovery,
-            timeout=10 * 60,  # 10 minutes
+            soft_timeout=10 * 60,  # Re-discover in the background after 10 minutes
+            timeout=60 * 60,  # Block on re-discovery after an hour
+            name="discovery",
         )
 
+        self.region_selector = RegionSelector(
+            self._cache, logger=logger.getChild("region")
+        )
+        self.session_supervisor = SessionSupervisor(
+            get_credentials=(
+                lambda: self.api_client.cloud_credentials if self.api_client else None
+            ),
+            verify=self._verify_session,
+            refresh=self._refresh_session,
+            get_mqtt_clients=(
+                lambda: dict(self.manager._mqtt_clients) if self.manager else {}
+            ),
+            logger=logger.getChild("session"),
+        )
+        self.device_registry = DeviceRegistry()
         self._controlled_device_cache = {}
+        # {dev_uuid: `time.monotonic()` the last `async_update()` was sent at}
+        self._device_updated_at: Dict[str, float] = {}
+        # In-flight `async_update()` calls of the stale device polls
+        self._device_polls: Dict[str, asyncio.Future] = {}
+        self.state_table = DeviceStateTable()
+        self.circuit_breakers: Dict[str, CircuitBreaker] = {}
+        self.command_queue = CommandQueue(
+            execute=self._run_channel_command,
+            state_matches=self._channel_state_matches,
+            logger=logger.getChild("command_queue"),
+        )
+        self.state_push = None
+        if on_state_push is not None:
+            self.state_push = StatePushPublisher(
+                send=on_state_push,
+                describe=self._describe_channels,
+                get_index=(lambda: self.device_registry.index),
+                logger=logger.getChild("state_push"),
+            )
+            self.state_table.on_change = self.state_push.channels_changed
+            self.device_registry.on_change = self.state_push.devices_changed
+
+    def _init_metrics(self):
+        metrics = self.metrics
+        self.logins_total = metrics.counter(
+            "logins_total", "Full (user/password) Meross cloud logins.", ["result"]
+        )
+        self.session_restores_total = metrics.counter(
+            "session_restores_total", "Attempts to reuse a saved session.", ["result"]
+        )
+        self.discoveries_total = metrics.counter(
+            "discoveries_total", "Device discovery sweeps."
+        )
+        self.mqtt_commands_total = metrics.counter(
+            "mqtt_commands_total",
+            "Commands sent to the devices ('update' is a `device.async_update()`).",
+            ["command"],
+        )
+        self.cloud_call_duration = metrics.histogram(
+            "cloud_call_duration_seconds",
+            "Duration of the Meross cloud/device calls.",
+            ["call"],
+        )
+        self.command_duration = metrics.histogram(
+            "command_duration_seconds", "Duration of the client commands.", ["command"]
+        )
+        self.command_errors_total = metrics.counter(
+            "command_errors_total", "Client commands that raised an error.", ["command"]
+        )
+        metrics.callback_counter(
+            "commands_coalesced_total",
+            "Queued on/off commands replaced by a newer one.",
+            [],
+            lambda: {(): self.command_queue.coalesced},
+        )
+        metrics.callback_counter(
+            "commands_skipped_total",
+            "On/off commands not sent as the channel was already in that state.",
+            [],
+            lambda: {(): self.command_queue.skipped},
+        )
+        metrics.callback_gauge(
+            "circuit_breakers_open",
+            "Devices whose calls currently fail fast after repeated failures.",
+            [],
+            lambda: {
+                (): sum(
+                    el.state == "open" for el in tuple(self.circuit_breakers.values())
+                )
+            },
+        )
+        metrics.callback_gauge(
+            "command_queue_depth",
+            "On/off commands being sent or waiting to be sent.",
+            [],
+            lambda: {(): self.command_queue.depth},
+        )
+        metrics.callback_counter(
+            "state_push_messages_total",
+            "State change messages sent to the frontend.",
+            [],
+            lambda: {(): self.state_push.messages_sent if self.state_push else 0},
+        )
+        metrics.callback_counter(
+            "session_refreshes_total",
+            "Background session token refreshes.",
+            ["result"],
+            lambda: {
+                ("success",): self.session_supervisor.refreshes,
+                ("failure",): self.session_supervisor.refresh_failures,
+            },
+        )
+        metrics.callback_counter(
+            "mqtt_reconnects_total",
+            "MQTT reconnects done by the session supervisor.",
+            ["result"],
+            lambda: {
+                ("success",): self.session_supervisor.reconnects,
+                ("failure",): self.session_supervisor.reconnect_failures,
+            },
+        )
+        metrics.callback_gauge(
+            "session_token_age_seconds",
+            "Time since the session token was issued.",
+            [],
+            self._get_token_age,
+        )
+        self.transport_commands_total = metrics.counter(
+            "transport_commands_total",
+            "Device commands by path (local LAN or cloud MQTT).",
+            ["path", "result"],
+        )
+        for name, attr, help in (
+            ("cache_hits_total", "hits", "Calls served from the cache."),
+            ("cache_misses_total", "misses", "Calls that needed a cache load."),
+            (
+                "cache_coalesced_loads_total",
+                "coalesced_loads",
+                "Cache misses that joined an in-flight load.",
+            ),
+        ):
+            metrics.callback_counter(
+                name, help, ["cache"], functools.partial(self._get_cache_stats, attr)
+            )
+
+    def _get_token_age(self) -> Dict[Tuple[str], float]:
+        try:
+            age = self.session_supervisor.token_age
+        except (AttributeError, TypeError, ValueError):  # Not a `MerossCloudCreds`
+            age = None
+        return {} if age is None else {(): age}
+
+    def _get_cache_stats(self, attr: str) -> Dict[Tuple[str], int]:
+        """Sum of the `attr` counter of the `AsyncCachedObject`s, by cache name."""
+        out = {}
+        caches = [self.get_manager, self.async_device_discovery]
+        caches.extend(tuple(self._controlled_device_cache.values()))
+        for cache_obj in caches:
+            key = (cache_obj.name,)
+            out[key] = out.get(key, 0) + getattr(cache_obj, attr)
+        return out
 
     async def _on_manager_event(
         self, evt, data: dict, device_internal_id: str, *args, **kwargs
     ):
-        if evt.namespace in (
-            MerossEvtNamespace.SYSTEM_ONLINE,
-            MerossEvtNamespace.SYSTEM_ALL,
-            MerossEvtNamespace.CONTROL_TOGGLEX,  # An unknown device is toggled
-        ):
-            # flush device list cache if a new device appeared online
-            self.async_device_discovery.flush()
-            self._logger.debug("Device list cache flushed")
+        self._update_state_from_push(evt)
+        dev_uuid = evt.originating_device_uuid
+        if dev_uuid not in self.device_registry:
+            if evt.namespace in (
+                MerossEvtNamespace.SYSTEM_ONLINE,
+                MerossEvtNamespace.SYSTEM_ALL,
+                MerossEvtNamespace.CONTROL_TOGGLEX,  # An unknown device is toggled
+            ):
+                # flush device list cache if a new device appeared online
+                self.async_device_discovery.flush()
+                self._logger.debug(
+                    f"Device list cache flushed (unknown device {dev_uuid!r})"
+                )
+        elif evt.namespace is MerossEvtNamespace.SYSTEM_ONLINE:
+            if self.device_registry.set_online_status(
+                dev_uuid, self._get_push_online_status(evt)
+            ):
+                self._logger.debug(f"Device {dev_uuid!r} online status changed.")
+
+    def _get_push_online_status(self, evt) -> "OnlineStatus":
+        status = (evt.raw_data or {}).get("online", {}).get("status")
+        try:
+            return OnlineStatus(status)
+        except ValueError:
+            return OnlineStatus.UNKNOWN
+
+    def _update_state_from_push(self, evt):
+        """Feed the state table from an MQTT push notification."""
+        dev_uuid = evt.originating_device_uuid
+        raw_data = evt.raw_data or {}
+        if evt.namespace is MerossEvtNamespace.CONTROL_TOGGLEX:
+            self.state_table.update_from_togglex(
+                dev_uuid, raw_data.get("togglex"), StateSource.PUSH
+            )
+        elif evt.namespace is MerossEvtNamespace.SYSTEM_ALL:
+            self.state_table.update_from_togglex(
+                dev_uuid,
+                raw_data.get("all", {}).get("digest", {}).get("togglex"),
+                StateSource.PUSH,
+            )
+        elif evt.namespace is MerossEvtNamespace.SYSTEM_ONLINE:
+            if self._get_push_online_status(evt) is not OnlineStatus.ONLINE:
+                # The device went away, its last known state is meaningless now
+                self.state_table.invalidate_device(dev_uuid)
+
+    def _update_state_from_device(self, dev_handles, source: StateSource):
+        """Record current states of the (device, channel) pairs."""
+        for device, channel in dev_handles:
+            is_on = device.is_on(channel=channel)
+            if is_on is not None:
+                self.state_table.update(device.uuid, channel, is_on, source)
 
     @property
     def is_authenticated(self):
         return self.api_client is not None
 
     async def logout(self):
+        self.session_supervisor.stop()
         if self.api_client:
             await self.api_client.async_logout()
-        self.api_client = None
+        self.api_client = self.manager = None
+        self._session_generation += 1
+        self.is_warmed_up = False
+        self._current_session_key = self._session_user = self._session_password = None
+        # Devices of the previous account
+        self.device_registry.sync(())
+        self.state_table.clear()
+
+    async def close(self):
+        """Stop the background work and disconnect from the cloud.
+
+        The session token is kept (and the device inventory saved),
+        so the next `login()` restores the session.
+        """
+        self.session_supervisor.stop()
+        self.command_queue.close()
+        saved = self._save_inventory()
+        if saved is not None:
+            await asyncio.wait([saved])
+        manager = self.manager
+        self.api_client = self.manager = None
+        self._session_generation += 1
+        self.is_warmed_up = False
+        self._current_session_key = self._session_user = self._session_password = None
+        self.get_manager.flush()
+        self.async_device_discovery.flush()
+        self._controlled_device_cache.clear()
+        self._device_updated_at.clear()
+        self._device_polls.clear()
+        self.device_registry.sync(())
+        self.state_table.clear()
+        if self.state_push is not None:
+            self.state_push.cancel()
+        self._cache.shutdown_executor()
+        await self.transport.close()
+        if manager is not None:
+            manager.close()
+            # Wait for the paho network threads to process the disconnect
+            mqtt_clients = tuple(manager._mqtt_clients.values())
+            await asyncio.get_running_loop().run_in_executor(
+                None, lambda: [el.loop_stop() for el in mqtt_clients]
+            )
 
     async def login(self, api_base_url: str, user: str, password: str, raise_exc: bool):
+        # Every other meross_iot call happens after a successful login
+        import_meross_iot()
         expected_session_key = self._cache.get_session_name_key(user, password)
         self._logger.debug(
             f"login called with user {user!r} "
@@ -119,63 +540,266 @@ class _OctoprintPsuMerossClientAsync:
                 return True
             else:
                 await self.logout()
+        self._session_generation += 1
         restore_success = await self._try_restore_session(user, password)
         if restore_success:
             self._logger.debug("Restored saved session.")
+            self._current_session_key = expected_session_key
+            # The saved token could have been revoked, the supervisor checks it
+            await self._on_logged_in(user, password, verified=False)
             return True
 
-        self._logger.info(f"Performing full auth login for the user {user!r} against {api_base_url!r}.")
-        try:
-            self.api_client = await MerossHttpClient.async_from_user_password(
-                api_base_url=api_base_url[0], email=user, password=password
-            )
-        except ANY_MEROSS_IOT_EXC:
-            self._logger.exception("Error when trying to log in.")
-            self.api_client = None
-            if raise_exc:
+        self._logger.info(
+            f"Performing full auth login for the user {user!r} against {api_base_url!r}."
+        )
+        if len(api_base_url) > 1:
+            # Automatic region selection
+            with tracing.span("region_probe"):
+                urls = await self.region_selector.order(user, api_base_url)
+        else:
+            self.region_selector.forget()
+            urls = api_base_url[:1]
+        for idx, url in enumerate(urls):
+            start = time.perf_counter()
+            try:
+                with self.cloud_call_duration.time(call="login"), tracing.span(
+                    "login", region=url
+                ):
+                    self.api_client = await MerossHttpClient.async_from_user_password(
+                        api_base_url=url, email=user, password=password
+                    )
+            except asyncio.CancelledError:  # An `Exception` on python 3.7
                 raise
+            except Exception as err:
+                self.logins_total.inc(result="failure")
+                self.api_client = None
+                if idx + 1 < len(urls) and not isinstance(err, BAD_CREDENTIALS_EXC):
+                    self._logger.warning(
+                        f"Login against {url!r} failed ({err!r}), trying the next region."
+                    )
+                    continue
+                if not isinstance(err, ANY_MEROSS_IOT_EXC):
+                    raise
+                self._logger.exception("Error when trying to log in.")
+                if raise_exc:
+                    raise
+            else:
+                self.logins_total.inc(result="success")
+                if len(api_base_url) > 1:
+                    await self.region_selector.remember(
+                        user, api_base_url, url, time.perf_counter() - start
+                    )
+                # save the session (and store a bound function to do that periodically later)
+                self._current_session_key = await self._cache.run_in_executor(
+                    self._cache.set_cloud_session_token,
+                    user,
+                    password,
+                    self.api_client.cloud_credentials,
+                )
+                await self._on_logged_in(user, password, verified=True)
+            break
+        return bool(self.api_client)  # Return 'True' on success
+
+    async def _on_logged_in(self, user: str, password: str, verified: bool):
+        self._session_user = user
+        self._session_password = password
+        self.session_supervisor.start(verified=verified)
+        try:
+            restored = await self._restore_inventory()
+        except Exception:
+            self._logger.exception("Unable to restore the device inventory.")
         else:
-            # save the session (and store a bound function to do that periodically later)
-            self._current_session_key = self._cache.set_cloud_session_token(
-                user, password, self.api_client.cloud_credentials
+            if restored:
+                self._logger.info(f"Restored {restored} device(s) from the inventory.")
+
+    def _schedule_inventory_save(self):
+        """Save the inventory within `INVENTORY_SAVE_DELAY` seconds (unless already scheduled)."""
+        if self._session_user is None or self._inventory_save_handle is not None:
+            return
+        self._inventory_save_handle = asyncio.get_running_loop().call_later(
+            INVENTORY_SAVE_DELAY, self._save_inventory
+        )
+
+    def _save_inventory(self) -> Optional[asyncio.Future]:
+        """Persist the known devices and their last states for the next startup.
+
+        Written on the cache thread (the commands do not wait for the disk),
+        the returned future is done once the inventory is saved.
+        Replaces the scheduled save, if any.
+        """
+        if self._inventory_save_handle is not None:
+            self._inventory_save_handle.cancel()
+            self._inventory_save_handle = None
+        if self._session_user is None:
+            return None
+        devices = [
+            {"abilities": device.abilities, "info": device.cached_http_info.to_dict()}
+            for device in self.device_registry.devices()
+            if not isinstance(device, GenericSubDevice)
+            and device.cached_http_info is not None
+        ]
+        out = asyncio.ensure_future(
+            self._cache.run_in_executor(
+                self._cache.set_device_inventory,
+                self._session_user,
+                {"devices": devices, "states": self.state_table.dump()},
+            )
+        )
+        out.add_done_callback(self._on_inventory_saved)
+        return out
+
+    def _on_inventory_saved(self, future: asyncio.Future):
+        if not future.cancelled() and future.exception() is not None:
+            self._logger.error(
+                f"Unable to save the device inventory: {future.exception()!r}"
             )
-        return bool(self.api_client)  # Return 'True' on success
+
+    async def _restore_inventory(self) -> int:
+        """Pre-populate the device registry from the inventory of the previous run.
+
+        Commands can target the known devices straight away, while the device
+        discovery revalidates the inventory in the background.
+        Returns the number of restored devices.
+        """
+        if len(self.device_registry):
+            return 0  # Already discovered
+        inventory = await self._cache.run_in_executor(
+            self._cache.get_device_inventory, self._session_user
+        )
+        if not inventory:
+            return 0
+        manager = await self.get_manager()
+        devices = []
+        for el in inventory["devices"]:
+            try:
+                device = build_meross_device_from_abilities(
+                    http_device_info=HttpDeviceInfo.from_dict(el["info"]),
+                    device_abilities=el["abilities"],
+                    manager=manager,
+                )
+            except Exception:
+                self._logger.exception(f"Unable to restore device {el!r}.")
+                continue
+            # Enroll with the manager too, so that it dispatches push notifications
+            #  to (and the discovery updates) these device objects.
+            manager._device_registry.enroll_device(device)
+            devices.append(device)
+        self.device_registry.sync(devices)
+        await self.async_device_discovery.prime(tuple(devices))
+
+        now = time.time()
+        for dev_id, (is_on, updated_at) in inventory["states"].items():
+            dev_uuid, channel = self.parse_plugin_dev_id(dev_id)
+            if dev_uuid in self.device_registry:
+                self.state_table.update(
+                    dev_uuid,
+                    channel,
+                    is_on,
+                    StateSource.SNAPSHOT,
+                    age=max(now - updated_at, 0),
+                )
+        return len(devices)
 
     async def _try_restore_session(self, user: str, password: str) -> bool:
-        old_session = self._cache.get_cloud_session_token(user, password)
+        old_session = await self._cache.run_in_executor(
+            self._cache.get_cloud_session_token, user, password
+        )
         if not old_session:
             # Nothing to restore
             return False
 
         success = False
         try:
-            self.api_client = await MerossHttpClient.async_from_cloud_creds(old_session)
+            with self.cloud_call_duration.time(call="session_restore"), tracing.span(
+                "session_restore"
+            ):
+                self.api_client = await MerossHttpClient.async_from_cloud_creds(
+                    old_session
+                )
             success = True
         except Exception:
             self._logger.exception("Error while trying to restore the session.")
-            self._cache.delete_cloud_session_token(user, password)
+            await self._cache.run_in_executor(
+                self._cache.delete_cloud_session_token, user, password
+            )
+        self.session_restores_total.inc(result="success" if success else "failure")
         return success
 
-    async def list_devices(self) -> Tuple[MerossDeviceHandle]:
-        """Return a list of (uuid, name) tuples."""
-        assert self.is_authenticated, "Must be authenticated"
-        out = []
-        for device in await self.async_device_discovery():
-            for channel in device.channels:
-                if channel.is_master_channel:
-                    # Use plain device name for master channel
-                    merged_name = device.name
-                else:
-                    merged_name = f"{device.name}: {channel.name}"
-
-                out.append(
-                    MerossDeviceHandle(
-                        name=merged_name,
-                        dev_id=f"{device.uuid}::{channel.index}",
-                    )
+    async def _verify_session(self) -> bool:
+        """`False` if the cloud rejects the session token."""
+        try:
+            with self.cloud_call_duration.time(call="session_check"):
+                await self.api_client.async_list_devices()
+        except SESSION_REJECTED_EXC:
+            return False
+        return True
+
+    async def _refresh_session(self) -> bool:
+        """Replace the session token by a new one (a full login).
+
+        The manager (with its MQTT connections) and the device registry
+        are kept, the new token is saved for the next startup.
+        """
+        old_client = self.api_client
+        user, password = (self._session_user, self._session_password)
+        if old_client is None or password is None:
+            return False
+        with self.cloud_call_duration.time(call="session_refresh"), tracing.span(
+            "session_refresh"
+        ):
+            new_client = await MerossHttpClient.async_from_user_password(
+                api_base_url=old_client.cloud_credentials.domain,
+                email=user,
+                password=password,
+            )
+        if self.api_client is not old_client:
+            return False  # Logged out (or in again) in the meantime
+        self.api_client = new_client
+        creds = new_client.cloud_credentials
+        self._current_session_key = await self._cache.run_in_executor(
+            self._cache.set_cloud_session_token, user, password, creds
+        )
+        manager = self.manager
+        if manager is not None:
+            old_creds = manager._cloud_creds
+            manager._http_client = new_client
+            manager._cloud_creds = creds
+            if (creds.user_id, creds.key) != (old_creds.user_id, old_creds.key):
+                from meross_iot.utilities.mqtt import generate_mqtt_password
+
+                # Used by paho on the next (re)connect
+                manager._mqtt_password = generate_mqtt_password(
+                    user_id=creds.user_id, key=creds.key
                 )
-        out.sort(key=lambda el: el.name)
-        return tuple(out)
+                for mqtt_client in tuple(manager._mqtt_clients.values()):
+                    mqtt_client.username_pw_set(
+                        username=creds.user_id, password=manager._mqtt_password
+                    )
+        try:
+            # The cloud limits the number of live tokens of an account
+            await old_client.async_logout()
+        except asyncio.CancelledError:  # An `Exception` on python 3.7
+            raise
+        except Exception as err:
+            self._logger.info(f"Unable to log the replaced token out: {err!r}")
+        self._logger.info("Session token refreshed.")
+        return True
+
+    async def list_devices(
+        self, asdict: bool = False, deadline: Deadline = None
+    ) -> Tuple[MerossDeviceHandle]:
+        """Return a list of device handles sorted by name (or their dict representations)."""
+        index = await self.device_index(deadline)
+        return index.handle_dicts if asdict else index.handles
+
+    async def device_index(self, deadline: Deadline = None) -> DeviceIndex:
+        """The (immutable) device lookup index, once the devices are discovered."""
+        assert self.is_authenticated, "Must be authenticated"
+        if deadline is None:
+            await self.async_device_discovery()
+        else:
+            await deadline.wait_for(self.async_device_discovery())
+        return self.device_registry.index
 
     async def get_controlled_device(self, dev_uuid: str):
         try:
@@ -187,55 +811,217 @@ class _OctoprintPsuMerossClientAsync:
             return await cache_obj(default=None)
 
         async def _get_device_cache_key():
+            # Only changes of this very device (or a re-login) invalidate the cache
             return (
                 self.get_manager.cache_key(),
-                self.async_device_discovery.cache_key(),
+                self.device_registry.device_version(dev_uuid),
             )
 
         async def _find_device():
-            for device in await self.async_device_discovery():
-                if device.uuid == dev_uuid:
-                    if device.online_status is not OnlineStatus.ONLINE:
-                        self._logger.info(f"The device is {device.online_status}.")
-                        return NO_VALUE
-
-                    try:
-                        await device.async_update()
-                    except CommandTimeoutError:
-                        self._logger.error(
-                            f"Timeout getting device update for {dev_uuid!r}. Flushing device cache."
-                        )
-                        device.online_status = OnlineStatus.OFFLINE
-                        self.async_device_discovery.flush()
-                        return NO_VALUE
-                    return device
-            raise CacheGetError(dev_uuid)
+            await self.async_device_discovery()
+            device = self.device_registry.get(dev_uuid)
+            if device is None:
+                raise CacheGetError(dev_uuid)
+
+            online_status = self.device_registry.online_status(dev_uuid)
+            if online_status is not OnlineStatus.ONLINE:
+                self._logger.info(f"The device is {online_status}.")
+                return NO_VALUE
+
+            if not await self._update_device(device):
+                return NO_VALUE
+            return device
 
         self._controlled_device_cache[dev_uuid] = AsyncCachedObject(
             enabled=(lambda: self.is_authenticated),
             get_key=_get_device_cache_key,
             get_object=_find_device,
+            name="controlled_device",
         )
         return await self._controlled_device_cache[dev_uuid](default=None)
 
+    async def _update_device(self, device) -> bool:
+        """Query the device for its current state, `False` if it did not answer."""
+        dev_uuid = device.uuid
+        self.mqtt_commands_total.inc(command="update")
+        sent_at = time.monotonic()
+        try:
+            with self.cloud_call_duration.time(call="device_update"), tracing.span(
+                "async_update", device=dev_uuid
+            ):
+                await device.async_update()
+        except CommandTimeoutError:
+            self._logger.error(
+                f"Timeout getting device update for {dev_uuid!r}. Marking it offline."
+            )
+            self.device_registry.set_online_status(dev_uuid, OnlineStatus.OFFLINE)
+            return False
+        self._device_updated_at[dev_uuid] = sent_at
+        return True
+
+    def _updated_since(self, dev_uuid: str, since: float) -> bool:
+        """True if an `async_update()` of the device was sent at `since` or later."""
+        updated_at = self._device_updated_at.get(dev_uuid)
+        return updated_at is not None and updated_at >= since
+
+    async def _poll_device(self, dev_uuid: str, deadline: Deadline = None):
+        """Look the device up and query its current state.
+
+        Returns the device (`None` if it is not available or did not answer).
+        A lookup that loaded the device has just updated it, concurrent polls
+        of a device share a single `async_update()`.
+        """
+        started_at = time.monotonic()
+        device = await self._lookup_device(dev_uuid, deadline)
+        if not device:
+            return None
+        if self._updated_since(dev_uuid, started_at):
+            return device
+        poll = self._device_polls.get(dev_uuid)
+        if poll is None:
+            poll = self._device_polls[dev_uuid] = asyncio.ensure_future(
+                self._update_device(device)
+            )
+            poll.add_done_callback(
+                lambda future: self._on_device_polled(dev_uuid, future)
+            )
+        try:
+            if deadline is None:
+                updated = await asyncio.shield(poll)
+            else:
+                updated = await deadline.wait_for(asyncio.shield(poll))
+        except DeadlineExceededError:
+            self._logger.error(f"Device {dev_uuid!r} update ran out of time.")
+            return None
+        return device if updated else None
+
+    def _on_device_polled(self, dev_uuid: str, future: asyncio.Future):
+        if self._device_polls.get(dev_uuid) is future:
+            del self._device_polls[dev_uuid]
+        if not future.cancelled() and future.exception() is not None:
+            self._logger.error(
+                f"Unable to update the device {dev_uuid!r}: {future.exception()!r}"
+            )
+
+    async def _poll_stale_devices(
+        self, dev_ids: Sequence[str], max_age: float, deadline: Deadline = None
+    ):
+        """Query the devices of the channels that are missing or older than `max_age`.
+
+        Every device is queried once, however many of its channels are
+        requested. Only the channels of the devices that answered are
+        recorded (as `StateSource.POLL`).
+        """
+        channels = {}  # {dev_uuid: {channel: dev_id}}
+        for dev_id in dev_ids:
+            dev_uuid, channel = self.parse_plugin_dev_id(dev_id)
+            channels.setdefault(dev_uuid, {})[channel] = dev_id
+        stale_uuids = [
+            dev_uuid
+            for (dev_uuid, dev_channels) in channels.items()
+            if self.state_table.get_fresh(dev_channels.values(), max_age) is None
+        ]
+        if not stale_uuids or not self.is_authenticated:
+            return
+        with tracing.span("poll_devices", devices=len(stale_uuids)):
+            devices = await asyncio.gather(
+                *[self._poll_device(dev_uuid, deadline) for dev_uuid in stale_uuids]
+            )
+        self._update_state_from_device(
+            [
+                (device, channel)
+                for device in devices
+                if device
+                for channel in channels[device.uuid]
+            ],
+            StateSource.POLL,
+        )
+
     def parse_plugin_dev_id(self, dev_id: str):
         """Convert this plugins' device IDs (<meross uuid>::<channel idx>) to a tuple."""
-        (uuid, channel_id) = dev_id.split("::")
+        uuid, channel_id = dev_id.split("::")
         return (uuid, int(channel_id))
 
-    async def get_device_handles(self, dev_ids: Sequence[str]):
+    async def warm_up(self, login: Future, dev_ids: Sequence[str]) -> bool:
+        """Load everything the first command is going to need.
+
+        Waits for the `login` future and then runs the manager initialisation,
+        device discovery and the target device lookup (those are shared with
+        any command that arrives in the meantime).
+        """
+        timings = self.warm_up_timings = {}
+        self.warm_up_failed_phase = None
+
+        async def _timed(phase: str, awaitable: Awaitable):
+            start = time.monotonic()
+            try:
+                return await awaitable
+            except BaseException:
+                self.warm_up_failed_phase = phase
+                raise
+            finally:
+                timings[phase] = time.monotonic() - start
+
+        if not await _timed("login", asyncio.wrap_future(login)):
+            self._logger.info("Warm-up skipped: not logged in.")
+            return False
+        await _timed("manager", self.get_manager())
+        await _timed("discovery", self.async_device_discovery())
+        prefetch_start = time.monotonic()
+        dev_handles = await _timed("prefetch", self.get_device_handles(dev_ids))
+        # The devices loaded by the prefetch have just been queried
+        self._update_state_from_device(
+            [
+                (device, channel)
+                for (device, channel) in dev_handles
+                if self._updated_since(device.uuid, prefetch_start)
+            ],
+            StateSource.POLL,
+        )
+        self.is_warmed_up = self.is_authenticated
+        self._logger.info(
+            "Warm-up finished: "
+            + ", ".join(
+                f"{phase} {duration:.3f}s" for (phase, duration) in timings.items()
+            )
+        )
+        return self.is_warmed_up
+
+    def get_breaker(self, dev_uuid: str) -> CircuitBreaker:
+        try:
+            return self.circuit_breakers[dev_uuid]
+        except KeyError:
+            return self.circuit_breakers.setdefault(dev_uuid, CircuitBreaker())
+
+    async def _lookup_device(self, dev_uuid: str, deadline: Deadline = None):
+        """`get_controlled_device()` bounded by the deadline and the device's circuit breaker."""
+        if self.get_breaker(dev_uuid).state == "open":
+            self._logger.warning(f"Skipping {dev_uuid!r}: it keeps failing.")
+            return None
+        if deadline is None:
+            return await self.get_controlled_device(dev_uuid)
+        try:
+            return await deadline.wait_for(self.get_controlled_device(dev_uuid))
+        except DeadlineExceededError:
+            self._logger.error(f"Device {dev_uuid!r} lookup ran out of time.")
+            return None
+
+    async def get_device_handles(
+        self, dev_ids: Sequence[str], deadline: Deadline = None
+    ):
         """Returns list of (dev_handle, channel)"""
         if not self.is_authenticated:
             self._logger.warning("get_device_handles:: not authenticated")
             return []
 
         uuid_channel_pairs = [self.parse_plugin_dev_id(dev_id) for dev_id in dev_ids]
-        devices = await asyncio.gather(
-            *[
-                self.get_controlled_device(dev_uuid)
-                for (dev_uuid, _) in uuid_channel_pairs
-            ]
-        )
+        with tracing.span("get_device_handles", devices=len(uuid_channel_pairs)):
+            devices = await asyncio.gather(
+                *[
+                    self._lookup_device(dev_uuid, deadline)
+                    for (dev_uuid, _) in uuid_channel_pairs
+                ]
+            )
         out = []
         for device_hanle, (dev_uuid, dev_channel) in zip(devices, uuid_channel_pairs):
             if not device_hanle:
@@ -244,113 +1030,637 @@ class _OctoprintPsuMerossClientAsync:
             out.append((device_hanle, dev_channel))
         return out
 
-    async def set_devices_states(self, dev_ids: Sequence[str], state: bool):
+    async def _run_device_calls(
+        self,
+        dev_ids: Sequence[str],
+        fn: Callable[[str], Awaitable],
+        deadline: Deadline,
+        **kwargs,
+    ) -> CommandResult:
+        """Run `fn(dev_id)` for every device (with retries, within the deadline)."""
+        if deadline is None:
+            deadline = Deadline()
+        results = await asyncio.gather(
+            *[
+                run_device_call(
+                    dev_id,
+                    functools.partial(fn, dev_id),
+                    deadline,
+                    self.get_breaker(self.parse_plugin_dev_id(dev_id)[0]),
+                    **kwargs,
+                )
+                for dev_id in dev_ids
+            ]
+        )
+        out = CommandResult(devices=tuple(results))
+        for el in out.failed:
+            self._logger.error(
+                f"{el.dev_id!r} failed after {el.attempts} attempt(s): {el.error}"
+            )
+        return out
+
+    @_measured_command("set_devices_states")
+    async def set_devices_states(
+        self, dev_ids: Sequence[str], state: bool, deadline: Deadline = None
+    ) -> CommandResult:
         self._logger.debug(f"Attempting to change state of {dev_ids!r}.")
         assert self.is_authenticated, "Must be authenticated"
-        dev_handles = await self.get_device_handles(dev_ids)
-        futures = []
-        for device, channel in dev_handles:
+        out = await self._run_device_calls(
+            dev_ids,
+            lambda dev_id: self.command_queue.submit(dev_id, state),
+            deadline,
+        )
+        self._schedule_inventory_save()
+        self._logger.debug(f"Changed state of {dev_ids!r}: {out.asdict()!r}.")
+        return out
+
+    def _channel_state_matches(self, dev_id: str, state: bool) -> bool:
+        """True if the channel is known to be in `state` already.
+
+        States restored from the previous run do not count (the device
+        could have been switched since).
+        """
+        known = self.state_table.get(dev_id)
+        return (
+            known is not None
+            and known.source is not StateSource.SNAPSHOT
+            and known.age <= DEFAULT_STATE_MAX_AGE
+            and known.is_on == state
+        )
+
+    async def _get_device_handle(self, dev_id: str):
+        """(device, channel) of the `dev_id`, raises if the device is not available."""
+        dev_uuid, channel = self.parse_plugin_dev_id(dev_id)
+        device = await self.get_controlled_device(dev_uuid)
+        if not device:
+            raise MerossClientError(f"Device {dev_uuid!r} is not available.")
+        return (device, channel)
+
+    async def _run_channel_command(self, dev_id: str, state: Union[bool, str]):
+        """Send a single on/off or toggle command (executed by the `command_queue`)."""
+        if state == TOGGLE:
+            await self._toggle_channel(dev_id)
+        else:
+            await self._set_channel_state(dev_id, state)
+
+    async def _set_channel_state(self, dev_id: str, state: bool):
+        device, channel = await self._get_device_handle(dev_id)
+        self.mqtt_commands_total.inc(command="turn_on" if state else "turn_off")
+        with tracing.span("mqtt_ack", device=device.uuid):
             if state:
-                the_future = device.async_turn_on(channel=channel)
+                await device.async_turn_on(channel=channel)
             else:
-                the_future = device.async_turn_off(channel=channel)
-            futures.append(the_future)
-        await asyncio.gather(*futures)
-        self._logger.debug(f"Sucessfully changed state of {dev_ids!r}.")
-        return True
+                await device.async_turn_off(channel=channel)
+        self.state_table.update(device.uuid, channel, state, StateSource.COMMAND)
+
+    @_measured_command("is_on")
+    async def is_on(
+        self,
+        dev_ids: Sequence[str],
+        deadline: Deadline = None,
+        max_age: float = DEFAULT_STATE_MAX_AGE,
+    ) -> bool:
+        """True if all available channels are on.
 
-    async def is_on(self, dev_ids: Sequence[str]) -> bool:
+        The devices of the missing or stale channels are queried, channels
+        that are still stale after that (unavailable devices) are ignored.
+        """
         assert self.is_authenticated, "Must be authenticated"
-        dev_handles = await self.get_device_handles(dev_ids)
-        on_states = [device.is_on(channel=channel) for (device, channel) in dev_handles]
+        fresh_since = time.monotonic() - max_age
+        await self._poll_stale_devices(dev_ids, max_age, deadline)
+        on_states = [
+            state.is_on
+            for state in self.state_table.get_many(dev_ids)
+            if state is not None and state.updated_at >= fresh_since
+        ]
+        # Refresh the group's fallback state (for when its channels get invalidated)
+        self.state_table.group_state(dev_ids)
         if on_states:
             out = all(on_states)
         else:
             out = False
-        # save a copy of result for async polling
-        self.is_on_cache = out
         return out
 
-    async def toggle_devices(self, dev_ids: Sequence[str]) -> bool:
+    @_measured_command("get_states")
+    async def get_states(
+        self,
+        dev_ids: Sequence[str],
+        max_age: float = DEFAULT_STATE_MAX_AGE,
+        deadline: Deadline = None,
+    ) -> Dict[str, dict]:
+        """Describe the channels, querying the devices of the missing or stale ones.
+
+        Every device is queried (`async_update()`) once, however many
+        of its channels are requested.
+        """
+        await self._poll_stale_devices(dev_ids, max_age, deadline)
+        return self._describe_channels(dev_ids)
+
+    def _describe_channels(self, dev_ids: Sequence[str]) -> Dict[str, dict]:
+        """`get_states()` of the `dev_ids`, from the state table alone."""
+        return {
+            dev_id: self._describe_channel(dev_id, state)
+            for (dev_id, state) in zip(dev_ids, self.state_table.get_many(dev_ids))
+        }
+
+    def _describe_channel(self, dev_id: str, state: Optional[ChannelState]) -> dict:
+        dev_uuid, _ = self.parse_plugin_dev_id(dev_id)
+        online_status = self.device_registry.online_status(dev_uuid)
+        return {
+            "state": None if state is None else ("on" if state.is_on else "off"),
+            "online": (
+                None if online_status is None else online_status is OnlineStatus.ONLINE
+            ),
+            "age": None if state is None else state.age,
+            "source": None if state is None else state.source.value,
+        }
+
+    @_measured_command("toggle_devices")
+    async def toggle_devices(
+        self, dev_ids: Sequence[str], deadline: Deadline = None
+    ) -> CommandResult:
         self._logger.debug(f"Attempting to toggle devices {dev_ids!r}.")
         assert self.is_authenticated, "Must be authenticated"
-        dev_handles = await self.get_device_handles(dev_ids)
-        await asyncio.gather(
-            *[device.async_toggle(channel=channel) for (device, channel) in dev_handles]
+        # Not retried: a toggle that timed out may still have been executed
+        out = await self._run_device_calls(
+            dev_ids,
+            lambda dev_id: self.command_queue.submit(dev_id, TOGGLE),
+            deadline,
+            max_attempts=1,
         )
-        self._logger.debug(f"Sucessfully toggled devices {dev_ids!r}.")
-        return True
+        self._schedule_inventory_save()
+        self._logger.debug(f"Toggled devices {dev_ids!r}: {out.asdict()!r}.")
+        return out
+
+    async def _toggle_channel(self, dev_id: str):
+        device, channel = await self._get_device_handle(dev_id)
+        self.mqtt_commands_total.inc(command="toggle")
+        with tracing.span("mqtt_ack", device=device.uuid):
+            await device.async_toggle(channel=channel)
+        self._update_state_from_device([(device, channel)], StateSource.COMMAND)
 
 
 class OctoprintPsuMerossClient:
-    def __init__(self, cache_file: Path, logger):
+    def __init__(
+        self,
+        cache_file: Path,
+        logger,
+        legacy_cache_file: Path = None,
+        manager_kwargs: dict = None,
+        lan_control: bool = True,
+        on_state_push: Callable[[dict], None] = None,
+        broker_socket: Path = None,
+        loop_debug: bool = False,
+        event_loop: str = EVENT_LOOP_AUTO,
+        executor_workers: int = DEFAULT_EXECUTOR_WORKERS,
+    ):
+        """`on_state_push` is called (on the worker thread) with the batched state changes.
+
+        With a `broker_socket`, the calls are forwarded to the session broker
+        listening on it (if there is one). Should the broker become unreachable
+        later on, the client falls back to running in-process. `loop_debug` runs the worker loop
+        in the asyncio debug mode (logs the slow callbacks), `event_loop`
+        picks its implementation ("auto", "asyncio" or "uvloop").
+        """
         super().__init__()
         self._logger = logger
-        self.worker = ThreadedWorker()
+        self.worker = ThreadedWorker(
+            logger=self._logger.getChild("worker"),
+            debug=loop_debug,
+            event_loop=event_loop,
+            executor_workers=executor_workers,
+        )
+        self._in_process_kwargs = dict(
+            cache_file=cache_file,
+            logger=self._logger.getChild("async_client"),
+            legacy_cache_file=legacy_cache_file,
+            manager_kwargs=manager_kwargs,
+            lan_control=lan_control,
+            on_state_push=on_state_push,
+        )
+        self._broker_kwargs = dict(
+            socket_path=broker_socket,
+            logger=self._logger.getChild("broker_client"),
+            on_state_push=on_state_push,
+            on_unreachable=self._fall_back_to_in_process,
+            lan_control=lan_control,
+        )
+        if broker_socket and broker.broker_available(broker_socket):
+            self._logger.info(f"Using the session broker on {broker_socket}.")
+            self._async_client = broker.BrokerAsyncClient(**self._broker_kwargs)
+        else:
+            if broker_socket:
+                self._logger.warning(
+                    f"No session broker on {broker_socket}, running in-process."
+                )
+            self._async_client = _OctoprintPsuMerossClientAsync(
+                **self._in_process_kwargs
+            )
+        # In-flight `is_on` state refreshes (keyed by the frozenset of device IDs)
+        self._state_refreshes_lock = threading.Lock()
+        self._state_refreshes: Dict[FrozenSet[str], Future] = {}
+        # Credentials of the current session (set once the login succeeds)
+        #  and of the most recently requested login
+        self._login_lock = threading.Lock()
+        self._session_credentials = None
+        self._login_credentials = None
+        self._login_future: Future = None
+        self._warm_up_key = None
+        self._warm_up_future: Future = None
+        self.tracer = tracing.Tracer(logger=self._logger.getChild("tracing"))
+        self._init_worker_metrics()
+
+    def _init_worker_metrics(self):
+        metrics = self.metrics
+        worker = self.worker
+        metrics.callback_gauge(
+            "worker_loop_lag_seconds",
+            "How late the worker loop runs its callbacks.",
+            [],
+            lambda: {(): worker.current_lag},
+        )
+        metrics.callback_gauge(
+            "worker_loop_max_lag_seconds",
+            "Max worker loop lag since the start.",
+            [],
+            lambda: {(): worker.max_lag},
+        )
+        metrics.callback_counter(
+            "worker_loop_stalls_total",
+            "Worker loop heartbeats delayed by a blocking call.",
+            [],
+            lambda: {(): worker.stalls},
+        )
+        metrics.callback_counter(
+            "worker_loop_exceptions_total",
+            "Unhandled exceptions on the worker loop.",
+            [],
+            lambda: {(): worker.loop_exceptions},
+        )
+        metrics.callback_gauge(
+            "worker_pending_tasks",
+            "Tasks scheduled on the worker loop.",
+            [],
+            lambda: {(): worker.pending_tasks()},
+        )
+        metrics.callback_counter(
+            "worker_restarts_total",
+            "Worker loop restarts.",
+            [],
+            lambda: {(): worker.restarts},
+        )
+
+    def _fall_back_to_in_process(self):
+        """Replace the unreachable session broker by an in-process client.
+
+        Called on the worker loop. The in-process client logs in (and warms up)
+        with the credentials of the last warm-up.
+        """
+        if not self.broker_mode:
+            return
+        self._logger.warning("The session broker is unreachable, running in-process.")
+        broker_client = self._async_client
         self._async_client = _OctoprintPsuMerossClientAsync(
-            cache_file=cache_file, logger=self._logger.getChild("async_client")
+            **dict(
+                self._in_process_kwargs, lan_control=broker_client.transport.lan_enabled
+            )
         )
+        self._init_worker_metrics()
+        with self._login_lock:
+            self._session_credentials = self._login_credentials = None
+        asyncio.ensure_future(broker_client.close())
+        if self._warm_up_key is not None:
+            api_base_url, user, password, dev_ids = self._warm_up_key
+            self.warm_up(api_base_url, user, password, dev_ids)
+
+    def worker_stats(self) -> dict:
+        """Health of the worker loop (lag, stalls, pending tasks)."""
+        return self.worker.stats()
+
+    def close(self, timeout: float = STOP_TIMEOUT) -> bool:
+        """Disconnect and stop the worker loop (`False` if it did not stop in time).
+
+        The session is kept for the next start (see `restart()`).
+        """
+        with self._login_lock:
+            # The next `login()` restores the session on the new loop
+            self._session_credentials = self._login_credentials = None
+        # Disconnects once the in-flight calls are cancelled
+        return self.worker.stop(timeout, on_stop=self._async_client.close)
+
+    def restart(self, timeout: float = STOP_TIMEOUT) -> bool:
+        """Restart the worker loop, replacing a blocked one."""
+        self._logger.info("Restarting the worker loop.")
+        stopped = self.close(timeout)
+        if not stopped:
+            self._replace_async_client()
+        self.worker.start()
+        return stopped
+
+    def _replace_async_client(self):
+        """Swap in a fresh async client once a blocked worker loop is abandoned.
+
+        The old client never got to `close()`: its session, in-flight futures
+        and locks belong to the abandoned loop and would not work on the new one.
+        """
+        lan_control = self._async_client.transport.lan_enabled
+        if self.broker_mode:
+            self._async_client = broker.BrokerAsyncClient(
+                **dict(self._broker_kwargs, lan_control=lan_control)
+            )
+        else:
+            self._async_client = _OctoprintPsuMerossClientAsync(
+                **dict(self._in_process_kwargs, lan_control=lan_control)
+            )
+        self._init_worker_metrics()
+        with self._state_refreshes_lock:
+            self._state_refreshes.clear()
+        # Never completes, the next `warm_up()` starts over
+        self._warm_up_future = None
+
+    @staticmethod
+    def _done_future(result) -> Future:
+        out = Future()
+        out.set_result(result)
+        return out
 
     def login(
         self, api_base_url: str, user: str, password: str, raise_exc: bool = False
     ) -> Future:
         """Login to the meross cloud.
 
-        Returns `None` in async mode, or True/False (success state) in sync mode.
+        Returns a future resolving to the login success state.
+        The already-authenticated case is resolved synchronously
+        (without a hop to the worker thread).
         """
         if (not user) or (not password):
             self._logger.info("No user/password configured, skipping login")
-            return False
+            return self._done_future(False)
 
         if not isinstance(api_base_url, list):
             api_base_url = [api_base_url]
-            
-        return asyncio.run_coroutine_threadsafe(
-            self._async_client.login(api_base_url, user, password, raise_exc),
+
+        credentials = (tuple(api_base_url), user, password)
+        with self._login_lock:
+            if self.is_authenticated and credentials == self._session_credentials:
+                return self._done_future(True)
+            if (
+                not raise_exc
+                and credentials == self._login_credentials
+                and not self._login_future.done()
+            ):
+                # The very same login is already in flight
+                return self._login_future
+            self._session_credentials = None
+            self._login_credentials = credentials
+            future = self._login_future = tracing.run_coroutine_threadsafe(
+                self._async_client.login(api_base_url, user, password, raise_exc),
+                self.worker.loop,
+            )
+        # Outside of the lock as the callback is invoked right away if the login is already done
+        future.add_done_callback(
+            lambda future: self._on_login_done(credentials, future)
+        )
+        return future
+
+    def _on_login_done(self, credentials: tuple, future: Future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        with self._login_lock:
+            if future.result() and credentials == self._login_credentials:
+                self._session_credentials = credentials
+
+    def warm_up(
+        self, api_base_url: str, user: str, password: str, dev_ids: Sequence[str]
+    ) -> Future:
+        """Log in and pre-load the devices in the background.
+
+        Calling this again while the same warm-up is running returns the running one.
+        """
+        key = (api_base_url, user, password, tuple(dev_ids or ()))
+        if (
+            key == self._warm_up_key
+            and self._warm_up_future is not None
+            and not self._warm_up_future.done()
+        ):
+            return self._warm_up_future
+        login_future = self.login(api_base_url, user, password)
+        self._warm_up_key = key
+        self._warm_up_future = tracing.run_coroutine_threadsafe(
+            self._async_client.warm_up(login_future, dev_ids or ()), self.worker.loop
+        )
+        self._warm_up_future.add_done_callback(self._on_warm_up_done)
+        return self._warm_up_future
+
+    def _on_warm_up_done(self, future: Future):
+        # Nobody waits for the warm-up, its failures would go unnoticed otherwise
+        if future.cancelled() or future.exception() is None:
+            return
+        self._logger.error(
+            f"Warm-up failed in the {self.warm_up_failed_phase or 'unknown'} phase.",
+            exc_info=future.exception(),
+        )
+
+    @property
+    def broker_mode(self) -> bool:
+        """True if the calls go to the session broker (rather than an in-process client)."""
+        return isinstance(self._async_client, broker.BrokerAsyncClient)
+
+    @property
+    def metrics(self) -> MetricsRegistry:
+        return self._async_client.metrics
+
+    @property
+    def lan_control(self) -> bool:
+        """Send the device commands over the local network first (the cloud is the fallback)."""
+        return self._async_client.transport.lan_enabled
+
+    @lan_control.setter
+    def lan_control(self, value: bool):
+        self._async_client.transport.lan_enabled = bool(value)
+
+    def transport_stats(self) -> Dict[str, dict]:
+        """Per-device command latency/failures of the LAN and the cloud paths."""
+        return self._async_client.transport.asdict()
+
+    @property
+    def warm_up_timings(self) -> Dict[str, float]:
+        return dict(self._async_client.warm_up_timings or {})
+
+    @property
+    def warm_up_failed_phase(self) -> Optional[str]:
+        """Warm-up phase ("login", "manager", "discovery" or "prefetch") that last failed."""
+        return self._async_client.warm_up_failed_phase
+
+    def list_devices(self, asdict: bool = False, timeout: float = DEFAULT_CALL_BUDGET):
+        """Blocks for at most `timeout` seconds (raises `DeadlineExceededError` then)."""
+        if not self.is_authenticated:
+            raise MerossClientError("Not authenticated")
+        deadline = Deadline.coerce(timeout)
+        future = tracing.run_coroutine_threadsafe(
+            self._async_client.list_devices(asdict=asdict, deadline=deadline),
             self.worker.loop,
         )
+        return deadline.result(future)
 
-    def list_devices(self):
+    def device_index(self, timeout: float = DEFAULT_CALL_BUDGET) -> DeviceIndex:
+        """Same as `list_devices()`, but returns the whole `DeviceIndex`."""
         if not self.is_authenticated:
             raise MerossClientError("Not authenticated")
-        future = asyncio.run_coroutine_threadsafe(
-            self._async_client.list_devices(), self.worker.loop
+        deadline = Deadline.coerce(timeout)
+        future = tracing.run_coroutine_threadsafe(
+            self._async_client.device_index(deadline=deadline),
+            self.worker.loop,
         )
-        return future.result()
+        return deadline.result(future)
 
-    def set_devices_states(self, dev_ids: Sequence[str], state: bool) -> Future:
+    def set_devices_states(
+        self, dev_ids: Sequence[str], state: bool, timeout: float = DEFAULT_CALL_BUDGET
+    ) -> Future:
+        """Returns a future resolving to a `CommandResult` within `timeout` seconds.
+
+        Devices that did not make it in time are reported as failed.
+        """
         if (not dev_ids) or (not self.is_authenticated):
             self._logger.info(
                 f"Unable change device state for {dev_ids!r} (auth state: {self.is_authenticated})"
             )
             return
 
-        return asyncio.run_coroutine_threadsafe(
-            self._async_client.set_devices_states(dev_ids, state), self.worker.loop
+        return tracing.run_coroutine_threadsafe(
+            self._async_client.set_devices_states(
+                dev_ids, state, deadline=Deadline.coerce(timeout)
+            ),
+            self.worker.loop,
         )
 
-    def toggle_device(self, dev_ids: Sequence[str]) -> Future:
+    def toggle_device(
+        self, dev_ids: Sequence[str], timeout: float = DEFAULT_CALL_BUDGET
+    ) -> Future:
+        """Same as `set_devices_states()`, but toggles the devices (without retries)."""
         self._logger.debug(f"toggle_device {dev_ids!r}.")
         if (not dev_ids) or (not self.is_authenticated):
             self._logger.info(f"Unable change device state for {dev_ids!r}")
             return
 
-        return asyncio.run_coroutine_threadsafe(
-            self._async_client.toggle_devices(dev_ids), self.worker.loop
+        return tracing.run_coroutine_threadsafe(
+            self._async_client.toggle_devices(
+                dev_ids, deadline=Deadline.coerce(timeout)
+            ),
+            self.worker.loop,
         )
 
-    def is_on(self, dev_ids: Sequence[str], sync: bool = False):
+    def is_on(
+        self,
+        dev_ids: Sequence[str],
+        sync: bool = False,
+        max_age: float = DEFAULT_STATE_MAX_AGE,
+        timeout: float = DEFAULT_CALL_BUDGET,
+    ):
+        """Return True if all devices are on.
+
+        In async mode, the answer comes from the push-fed state table and
+        the devices are only queried if any of their entries is missing or
+        older than `max_age` seconds.
+        Device queries are bounded by `timeout` seconds (the sync mode raises
+        `DeadlineExceededError` if they take longer).
+        """
         self._logger.debug(f"Attempting to check if devices is on {dev_ids!r}.")
         if (not dev_ids) or (not self.is_authenticated):
             return False
 
-        future = asyncio.run_coroutine_threadsafe(
-            self._async_client.is_on(dev_ids), self.worker.loop
+        state_table = self._async_client.state_table
+        group = state_table.group_state(dev_ids)
+        if not sync and group is not None and group.age <= max_age:
+            return group.is_on
+
+        deadline = Deadline.coerce(timeout)
+        # The result of a wider in-flight query would not be the answer for this group
+        future = self._refresh_state(
+            dev_ids, deadline, max_age=max_age, reuse_wider=not sync
         )
         if sync:
-            return future.result()
-        else:
-            return self._async_client.is_on_cache
+            return deadline.result(future)
+
+        # Stale, but still the best guess we have
+        if group is None:
+            group = state_table.last_group_state(dev_ids)
+        return group is not None and group.is_on
+
+    def channel_states(
+        self,
+        dev_ids: Sequence[str],
+        max_age: float = DEFAULT_STATE_MAX_AGE,
+    ) -> Dict[str, Optional[bool]]:
+        """Return {dev_id: is_on (`None` if unknown)} from the state table.
+
+        Missing or stale channels are refreshed in the background with
+        a single device query for all of them.
+        """
+        if (not dev_ids) or (not self.is_authenticated):
+            return {dev_id: None for dev_id in dev_ids}
+        states = self._async_client.state_table.get_many(dev_ids)
+        stale = [
+            dev_id
+            for (dev_id, state) in zip(dev_ids, states)
+            if state is None or state.age > max_age
+        ]
+        if stale:
+            self._refresh_state(stale, Deadline(), max_age=max_age, reuse_wider=True)
+        return {
+            dev_id: None if state is None else state.is_on
+            for (dev_id, state) in zip(dev_ids, states)
+        }
+
+    def get_states(
+        self,
+        dev_ids: Sequence[str],
+        max_age: float = DEFAULT_STATE_MAX_AGE,
+        timeout: float = DEFAULT_CALL_BUDGET,
+    ) -> Dict[str, dict]:
+        """Return {dev_id: {"state": "on"|"off", "online": .., "age": .., "source": ..}}.
+
+        Fresh channel states come from the state table, the devices of
+        the others are queried (a single worker loop call for all of them).
+        Unknown values are `None`.
+        """
+        if not dev_ids:
+            return {}
+        deadline = Deadline.coerce(timeout)
+        return deadline.result(
+            tracing.run_coroutine_threadsafe(
+                self._async_client.get_states(
+                    dev_ids, max_age=max_age, deadline=deadline
+                ),
+                self.worker.loop,
+            )
+        )
+
+    def _refresh_state(
+        self,
+        dev_ids: Sequence[str],
+        deadline: Deadline,
+        max_age: float = DEFAULT_STATE_MAX_AGE,
+        reuse_wider: bool = False,
+    ) -> Future:
+        """Schedule an `is_on` query of the stale devices (unless one is already in flight).
+
+        With `reuse_wider`, an in-flight query of a superset of `dev_ids`
+        counts too (for the callers that only need the state table refreshed).
+        """
+        key = frozenset(dev_ids)
+        with self._state_refreshes_lock:
+            for in_flight_key, future in tuple(self._state_refreshes.items()):
+                if future.done():
+                    del self._state_refreshes[in_flight_key]
+                elif key == in_flight_key or (reuse_wider and key < in_flight_key):
+                    return future
+            future = tracing.run_coroutine_threadsafe(
+                self._async_client.is_on(dev_ids, deadline=deadline, max_age=max_age),
+                self.worker.loop,
+            )
+            self._state_refreshes[key] = future
+        return future
 
     @property
     def is_authenticated(self) -> bool:
@@ -361,4 +1671,4 @@ class OctoprintPsuMerossClient:
         """Return True/False signifying if the API is ready to be invoked to turn stuff on or off."""
         if not self.is_authenticated:
             return False
-        return False
+        return self._async_client.is_warmed_up
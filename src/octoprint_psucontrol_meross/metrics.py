@@ -0,0 +1,267 @@
+"""Low-overhead in-process metrics (counters and histograms).
+
+Rendered in the Prometheus text exposition format or as a JSON snapshot.
+"""
+
+import bisect
+import contextlib
+import math
+import threading
+import time
+
+from typing import Callable, Dict, Sequence, Tuple
+
+# Default latency histogram buckets (in seconds)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (key, str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n"))
+        for (key, value) in labels.items()
+    )
+    return "{" + ",".join(f'{key}="{value}"' for (key, value) in escaped) + "}"
+
+
+class _Metric:
+    kind: str = None
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _label_values(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels_dict(self, values: LabelValues) -> Dict[str, str]:
+        return dict(zip(self.labelnames, values))
+
+    def samples(self) -> Dict[LabelValues, object]:
+        raise NotImplementedError
+
+    def render(self) -> Sequence[str]:
+        """Prometheus text format lines."""
+        raise NotImplementedError
+
+    def snapshot(self) -> dict:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """Monotonically increasing value (per label set)."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._label_values(labels), 0)
+
+    def samples(self) -> Dict[LabelValues, float]:
+        with self._lock:
+            return dict(self._values)
+
+    def render(self):
+        return [
+            f"{self.name}{_format_labels(self._labels_dict(key))} {_format_value(value)}"
+            for (key, value) in sorted(self.samples().items())
+        ]
+
+    def snapshot(self):
+        return [
+            {"labels": self._labels_dict(key), "value": value}
+            for (key, value) in sorted(self.samples().items())
+        ]
+
+
+class CallbackCounter(Counter):
+    """Counter whose values are read from `fn()` ({label values: value}) on collection.
+
+    For counts that are already kept elsewhere (e.g. on the cache objects).
+    """
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str],
+        fn: Callable[[], Dict[LabelValues, float]],
+    ):
+        super().__init__(name, help, labelnames)
+        self.fn = fn
+
+    def inc(self, amount: float = 1, **labels):
+        raise TypeError(f"{self.name} is read-only")
+
+    def get(self, **labels) -> float:
+        return self.samples().get(self._label_values(labels), 0)
+
+    def samples(self):
+        return dict(self.fn())
+
+
+class CallbackGauge(CallbackCounter):
+    """Value that can go up and down, read from `fn()` on collection."""
+
+    kind = "gauge"
+
+
+class Histogram(_Metric):
+    """Distribution of observed values (cumulative buckets, sum and count per label set)."""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per-bucket counts (non-cumulative, last one is +Inf), sum]
+        self._values: Dict[LabelValues, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._label_values(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][idx] += 1
+            entry[1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observe the duration (in seconds) of the `with` block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> Dict[LabelValues, dict]:
+        """{label values: {"buckets": ((upper bound, cumulative count), ...), "sum": .., "count": ..}}"""
+        with self._lock:
+            values = {
+                key: (tuple(counts), total)
+                for (key, (counts, total)) in self._values.items()
+            }
+        out = {}
+        for key, (counts, total) in values.items():
+            cumulative = 0
+            buckets = []
+            for upper_bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                buckets.append((upper_bound, cumulative))
+            out[key] = {"buckets": tuple(buckets), "sum": total, "count": cumulative}
+        return out
+
+    def render(self):
+        out = []
+        for key, sample in sorted(self.samples().items()):
+            labels = self._labels_dict(key)
+            for upper_bound, count in sample["buckets"]:
+                bucket_labels = _format_labels(
+                    {**labels, "le": _format_value(upper_bound)}
+                )
+                out.append(f"{self.name}_bucket{bucket_labels} {count}")
+            out.append(
+                f"{self.name}_sum{_format_labels(labels)} {_format_value(sample['sum'])}"
+            )
+            out.append(f"{self.name}_count{_format_labels(labels)} {sample['count']}")
+        return out
+
+    def snapshot(self):
+        return [
+            {
+                "labels": self._labels_dict(key),
+                "count": sample["count"],
+                "sum": sample["sum"],
+                "buckets": [
+                    [_format_value(upper_bound), count]
+                    for (upper_bound, count) in sample["buckets"]
+                ],
+            }
+            for (key, sample) in sorted(self.samples().items())
+        ]
+
+
+class MetricsRegistry:
+    """A named collection of metrics.
+
+    Metrics are written to from the worker loop and read from the flask threads.
+    """
+
+    def __init__(self, prefix: str = ""):
+        self.prefix = prefix
+        self._metrics: Dict[str, _Metric] = {}
+
+    def _register(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Duplicate metric {metric.name!r}")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(self.prefix + name, help, labelnames))
+
+    def callback_counter(
+        self, name: str, help: str, labelnames: Sequence[str], fn: Callable
+    ) -> CallbackCounter:
+        return self._register(CallbackCounter(self.prefix + name, help, labelnames, fn))
+
+    def callback_gauge(
+        self, name: str, help: str, labelnames: Sequence[str], fn: Callable
+    ) -> CallbackGauge:
+        return self._register(CallbackGauge(self.prefix + name, help, labelnames, fn))
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self._register(Histogram(self.prefix + name, help, labelnames, buckets))
+
+    def render_prometheus(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        return {
+            metric.name: {
+                "type": metric.kind,
+                "help": metric.help,
+                "samples": metric.snapshot(),
+            }
+            for metric in self._metrics.values()
+        }
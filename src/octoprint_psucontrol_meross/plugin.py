@@ -1,30 +1,83 @@
+import hashlib
+import json
+
 from pathlib import Path
 
 import flask
 import octoprint.plugin
 
-from . import meross_client
+from . import meross_client, region, tracing
+from .exc import DeadlineExceededError
+from .resilience import Deadline
+from .threaded_worker import EVENT_LOOP_AUTO
+
+# Diagnostics and worker control, for the administrators only
+#  (the "states" dashboard snapshot is open to every API user, like the plain GET)
+ADMIN_API_RESOURCES = frozenset(("metrics", "traces", "transport", "worker"))
+ADMIN_API_COMMANDS = frozenset(("restart_worker",))
 
 
 class PSUControlMeross(
     octoprint.plugin.StartupPlugin,
+    octoprint.plugin.ShutdownPlugin,
     octoprint.plugin.TemplatePlugin,
     octoprint.plugin.SettingsPlugin,
     octoprint.plugin.SimpleApiPlugin,
     octoprint.plugin.AssetPlugin,
 ):
+    # (api_base_url, user_email, user_password) read from the settings
+    #  (refreshed by `on_settings_save()`)
+    _login_settings: tuple = None
+
     def initialize(self):
         super().initialize()
-        cache_file = Path(self.get_plugin_data_folder()) / "meross_cloud.cache"
+        data_folder = Path(self.get_plugin_data_folder())
         self.meross = meross_client.OctoprintPsuMerossClient(
-            cache_file=cache_file,
+            cache_file=data_folder / "meross_cloud.sqlite3",
+            # Legacy shelve cache file (migrated on startup)
+            legacy_cache_file=data_folder / "meross_cloud.cache",
             logger=self._logger.getChild("meross_client"),
+            lan_control=self._settings.get_boolean(["lan_control"]),
+            on_state_push=self._send_state_push,
+            broker_socket=self._settings.get(["broker_socket"]) or None,
+            loop_debug=self._settings.get_boolean(["loop_debug"]),
+            event_loop=self._settings.get(["event_loop"]) or EVENT_LOOP_AUTO,
         )
 
+    def _send_state_push(self, message: dict):
+        """Forward the batched device state changes to the settings view."""
+        self._plugin_manager.send_plugin_message(self._identifier, message)
+
     def on_settings_initialized(self):
         self._logger.info(f"{self.__class__.__name__} loaded.")
+        self._login_settings = self._read_login_settings()
         self._ensure_meross_login()
 
+    def _get_login_settings(self) -> tuple:
+        if self._login_settings is None:
+            self._login_settings = self._read_login_settings()
+        return self._login_settings
+
+    def _read_login_settings(self) -> tuple:
+        api_base_url, user, password = (
+            self._settings.get([key])
+            for key in ("api_base_url", "user_email", "user_password")
+        )
+        return (self._resolve_api_base_url(api_base_url), user, password)
+
+    def _resolve_api_base_url(self, api_base_url):
+        """The `api_base_url` with the automatic region replaced by the known regions."""
+        if region.AUTO_REGION in (
+            api_base_url if isinstance(api_base_url, list) else [api_base_url]
+        ):
+            # Let the client pick the fastest of the known regions
+            return [
+                el["url"]
+                for el in self._settings.get(["api_urls"])
+                if el["url"] != region.AUTO_REGION
+            ]
+        return api_base_url
+
     def _ensure_meross_login(
         self, api_base_url=None, user=None, password=None, raise_exc=False
     ):
@@ -32,13 +85,22 @@ class PSUControlMeross(
 
         (either provided or values from the settings).
         """
-        if not api_base_url:
-            api_base_url = self._settings.get(["api_base_url"])
+        (
+            settings_api_base_url,
+            settings_user,
+            settings_password,
+        ) = self._get_login_settings()
+        if api_base_url:
+            api_base_url = self._resolve_api_base_url(api_base_url)
+        else:
+            # Resolved once, when the settings were read
+            api_base_url = settings_api_base_url
         if not user:
-            user = self._settings.get(["user_email"])
+            user = settings_user
         if not password:
-            password = self._settings.get(["user_password"])
-        return self.meross.login(api_base_url, user, password, raise_exc=raise_exc)
+            password = settings_password
+        with tracing.span("ensure_login"):
+            return self.meross.login(api_base_url, user, password, raise_exc=raise_exc)
 
     def get_settings_defaults(self):
         return {
@@ -46,11 +108,20 @@ class PSUControlMeross(
                 {"name": "Asia-Pacific", "url": "iotx-ap.meross.com"},
                 {"name": "Europe", "url": "iotx-eu.meross.com"},
                 {"name": "US", "url": "iotx-us.meross.com"},
+                {"name": "Automatic (lowest latency)", "url": region.AUTO_REGION},
             ],
             "api_base_url": "iotx-eu.meross.com",
             "user_email": "",
             "user_password": "",
             "target_device_ids": [],
+            "state_max_age": meross_client.DEFAULT_STATE_MAX_AGE,
+            "lan_control": True,
+            # Unix socket of the shared session broker (empty: in-process client)
+            "broker_socket": "",
+            # asyncio debug mode of the worker loop (logs the slow callbacks)
+            "loop_debug": False,
+            # Worker event loop: "auto" (uvloop if installed), "asyncio" or "uvloop"
+            "event_loop": EVENT_LOOP_AUTO,
         }
 
     def get_settings_restricted_paths(self):
@@ -77,7 +148,14 @@ class PSUControlMeross(
 
     def on_settings_save(self, data):
         self._logger.debug(f"on_settings_save: {data!r}")
-        return super().on_settings_save(data)
+        out = super().on_settings_save(data)
+        self.meross.lan_control = self._settings.get_boolean(["lan_control"])
+        login_settings = self._read_login_settings()
+        if login_settings != self._login_settings:
+            # Credentials changed - log in (and warm up) in the background
+            self._login_settings = login_settings
+            self._start_warm_up()
+        return out
 
     def on_settings_migrate(self, target, current):
         for migrate_from, migrate_to in zip(
@@ -111,21 +189,41 @@ class PSUControlMeross(
 
         self._logger.debug("Registering plugin with PSUControl")
         psucontrol_helpers["register_plugin"](self)
+        self._start_warm_up()
+
+    def on_shutdown(self):
+        # Disconnect cleanly, the session is restored on the next start
+        if not self.meross.close():
+            self._logger.warning("The Meross worker loop did not stop in time.")
+
+    def _start_warm_up(self):
+        """Log in and load the target devices in the background."""
+        api_base_url, user, password = self._get_login_settings()
+        with self.meross.tracer.trace("warm_up"):
+            return self.meross.warm_up(
+                api_base_url, user, password, self.target_device_ids
+            )
 
     def turn_psu_on(self):
         self._logger.debug("turn_psu_on")
-        self._ensure_meross_login()
-        self.meross.set_devices_states(self.target_device_ids, True)
+        with self.meross.tracer.trace("turn_psu_on"):
+            self._ensure_meross_login()
+            self.meross.set_devices_states(self.target_device_ids, True)
 
     def turn_psu_off(self):
         self._logger.debug("turn_psu_off")
-        self._ensure_meross_login()
-        self.meross.set_devices_states(self.target_device_ids, False)
+        with self.meross.tracer.trace("turn_psu_off"):
+            self._ensure_meross_login()
+            self.meross.set_devices_states(self.target_device_ids, False)
 
     def get_psu_state(self):
         self._logger.debug("get_psu_state")
-        self._ensure_meross_login()
-        return self.meross.is_on(self.target_device_ids)
+        with self.meross.tracer.trace("get_psu_state"):
+            self._ensure_meross_login()
+            return self.meross.is_on(
+                self.target_device_ids,
+                max_age=self._settings.get_int(["state_max_age"]),
+            )
 
     # Setting the location of the assets such as javascript
     def get_assets(self):
@@ -137,24 +235,30 @@ class PSUControlMeross(
         return {
             "try_login": ("api_base_url", "user_email", "user_password"),
             "list_devices": ("api_base_url", "user_email", "user_password"),
-            "toggle_device": (
-                "api_base_url",
-                "user_email",
-                "user_password",
-                "dev_ids"
-            ),
+            "toggle_device": ("api_base_url", "user_email", "user_password", "dev_ids"),
+            "restart_worker": (),
         }
 
     def on_api_command(self, event, payload):
         self._logger.debug(f"ON_EVENT {event!r}")
+        if event in ADMIN_API_COMMANDS:
+            self._require_admin()
+        with self.meross.tracer.trace(f"api_command:{event}"):
+            return self._on_api_command(event, payload)
+
+    def _on_api_command(self, event, payload):
+        # Never block the flask thread for longer than that
+        deadline = Deadline()
         if event == "try_login":
             try:
-                success = self._ensure_meross_login(
-                    payload["api_base_url"],
-                    payload["user_email"],
-                    payload["user_password"],
-                    raise_exc=True,
-                ).result()
+                success = deadline.result(
+                    self._ensure_meross_login(
+                        payload["api_base_url"],
+                        payload["user_email"],
+                        payload["user_password"],
+                        raise_exc=True,
+                    )
+                )
             except Exception as err:
                 success = False
                 message = str(err)
@@ -169,26 +273,92 @@ class PSUControlMeross(
             self._logger.debug(f"ON_EVENT {event!r}")
             # Ensure that we are logged in with the desired credentials
             err = False
+            devices = {}
             try:
-                self._ensure_meross_login(
-                    payload["api_base_url"],
-                    payload["user_email"],
-                    payload["user_password"],
-                    raise_exc=True,
-                ).result()
-                rv = self.meross.toggle_device(payload["dev_ids"]).result()
+                deadline.result(
+                    self._ensure_meross_login(
+                        payload["api_base_url"],
+                        payload["user_email"],
+                        payload["user_password"],
+                        raise_exc=True,
+                    )
+                )
+                rv = deadline.result(
+                    self.meross.toggle_device(payload["dev_ids"], timeout=deadline)
+                )
             except Exception as exc:
                 err = message = str(exc)
             else:
-                message = "success!" if rv else "Unexpected failure"
+                devices = rv.asdict()
+                if rv:
+                    message = "success!"
+                else:
+                    err = message = "; ".join(
+                        f"{el.dev_id}: {el.error}" for el in rv.failed
+                    )
             out = {
                 "rv": message,
                 "error": err,
+                "devices": devices,
             }
+        elif event == "list_devices":
+            return self._list_devices_response(payload, deadline)
+        elif event == "restart_worker":
+            stopped = self.meross.restart()
+            self._start_warm_up()
+            out = {"rv": self.meross.worker_stats(), "error": not stopped}
         else:
             raise NotImplementedError(event)
         return flask.jsonify(out)
 
+    def _list_devices_response(self, payload, deadline: Deadline):
+        """The `list_devices` command (optional `query`, `offset` and `limit` fields).
+
+        Answers `If-None-Match` with 304 while the device list stays the same.
+        """
+        try:
+            query = str(payload.get("query") or "")
+            offset = max(int(payload.get("offset") or 0), 0)
+            limit = payload.get("limit")
+            if limit is not None:
+                limit = max(int(limit), 0)
+        except (TypeError, ValueError):
+            flask.abort(400)
+        try:
+            # No new login if the credentials are those of the current session
+            deadline.result(
+                self._ensure_meross_login(
+                    payload["api_base_url"],
+                    payload["user_email"],
+                    payload["user_password"],
+                    raise_exc=True,
+                )
+            )
+            index = self.meross.device_index(timeout=deadline)
+        except Exception as exc:
+            return flask.jsonify({"rv": str(exc), "error": True, "devices": []})
+
+        etag = hashlib.sha1(
+            json.dumps([index.etag, query, offset, limit]).encode("utf-8")
+        ).hexdigest()
+        if etag in flask.request.if_none_match:
+            return flask.Response(status=304, headers={"ETag": f'"{etag}"'})
+        total, page = index.select(query=query, offset=offset, limit=limit)
+        header = json.dumps(
+            {
+                "rv": "success!",
+                "error": False,
+                "total": total,
+                "offset": offset,
+                "limit": limit,
+            }
+        )
+        # Splice in the pre-serialised device handles
+        body = header[:-1] + ', "devices": [' + ", ".join(page) + "]}"
+        return flask.Response(
+            body, content_type="application/json", headers={"ETag": f'"{etag}"'}
+        )
+
     def get_update_information(self):
         from . import __VERSION__, __plugin_name__
 
@@ -219,20 +389,98 @@ class PSUControlMeross(
             }
         }
 
+    @staticmethod
+    def _require_admin():
+        """Abort the API request unless the current user is an administrator."""
+        from octoprint.access.permissions import Permissions
+
+        if not Permissions.ADMIN.can():
+            flask.abort(403)
+
     def on_api_get(self, request):
+        resource = request.args.get("resource")
+        if resource in ADMIN_API_RESOURCES:
+            self._require_admin()
+        if resource == "metrics":
+            return self._get_metrics_response(request.args.get("format", "prometheus"))
+        elif resource == "traces":
+            return self._get_traces_response(request.args.get("format", "json"))
+        elif resource == "transport":
+            try:
+                return flask.jsonify(self.meross.transport_stats())
+            except DeadlineExceededError:
+                flask.abort(504)
+        elif resource == "states":
+            return self._get_states_response(request.args)
+        elif resource == "worker":
+            return flask.jsonify(self.meross.worker_stats())
+        elif resource is not None:
+            flask.abort(404)
+
         device_list = ()
         if self.meross.is_authenticated:
-            device_list = [dev.asdict() for dev in self.meross.list_devices()]
+            try:
+                device_list = self.meross.list_devices(asdict=True)
+            except DeadlineExceededError:
+                flask.abort(504)
+        # A single (background) query for all the stale target channels
+        target_states = self.meross.channel_states(
+            self.target_device_ids, max_age=self._settings.get_int(["state_max_age"])
+        )
         return flask.jsonify(
             {
                 "is_authenticated": self.meross.is_authenticated,
                 "target_devices": [
                     {
                         "id": device_id,
-                        "state": "on" if self.meross.is_on([device_id]) else "off",
+                        # `None` until the state is known
+                        "state": None if is_on is None else ("on" if is_on else "off"),
                     }
-                    for device_id in self.target_device_ids
+                    for (device_id, is_on) in target_states.items()
                 ],
                 "device_list": device_list,
             }
         )
+
+    def _get_metrics_response(self, fmt: str):
+        """`GET ?resource=metrics[&format=prometheus|json]`"""
+        metrics = self.meross.metrics
+        if fmt == "json":
+            return flask.jsonify(metrics.snapshot())
+        elif fmt == "prometheus":
+            return flask.Response(
+                metrics.render_prometheus(),
+                content_type="text/plain; version=0.0.4; charset=utf-8",
+            )
+        flask.abort(400)
+
+    def _get_states_response(self, args):
+        """`GET ?resource=states[&ids=<uuid>::<channel>,..][&max_age=<seconds>]`
+
+        (The target devices by default.)
+        """
+        if args.get("ids"):
+            dev_ids = [el.strip() for el in args["ids"].split(",") if el.strip()]
+        else:
+            dev_ids = self.target_device_ids
+        try:
+            max_age = float(
+                args.get("max_age", self._settings.get_int(["state_max_age"]))
+            )
+            states = self.meross.get_states(dev_ids, max_age=max_age)
+        except ValueError:
+            flask.abort(400)
+        except DeadlineExceededError:
+            flask.abort(504)
+        return flask.jsonify(
+            {"is_authenticated": self.meross.is_authenticated, "states": states}
+        )
+
+    def _get_traces_response(self, fmt: str):
+        """`GET ?resource=traces[&format=json|otlp]` (the recent slow traces)"""
+        tracer = self.meross.tracer
+        if fmt == "json":
+            return flask.jsonify(tracer.to_dict())
+        elif fmt == "otlp":
+            return flask.jsonify(tracer.to_otlp())
+        flask.abort(400)
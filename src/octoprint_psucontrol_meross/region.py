@@ -0,0 +1,200 @@
+"""Automatic Meross cloud region (API endpoint) selection by latency."""
+
+import asyncio
+import hashlib
+import time
+
+from typing import Optional, Sequence
+
+# Setting value that selects the region automatically
+AUTO_REGION = "auto"
+# How long a region choice is reused before the endpoints are probed again (seconds)
+REGION_CACHE_TTL = 24 * 60 * 60
+# Max time to wait for a probed endpoint to answer (seconds)
+PROBE_TIMEOUT = 5.0
+# Re-probe once the moving average of the cloud command latency (or a login)
+#  gets this much slower than it was right after the region was chosen
+DEGRADATION_FACTOR = 3.0
+# Cloud command latencies averaged into the baseline after a login
+BASELINE_SAMPLES = 5
+# Latencies below this never count as degraded (seconds)
+DEGRADATION_MIN_LATENCY = 0.5
+# Min time between two background re-probes (seconds)
+REPROBE_INTERVAL = 10 * 60
+# Weight of the latest sample in the latency moving average
+LATENCY_EWMA_ALPHA = 0.2
+
+REGION_KEY_PREFIX = "meross_region_"
+
+
+def endpoint_url(api_base_url: str) -> str:
+    if "://" in api_base_url:
+        return api_base_url
+    return f"https://{api_base_url}"
+
+
+class RegionSelector:
+    """Orders the candidate API endpoints by their probed latency.
+
+    The choice (per account and candidate list) is kept in the `MerossCache`
+    for `REGION_CACHE_TTL`. When the logins or the cloud commands get slower,
+    the endpoints are re-probed in the background and the next login uses
+    the new choice.
+
+    Lives on the worker loop.
+    """
+
+    def __init__(self, cache, logger, ttl: float = REGION_CACHE_TTL):
+        self._cache = cache
+        self._logger = logger
+        self.ttl = ttl
+        self._current_key: str = None
+        self._current_urls: Sequence[str] = ()
+        # Cloud command latency right after the login (`None` if not auto-selected)
+        self.baseline_latency: Optional[float] = None
+        self._baseline_samples = []
+        self.latency: Optional[float] = None  # Moving average after the baseline
+        self._last_reprobe: Optional[float] = None
+        self._reprobe_task: asyncio.Future = None
+        self.probes = 0
+
+    @classmethod
+    def get_region_key(cls, user: str, urls: Sequence[str]) -> str:
+        data = "\n".join([user, *sorted(urls)]).encode("utf8")
+        return f"{REGION_KEY_PREFIX}{hashlib.sha256(data).hexdigest()}"
+
+    async def probe(self, url: str) -> Optional[float]:
+        """Round trip time of a request to the endpoint (`None` if unreachable).
+
+        Any HTTP answer counts, the account is checked by the login.
+        """
+        import aiohttp  # Already imported by meross_iot at this point
+
+        self.probes += 1
+        start = time.perf_counter()
+        try:
+            async with aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=PROBE_TIMEOUT)
+            ) as session:
+                async with session.head(
+                    endpoint_url(url), allow_redirects=False
+                ) as response:
+                    await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as err:
+            self._logger.info(f"Region {url!r} is not reachable: {err!r}")
+            return None
+        return time.perf_counter() - start
+
+    async def rank(self, urls: Sequence[str]) -> Sequence[tuple]:
+        """Probe the `urls` concurrently, return (url, latency) of the reachable ones, fastest first."""
+        latencies = await asyncio.gather(*[self.probe(url) for url in urls])
+        out = sorted(
+            (
+                (url, latency)
+                for (url, latency) in zip(urls, latencies)
+                if latency is not None
+            ),
+            key=lambda el: el[1],
+        )
+        self._logger.debug(f"Region latencies: {out!r}")
+        return out
+
+    async def order(self, user: str, urls: Sequence[str]) -> Sequence[str]:
+        """The `urls` to try logging in with, best first."""
+        key = self.get_region_key(user, urls)
+        cached = await self._cache.run_in_executor(self._cache.get, key)
+        if cached and cached["url"] in urls:
+            ranked = [(cached["url"], cached["latency"])]
+        else:
+            ranked = await self.rank(urls)
+        # The unreachable endpoints go last (the probe could have been wrong)
+        ranked_urls = [url for (url, _) in ranked]
+        return ranked_urls + [url for url in urls if url not in ranked_urls]
+
+    async def remember(
+        self, user: str, urls: Sequence[str], url: str, login_latency: float
+    ):
+        """Record the endpoint that accepted the account (and the duration of the login)."""
+        key = self._current_key = self.get_region_key(user, urls)
+        self._current_urls = tuple(urls)
+        self.baseline_latency = self.latency = None
+        self._baseline_samples = []
+        cached = await self._cache.run_in_executor(self._cache.get, key) or {}
+        entry = {
+            "url": url,
+            "latency": cached.get("latency") if cached.get("url") == url else None,
+            "login_latency": login_latency,
+        }
+        previous_login = cached.get("login_latency")
+        if previous_login is not None and cached.get("url") == url:
+            # Compare against the first login with this endpoint
+            entry["login_latency"] = previous_login
+            if login_latency >= max(
+                DEGRADATION_FACTOR * previous_login, DEGRADATION_MIN_LATENCY
+            ):
+                self._logger.info(f"Slow login ({login_latency:.3f}s).")
+                self._schedule_reprobe()
+        await self._cache.run_in_executor(self._cache.set, key, entry, ttl=self.ttl)
+        self._logger.info(f"Using the {url!r} region.")
+
+    def forget(self):
+        self._current_key = self.baseline_latency = self.latency = None
+        self._current_urls = ()
+
+    def observe(self, latency: float):
+        """Record a cloud command latency, re-probes in the background if it degraded."""
+        if self._current_key is None:
+            return  # Not an automatically selected region
+        if self.baseline_latency is None:
+            self._baseline_samples.append(latency)
+            if len(self._baseline_samples) >= BASELINE_SAMPLES:
+                self.baseline_latency = sum(self._baseline_samples) / len(
+                    self._baseline_samples
+                )
+            return
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += LATENCY_EWMA_ALPHA * (latency - self.latency)
+        if self.degraded:
+            self._logger.info(f"Cloud latency degraded ({self.latency:.3f}s).")
+            self._schedule_reprobe()
+
+    def _schedule_reprobe(self):
+        now = time.monotonic()
+        if (
+            self._last_reprobe is not None
+            and now - self._last_reprobe < REPROBE_INTERVAL
+        ):
+            return
+        if self._reprobe_task is not None and not self._reprobe_task.done():
+            return
+        self._last_reprobe = now
+        self._reprobe_task = asyncio.ensure_future(self._reprobe())
+
+    @property
+    def degraded(self) -> bool:
+        return (
+            self.baseline_latency is not None
+            and self.latency is not None
+            and self.latency >= DEGRADATION_MIN_LATENCY
+            and self.latency >= DEGRADATION_FACTOR * self.baseline_latency
+        )
+
+    async def _reprobe(self):
+        key, urls = (self._current_key, self._current_urls)
+        self._logger.info("Re-probing the regions.")
+        ranked = await self.rank(urls)
+        if not ranked or key != self._current_key:
+            return
+        url, latency = ranked[0]
+        cached = await self._cache.run_in_executor(self._cache.get, key) or {}
+        if cached.get("url") != url:
+            self._logger.info(
+                f"Region {url!r} is faster now, using it on the next login."
+            )
+            await self._cache.run_in_executor(
+                self._cache.set, key, {"url": url, "latency": latency}, ttl=self.ttl
+            )
+        # Do not re-probe again on the same (degraded) measurements
+        self.latency = None
@@ -0,0 +1,235 @@
+"""Deadlines, per-device circuit breakers, retries and per-device results."""
+
+import asyncio
+import concurrent.futures
+import dataclasses
+import random
+import time
+
+from typing import (
+    Awaitable,
+    Callable,
+    Dict,
+    Hashable,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
+
+from .exc import CircuitOpenError, DeadlineExceededError
+
+# Default time budget of a client call (seconds)
+DEFAULT_CALL_BUDGET = 20
+# Extra time the waiting (flask) thread gives the worker loop to report
+#  the (partial) results of a call whose deadline has just passed
+DEADLINE_GRACE = 0.5
+
+# Retries of the failed device commands (within the call's budget)
+DEFAULT_MAX_ATTEMPTS = 3
+BACKOFF_BASE_DELAY = 0.25
+BACKOFF_MAX_DELAY = 4
+
+# Consecutive failed calls (however many attempts each) that open a device's circuit breaker
+BREAKER_FAILURE_THRESHOLD = 3
+# Time an open circuit breaker rejects calls before letting a trial call through
+BREAKER_RESET_TIMEOUT = 30
+
+
+class Deadline:
+    """An absolute point in time (`time.monotonic()`) a call has to finish by.
+
+    Created from a budget in seconds, it can be handed across threads.
+    """
+
+    def __init__(self, budget: float = DEFAULT_CALL_BUDGET):
+        self.budget = budget
+        self.expires_at = time.monotonic() + budget
+
+    @classmethod
+    def coerce(cls, value) -> "Deadline":
+        """Accept a `Deadline`, a budget in seconds or `None` (the default budget)."""
+        if isinstance(value, Deadline):
+            return value
+        return cls(DEFAULT_CALL_BUDGET if value is None else value)
+
+    def remaining(self) -> float:
+        return max(self.expires_at - time.monotonic(), 0)
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    async def wait_for(self, awaitable: Awaitable):
+        """Await `awaitable`, cancelling it when the deadline passes."""
+        try:
+            return await asyncio.wait_for(awaitable, self.remaining())
+        except asyncio.TimeoutError:
+            raise DeadlineExceededError(
+                f"No result within the {self.budget}s budget"
+            ) from None
+
+    def result(self, future: concurrent.futures.Future, grace: float = DEADLINE_GRACE):
+        """Block until the `future` is done (for at most the remaining budget + `grace`).
+
+        The future is not cancelled on timeout, as it may be shared with other callers.
+        """
+        try:
+            return future.result(timeout=self.remaining() + grace)
+        except concurrent.futures.TimeoutError:
+            raise DeadlineExceededError(
+                f"No result within the {self.budget}s budget"
+            ) from None
+
+
+class CircuitBreaker:
+    """Fails the calls to a device fast after it failed `failure_threshold` times in a row.
+
+    Once `reset_timeout` seconds have passed, a single trial call per `key`
+    (a channel of the device) is let through: a success closes the breaker,
+    a failed trial re-opens it.
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+        reset_timeout: float = BREAKER_RESET_TIMEOUT,
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trials: Set[Hashable] = set()  # Keys of the running trial calls
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self, key: Hashable = None) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and key not in self._trials:
+            self._trials.add(key)
+            return True
+        return False
+
+    def record_success(self, key: Hashable = None):
+        self.failures = 0
+        self.opened_at = None
+        self._trials.clear()
+
+    def record_failure(self, key: Hashable = None):
+        self.failures += 1
+        if key in self._trials or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+        self._trials.discard(key)
+
+    def release(self, key: Hashable = None):
+        """Forget the trial call of `key` that ended without an outcome (cancelled)."""
+        self._trials.discard(key)
+
+
+def backoff_delay(
+    attempt: int,
+    base_delay: float = BACKOFF_BASE_DELAY,
+    max_delay: float = BACKOFF_MAX_DELAY,
+) -> float:
+    """Exponential backoff with full jitter before the retry number `attempt` (1-based)."""
+    return random.uniform(0, min(max_delay, base_delay * 2**attempt))
+
+
+@dataclasses.dataclass
+class DeviceResult:
+    """Outcome of a command for a single `uuid::channel`."""
+
+    dev_id: str
+    success: bool
+    latency: float  # Seconds, including the retries
+    attempts: int = 1
+    error: str = None
+
+    def asdict(self) -> dict:
+        return dataclasses.asdict(self)
+
+
+@dataclasses.dataclass
+class CommandResult:
+    """Per-device outcome of a group command (truthy if all devices succeeded)."""
+
+    devices: Sequence[DeviceResult]
+
+    @property
+    def success(self) -> bool:
+        return all(el.success for el in self.devices)
+
+    def __bool__(self) -> bool:
+        return self.success
+
+    @property
+    def failed(self) -> Sequence[DeviceResult]:
+        return tuple(el for el in self.devices if not el.success)
+
+    def asdict(self) -> Dict[str, dict]:
+        return {el.dev_id: el.asdict() for el in self.devices}
+
+
+async def _call_with_retries(
+    fn: Callable[[], Awaitable], deadline: Deadline, max_attempts: int
+) -> Tuple[int, Optional[Exception]]:
+    """Return (attempts, the last error (`None` on success)) of calling `fn()`."""
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            await deadline.wait_for(fn())
+        except asyncio.CancelledError:  # An `Exception` on python 3.7
+            raise
+        except Exception as err:
+            if attempt >= max_attempts:
+                return (attempt, err)
+            delay = backoff_delay(attempt)
+            if delay >= deadline.remaining():
+                return (attempt, err)
+            await asyncio.sleep(delay)
+        else:
+            return (attempt, None)
+
+
+async def run_device_call(
+    dev_id: str,
+    fn: Callable[[], Awaitable],
+    deadline: Deadline,
+    breaker: CircuitBreaker,
+    max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+) -> DeviceResult:
+    """Call `fn()` until it succeeds, retrying with backoff within the `deadline`.
+
+    The call (not every attempt) counts as a single failure or success
+    of the `breaker`. Never raises, the outcome is reported in the returned
+    `DeviceResult`.
+    """
+    start = time.monotonic()
+    if not breaker.allow(dev_id):
+        attempts, error = (0, CircuitOpenError("Too many recent failures, not trying"))
+    else:
+        try:
+            attempts, error = await _call_with_retries(fn, deadline, max_attempts)
+        except asyncio.CancelledError:  # An `Exception` on python 3.7
+            breaker.release(dev_id)
+            raise
+        if error is None:
+            breaker.record_success(dev_id)
+        else:
+            breaker.record_failure(dev_id)
+    return DeviceResult(
+        dev_id=dev_id,
+        success=error is None,
+        latency=time.monotonic() - start,
+        attempts=attempts,
+        error=None if error is None else (str(error) or repr(error)),
+    )
@@ -0,0 +1,215 @@
+"""Background upkeep of the Meross cloud session (token refreshes, MQTT reconnects)."""
+
+import asyncio
+import datetime
+import time
+
+from typing import Awaitable, Callable, Dict, Optional
+
+from .resilience import backoff_delay
+
+# Time between two supervisor checks (seconds)
+SUPERVISOR_INTERVAL = 15
+# The token lifetime is not documented by Meross, so it is replaced
+#  by a new one long before it could expire (seconds)
+TOKEN_REFRESH_AGE = 7 * 24 * 60 * 60
+# Time between two token checks against the cloud (seconds).
+#  A restored session is checked on the first supervisor tick.
+TOKEN_CHECK_INTERVAL = 60 * 60
+# A dropped MQTT connection is left to paho's own reconnect for this long (seconds)
+MQTT_RECONNECT_GRACE = 30
+# Exponential backoff of the failed token refreshes and MQTT reconnects (seconds)
+RETRY_BASE_DELAY = 5
+RETRY_MAX_DELAY = 10 * 60
+
+
+def _utcnow() -> datetime.datetime:
+    """Naive UTC time (what meross_iot stamps the credentials with)."""
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+class SessionSupervisor:
+    """Keeps the cloud session usable, so that no command has to wait for a login.
+
+    On every tick it checks the token with the cloud (every `TOKEN_CHECK_INTERVAL`),
+    replaces the token once it is `TOKEN_REFRESH_AGE` old or was rejected, and
+    reconnects the MQTT clients that stay disconnected. The failed attempts are
+    retried with an exponential backoff. The manager and the device registry
+    are kept as they are.
+
+    Lives on the worker loop.
+    """
+
+    def __init__(
+        self,
+        get_credentials: Callable[[], object],
+        verify: Callable[[], Awaitable[bool]],
+        refresh: Callable[[], Awaitable[bool]],
+        get_mqtt_clients: Callable[[], Dict[str, object]],
+        logger,
+        interval: float = SUPERVISOR_INTERVAL,
+        token_refresh_age: float = TOKEN_REFRESH_AGE,
+    ):
+        # `MerossCloudCreds` (`None` if logged out)
+        self.get_credentials = get_credentials
+        self.verify = verify  # `False` if the cloud rejects the token
+        self.refresh = refresh  # Log in again in place, `True` on success
+        self.get_mqtt_clients = get_mqtt_clients  # {"host:port": paho client}
+        self.interval = interval
+        self.token_refresh_age = token_refresh_age
+        self._logger = logger
+        self._task: asyncio.Future = None
+        self._verified_at: Optional[float] = None  # `time.monotonic()`
+        self._token_rejected = False
+        self._refresh_attempts = 0
+        self._next_refresh_at = 0.0
+        self._disconnected_since: Dict[str, float] = {}
+        self._reconnect_attempts: Dict[str, int] = {}
+        self._next_reconnect_at: Dict[str, float] = {}
+        self.refreshes = self.refresh_failures = 0
+        self.reconnects = self.reconnect_failures = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self, verified: bool):
+        """Supervise a new session (`verified` if its token was just issued)."""
+        self.stop()
+        self._verified_at = time.monotonic() if verified else None
+        self._token_rejected = False
+        self._refresh_attempts = 0
+        self._next_refresh_at = 0.0
+        self._disconnected_since.clear()
+        self._reconnect_attempts.clear()
+        self._next_reconnect_at.clear()
+        self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.check()
+            except asyncio.CancelledError:  # An `Exception` on python 3.7
+                raise
+            except Exception:
+                self._logger.exception("Session check failed.")
+
+    @property
+    def token_age(self) -> Optional[float]:
+        """Seconds since the session token was issued (`None` if logged out)."""
+        creds = self.get_credentials()
+        if creds is None:
+            return None
+        issued_on = creds.issued_on
+        if issued_on.tzinfo is not None:
+            issued_on = issued_on.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        return (_utcnow() - issued_on).total_seconds()
+
+    async def check(self):
+        if self.get_credentials() is None:
+            return  # Logged out
+        await self._check_token()
+        await self._check_mqtt()
+
+    async def _check_token(self):
+        now = time.monotonic()
+        if not self._token_rejected and (
+            self._verified_at is None or now - self._verified_at >= TOKEN_CHECK_INTERVAL
+        ):
+            try:
+                valid = await self.verify()
+            except asyncio.CancelledError:  # An `Exception` on python 3.7
+                raise
+            except Exception as err:
+                # Most likely the network, the token is checked again on the next tick
+                self._logger.warning(f"Unable to check the session token: {err!r}")
+            else:
+                self._verified_at = now
+                if not valid:
+                    self._logger.warning("The session token was rejected.")
+                    self._token_rejected = True
+        if not self._token_rejected and self.token_age < self.token_refresh_age:
+            return
+        if now < self._next_refresh_at:
+            return  # Backing off
+        self._logger.info("Refreshing the session token.")
+        try:
+            success = await self.refresh()
+        except asyncio.CancelledError:  # An `Exception` on python 3.7
+            raise
+        except Exception:
+            self._logger.exception("Unable to refresh the session token.")
+            success = False
+        if success:
+            self.refreshes += 1
+            self._verified_at = now
+            self._token_rejected = False
+            self._refresh_attempts = 0
+            self._next_refresh_at = 0.0
+        else:
+            self.refresh_failures += 1
+            self._refresh_attempts += 1
+            self._next_refresh_at = now + backoff_delay(
+                self._refresh_attempts, RETRY_BASE_DELAY, RETRY_MAX_DELAY
+            )
+
+    async def _check_mqtt(self):
+        now = time.monotonic()
+        clients = self.get_mqtt_clients()
+        for key in set(self._disconnected_since) - set(clients):
+            self._forget_disconnection(key)
+        for key, client in clients.items():
+            if client.is_connected():
+                if key in self._disconnected_since:
+                    self._logger.info(f"MQTT connection to {key} is back.")
+                    self._forget_disconnection(key)
+                continue
+            since = self._disconnected_since.setdefault(key, now)
+            if now - since < MQTT_RECONNECT_GRACE or now < self._next_reconnect_at.get(
+                key, 0.0
+            ):
+                continue
+            attempt = self._reconnect_attempts[key] = (
+                self._reconnect_attempts.get(key, 0) + 1
+            )
+            self._logger.info(f"Reconnecting to MQTT {key} (attempt {attempt}).")
+            try:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self._reconnect_mqtt, client
+                )
+            except asyncio.CancelledError:  # An `Exception` on python 3.7
+                raise
+            except Exception as err:
+                self.reconnect_failures += 1
+                self._logger.warning(f"Unable to reconnect to MQTT {key}: {err!r}")
+            else:
+                self.reconnects += 1
+            # paho only reports the connection once the broker acknowledges it,
+            #  until then the next attempts back off
+            self._next_reconnect_at[key] = now + backoff_delay(
+                attempt, RETRY_BASE_DELAY, RETRY_MAX_DELAY
+            )
+
+    @staticmethod
+    def _reconnect_mqtt(client):
+        """Blocking reconnect of a paho client.
+
+        paho's network thread reconnects on its own as well, it is stopped first so that
+        the two never touch the socket at the same time.
+        """
+        client.loop_stop()  # Joins the thread, it notices the request within a second
+        try:
+            client.reconnect()
+        finally:
+            client.loop_start()
+
+    def _forget_disconnection(self, key: str):
+        self._disconnected_since.pop(key, None)
+        self._reconnect_attempts.pop(key, None)
+        self._next_reconnect_at.pop(key, None)
@@ -0,0 +1,116 @@
+"""Batched device state/discovery change notifications for the frontend."""
+
+import asyncio
+import time
+
+from typing import Callable, Dict, Iterable, Sequence, Set, Tuple
+
+from .device_state import make_dev_id
+
+# Min time between two messages (seconds); the changes in between are batched
+DEFAULT_PUSH_INTERVAL = 1.0
+
+
+class StatePushPublisher:
+    """Collects channel and device changes and sends their deltas once per tick.
+
+    A message looks like `{"states": {dev_id: {..}}, "devices": [..]}`,
+    where `states` only contains the channels whose state or online status
+    differs from what was sent before (`None` values for the forgotten ones)
+    and `devices` (the whole device list) is only there if it changed.
+
+    Lives on the worker loop.
+    """
+
+    def __init__(
+        self,
+        send: Callable[[dict], None],
+        describe: Callable[[Sequence[str]], Dict[str, dict]],
+        get_index: Callable[[], object],
+        logger,
+        interval: float = DEFAULT_PUSH_INTERVAL,
+    ):
+        self.send = send
+        self.describe = describe  # {dev_id: `get_states()`-like description}
+        self.get_index = get_index  # The current `DeviceIndex`
+        self.interval = interval
+        self._logger = logger
+        self._pending_channels: Set[str] = set()
+        self._pending_devices: Set[str] = set()
+        self._last_sent: Dict[str, tuple] = {}  # dev_id -> (state, online)
+        self._last_devices: Tuple[str] = None  # `DeviceIndex.handle_jsons`
+        self._last_flush = 0.0
+        self._flush_handle: asyncio.Handle = None
+        self._flush_loop: asyncio.AbstractEventLoop = None
+        self.messages_sent = 0
+
+    def channels_changed(self, dev_ids: Iterable[str]):
+        self._pending_channels.update(dev_ids)
+        self._schedule()
+
+    def devices_changed(self, dev_uuids: Iterable[str]):
+        self._pending_devices.update(dev_uuids)
+        self._schedule()
+
+    def cancel(self):
+        """Drop the scheduled message (the loop is going away)."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+    def _schedule(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return  # Not on the worker loop, goes out with the next message
+        if self._flush_handle is not None and self._flush_loop is loop:
+            return  # Batched with the already scheduled message
+        delay = max(self._last_flush + self.interval - time.monotonic(), 0)
+        self._flush_handle = loop.call_later(delay, self.flush)
+        # (A handle of a stopped worker loop never runs)
+        self._flush_loop = loop
+
+    def _affected_channels(self) -> Set[str]:
+        out = set(self._pending_channels)
+        if self._pending_devices:
+            prefixes = tuple(
+                make_dev_id(dev_uuid, "") for dev_uuid in self._pending_devices
+            )
+            known = set(self.get_index().channels) | set(self._last_sent)
+            out.update(dev_id for dev_id in known if dev_id.startswith(prefixes))
+        return out
+
+    def flush(self):
+        """Send the changes collected since the last message (if any)."""
+        self._flush_handle = None
+        self._last_flush = time.monotonic()
+        dev_ids = sorted(self._affected_channels())
+        self._pending_channels.clear()
+        self._pending_devices.clear()
+
+        message = {}
+        states = {}
+        for dev_id, description in self.describe(dev_ids).items():
+            key = (description["state"], description["online"])
+            if self._last_sent.get(dev_id, (None, None)) == key:
+                continue
+            states[dev_id] = description
+            if key == (None, None):
+                self._last_sent.pop(dev_id, None)
+            else:
+                self._last_sent[dev_id] = key
+        if states:
+            message["states"] = states
+        index = self.get_index()
+        if index.handle_jsons != self._last_devices:
+            # (Online status changes bump the generation, but not the list)
+            self._last_devices = index.handle_jsons
+            message["devices"] = index.handle_dicts
+        if not message:
+            return
+        try:
+            self.send(message)
+        except Exception:
+            self._logger.exception("Unable to send the state update.")
+        else:
+            self.messages_sent += 1
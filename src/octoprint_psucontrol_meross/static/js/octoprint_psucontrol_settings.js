@@ -14,6 +14,31 @@ $(function() {
 
         self.devices.extend({ rateLimit: 200 });
 
+        // ETag of the listed devices (`list_devices` answers 304 while they stay the same)
+        self._devices_etag = null;
+
+        // dev_id -> ko.observable({state, online, age, source}) (kept up to date by the backend)
+        self.device_states = {};
+
+        self.device_state = function(dev_id) {
+            if(!(dev_id in self.device_states)) {
+                self.device_states[dev_id] = ko.observable(null);
+            }
+            return self.device_states[dev_id];
+        }
+
+        self.device_label = function(device) {
+            var state = self.device_state(device.dev_id)();
+            if(!state) {
+                return device.name;
+            }
+            var label = device.name + ' (' + (state.state || 'unknown');
+            if(state.online === false) {
+                label += ', offline';
+            }
+            return label + ')';
+        }
+
         self.message = new function() {
             this.state = {
                 level: ko.observable(),
@@ -97,18 +122,69 @@ $(function() {
         self.fetch_plugin_status = function() {
             // Fetch BE state
             var ajaxDone = this.message.ajaxWait();
-            OctoPrint.simpleApiGet(
+            $.when(self.fetch_devices(), self.fetch_target_states()).always(ajaxDone);
+        }
+
+        self.fetch_devices = function() {
+            var username = self.settings.user_email();
+            var password = self.settings.user_password();
+            if (!username || !password) {
+                return $.Deferred().resolve();
+            }
+            var headers = {};
+            if (self._devices_etag) {
+                headers["If-None-Match"] = self._devices_etag;
+            }
+            return OctoPrint.simpleApiCommand(
                 "psucontrol_meross",
-            ).done(function(response){
-                var orig_selection = self.settings.target_device_ids(); // Store the current selection (while the list is being re-populated)
-                console.log("ORIG", orig_selection);
-                self.devices.removeAll()
-                for (device of response.device_list) {
-                    self.devices.push(device);
+                "list_devices",
+                {
+                    "api_base_url": self.settings.api_base_url(),
+                    "user_email": username,
+                    "user_password": password,
+                },
+                {headers: headers}
+            ).done(function(response, status, xhr){
+                if(xhr.status == 304) {
+                    return; // The listed devices are up to date
                 }
+                if(response.error) {
+                    self.message.error(response.rv);
+                    return;
+                }
+                self._devices_etag = xhr.getResponseHeader("ETag");
+                var orig_selection = self.settings.target_device_ids(); // Store the current selection (while the list is being re-populated)
+                self.devices(response.devices.slice());
                 ensure_devices_are_listed(orig_selection)
                 self.settings.target_device_ids(orig_selection);
-            }).always(ajaxDone);
+            });
+        }
+
+        self.fetch_target_states = function() {
+            return OctoPrint.simpleApiGet(
+                "psucontrol_meross",
+                {data: {resource: "states"}}
+            ).done(function(response){
+                for (dev_id in response.states) {
+                    self.device_state(dev_id)(response.states[dev_id]);
+                }
+            });
+        }
+
+        self.onDataUpdaterPluginMessage = function(plugin, data) {
+            // Deltas pushed by the backend (see `state_push.py`)
+            if(plugin != "psucontrol_meross" || !self.settings) {
+                return;
+            }
+            if(data.devices) {
+                var orig_selection = self.settings.target_device_ids();
+                self.devices(data.devices.slice());
+                ensure_devices_are_listed(orig_selection);
+                self.settings.target_device_ids(orig_selection);
+            }
+            for (dev_id in (data.states || {})) {
+                self.device_state(dev_id)(data.states[dev_id]);
+            }
         }
 
         self.toggle_device = function() {
@@ -1,23 +1,222 @@
 import asyncio
+import concurrent.futures
+import logging
 import threading
+import time
 
-from concurrent.futures import Future
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Awaitable, Callable, Tuple
 
 # Procured from https://github.com/jamesmccannon02/OctoPrint-Tplinkautoshutdown
 
+logger = logging.getLogger(__name__)
+
+# Time between two loop lag measurements (seconds)
+HEARTBEAT_INTERVAL = 1.0
+# Loop lag (or, in the debug mode, callback duration) worth a warning (seconds)
+SLOW_CALLBACK_DURATION = 0.1
+# Max time `stop()` waits for the pending tasks and the thread (seconds)
+STOP_TIMEOUT = 5.0
+# Threads of the loop's default executor (DNS lookups, paho calls)
+DEFAULT_EXECUTOR_WORKERS = 4
+
+# Event loop implementations ("auto" is uvloop if it is installed)
+EVENT_LOOP_AUTO = "auto"
+EVENT_LOOP_ASYNCIO = "asyncio"
+EVENT_LOOP_UVLOOP = "uvloop"
+
+
+def get_loop_factory(
+    name: str = EVENT_LOOP_AUTO,
+) -> Tuple[str, Callable[[], asyncio.AbstractEventLoop]]:
+    """(implementation name, new loop function) of the event loop `name`.
+
+    Falls back to the standard asyncio loop if uvloop is not installed.
+    Only the worker's own loop is affected (no global loop policy).
+    """
+    if name in (EVENT_LOOP_AUTO, EVENT_LOOP_UVLOOP):
+        try:
+            import uvloop
+        except ImportError:
+            if name == EVENT_LOOP_UVLOOP:
+                logger.warning("uvloop is not installed, using the asyncio loop.")
+        else:
+            return (EVENT_LOOP_UVLOOP, uvloop.new_event_loop)
+    elif name != EVENT_LOOP_ASYNCIO:
+        logger.warning(f"Unknown event loop {name!r}, using the asyncio loop.")
+    return (EVENT_LOOP_ASYNCIO, asyncio.new_event_loop)
+
 
 class ThreadedWorker:
-    def __init__(self):
-        self.thread = threading.Thread(target=self.run, daemon=True)
-        self.loop_future = Future()
-        self.thread.start()
+    """An asyncio loop running on a daemon thread.
+
+    A heartbeat measures how late the loop runs its callbacks (the loop lag),
+    a blocked loop is logged. The asyncio debug mode (`debug`) additionally
+    logs every callback that takes longer than `slow_callback_duration`.
+
+    `event_loop` picks the loop implementation (see `get_loop_factory()`),
+    `executor_workers` sizes the loop's default executor.
+    """
+
+    def __init__(
+        self,
+        logger: logging.Logger = logger,
+        debug: bool = False,
+        slow_callback_duration: float = SLOW_CALLBACK_DURATION,
+        heartbeat_interval: float = HEARTBEAT_INTERVAL,
+        event_loop: str = EVENT_LOOP_AUTO,
+        executor_workers: int = DEFAULT_EXECUTOR_WORKERS,
+    ):
+        self._logger = logger
+        self.event_loop, self._new_loop = get_loop_factory(event_loop)
+        self.executor_workers = executor_workers
+        self.debug = bool(debug)
+        self.slow_callback_duration = slow_callback_duration
+        self.heartbeat_interval = heartbeat_interval
+        self.thread: threading.Thread = None
+        self.loop_future: Future = None
+        self.restarts = 0
+        # Loop lag of the last heartbeat and the max one since the start (seconds)
+        self.lag = self.max_lag = 0.0
+        self.heartbeats = 0
+        self.stalls = 0  # Heartbeats late by `slow_callback_duration` or more
+        self.loop_exceptions = 0  # Exceptions nobody retrieved
+        self._heartbeat_due: float = None  # `time.monotonic()`
+        self.start()
 
     @property
-    def loop(self):
+    def loop(self) -> asyncio.AbstractEventLoop:
         return self.loop_future.result()
 
+    @property
+    def running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        """Start the loop thread (again, after a `stop()`)."""
+        if self.running:
+            return
+        if self.loop_future is not None:
+            self.restarts += 1
+        self.loop_future = Future()
+        self._heartbeat_due = None
+        self.thread = threading.Thread(
+            target=self.run, name="psucontrol_meross_worker", daemon=True
+        )
+        self.thread.start()
+
     def run(self):
-        loop = asyncio.new_event_loop()
+        loop = self._new_loop()
         asyncio.set_event_loop(loop)
+        loop.set_default_executor(
+            ThreadPoolExecutor(
+                max_workers=self.executor_workers,
+                thread_name_prefix="psucontrol_meross_executor",
+            )
+        )
+        loop.set_debug(self.debug)
+        loop.slow_callback_duration = self.slow_callback_duration
+        loop.set_exception_handler(self._on_loop_exception)
+        loop.call_soon(self._heartbeat, loop)
         self.loop_future.set_result(loop)
-        return loop.run_forever()
+        try:
+            loop.run_forever()
+        finally:
+            loop.close()
+
+    def _heartbeat(self, loop: asyncio.AbstractEventLoop):
+        now = time.monotonic()
+        if self._heartbeat_due is not None:
+            self.lag = max(now - self._heartbeat_due, 0.0)
+            self.max_lag = max(self.max_lag, self.lag)
+            if self.lag >= self.slow_callback_duration:
+                self.stalls += 1
+                self._logger.warning(
+                    f"The worker loop was blocked for {self.lag:.3f}s."
+                )
+        self.heartbeats += 1
+        self._heartbeat_due = now + self.heartbeat_interval
+        loop.call_later(self.heartbeat_interval, self._heartbeat, loop)
+
+    def _on_loop_exception(self, loop: asyncio.AbstractEventLoop, context: dict):
+        self.loop_exceptions += 1
+        self._logger.error(
+            f"Worker loop error: {context.get('message')}",
+            exc_info=context.get("exception"),
+        )
+
+    @property
+    def current_lag(self) -> float:
+        """The loop lag, including the time a currently blocked loop is late by."""
+        due = self._heartbeat_due
+        if due is None or not self.running:
+            return self.lag
+        return max(self.lag, time.monotonic() - due)
+
+    def pending_tasks(self) -> int:
+        if not self.running:
+            return 0
+        return len(asyncio.all_tasks(self.loop))
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "event_loop": self.event_loop,
+            "debug": self.debug,
+            "lag": self.current_lag,
+            "max_lag": self.max_lag,
+            "heartbeats": self.heartbeats,
+            "stalls": self.stalls,
+            "loop_exceptions": self.loop_exceptions,
+            "pending_tasks": self.pending_tasks(),
+            "restarts": self.restarts,
+        }
+
+    def stop(
+        self,
+        timeout: float = STOP_TIMEOUT,
+        on_stop: Callable[[], Awaitable] = None,
+    ) -> bool:
+        """Cancel the pending tasks, stop the loop and wait for the thread.
+
+        `on_stop()` is awaited once the pending tasks are cancelled.
+        Returns `False` if the loop did not stop in time (e.g. it is blocked),
+        the thread is abandoned then.
+        """
+        if not self.running:
+            return True
+        deadline = time.monotonic() + timeout
+        loop = self.loop
+        shutdown = self._shutdown(on_stop)
+        future = asyncio.run_coroutine_threadsafe(shutdown, loop)
+        try:
+            future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            self._logger.error("The worker loop did not shut down in time.")
+            if future.cancel():
+                # A blocked loop never started it (and never will)
+                shutdown.close()
+        except Exception:
+            self._logger.exception("Worker loop shutdown failed.")
+        loop.call_soon_threadsafe(loop.stop)
+        self.thread.join(max(deadline - time.monotonic(), 0.1))
+        if self.thread.is_alive():
+            self._logger.error("The worker thread is blocked, abandoning it.")
+            self.thread = None
+            return False
+        return True
+
+    async def _shutdown(self, on_stop: Callable[[], Awaitable] = None):
+        tasks = [el for el in asyncio.all_tasks() if el is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if on_stop is not None:
+            try:
+                await on_stop()
+            except Exception:
+                self._logger.exception("Worker loop shutdown hook failed.")
+        loop = asyncio.get_running_loop()
+        await loop.shutdown_asyncgens()
+        if hasattr(loop, "shutdown_default_executor"):  # python 3.9+
+            await loop.shutdown_default_executor()
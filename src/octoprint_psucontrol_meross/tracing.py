@@ -0,0 +1,299 @@
+"""Lightweight per-command tracing.
+
+A trace is started by the plugin for every PSUControl/API command and is
+carried (via a context variable) to the worker loop, where the client records
+timed spans of the individual stages (login, loop wait, discovery, device
+updates, ...). Finished traces slower than a threshold are kept in a ring buffer.
+"""
+
+import asyncio
+import collections
+import contextlib
+import contextvars
+import dataclasses
+import os
+import threading
+import time
+
+from concurrent.futures import Future
+from typing import Awaitable, Dict, List, Optional
+
+# Keep traces that took longer than this (seconds)
+DEFAULT_SLOW_THRESHOLD = 1.0
+# Number of slow traces to keep
+DEFAULT_MAX_TRACES = 20
+
+_current_trace: contextvars.ContextVar = contextvars.ContextVar(
+    "psucontrol_meross_trace", default=None
+)
+_current_span_id: contextvars.ContextVar = contextvars.ContextVar(
+    "psucontrol_meross_span_id", default=None
+)
+
+
+def _new_id(n_bytes: int) -> str:
+    return os.urandom(n_bytes).hex()
+
+
+@dataclasses.dataclass
+class Span:
+    name: str
+    span_id: str
+    parent_id: Optional[str]
+    start: float  # `time.perf_counter()` timestamps
+    end: float = None
+    attributes: Dict[str, object] = dataclasses.field(default_factory=dict)
+    error: str = None
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+class Trace:
+    """Spans of a single command.
+
+    The trace finishes once the code that started it is done and all of
+    the worker loop futures attached to it are resolved.
+    """
+
+    def __init__(self, tracer: "Tracer", name: str):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = _new_id(16)
+        self.root = Span(
+            name=name, span_id=_new_id(8), parent_id=None, start=time.perf_counter()
+        )
+        self.start_time = time.time()  # Wall clock time of `root.start`
+        self.spans: List[Span] = []
+        self.finished = False
+        self._lock = threading.Lock()
+        self._pending = 1  # The code that started the trace
+
+    @property
+    def duration(self) -> float:
+        end = self.root.end if self.finished else time.perf_counter()
+        return end - self.root.start
+
+    def add_span(
+        self, name: str, start: float, end: float, parent_id: str = None, **attributes
+    ) -> Optional[Span]:
+        """Record a span that has already ended."""
+        out = Span(
+            name=name,
+            span_id=_new_id(8),
+            parent_id=parent_id or _current_span_id.get() or self.root.span_id,
+            start=start,
+            end=end,
+            attributes=attributes,
+        )
+        return self._append(out)
+
+    def _append(self, span: Span) -> Optional[Span]:
+        if self.finished:
+            # e.g. a background cache refresh that outlived the command
+            return None
+        self.spans.append(span)
+        return span
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes):
+        parent_id = _current_span_id.get() or self.root.span_id
+        out = Span(
+            name=name,
+            span_id=_new_id(8),
+            parent_id=parent_id,
+            start=time.perf_counter(),
+            attributes=attributes,
+        )
+        token = _current_span_id.set(out.span_id)
+        try:
+            yield out
+        except BaseException as err:
+            out.error = repr(err)
+            raise
+        finally:
+            _current_span_id.reset(token)
+            out.end = time.perf_counter()
+            self._append(out)
+
+    def attach(self, future: Future):
+        """Keep the trace open until `future` is done."""
+        with self._lock:
+            if self.finished:
+                return
+            self._pending += 1
+        future.add_done_callback(lambda _future: self.release())
+
+    def release(self):
+        with self._lock:
+            self._pending -= 1
+            if self._pending > 0 or self.finished:
+                return
+            self.root.end = time.perf_counter()
+            self.finished = True
+        self.tracer.on_trace_finished(self)
+
+    def _unix_time(self, perf_counter: float) -> float:
+        return self.start_time + (perf_counter - self.root.start)
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "start_time": self.start_time,
+            "duration": self.duration,
+            "spans": [
+                {
+                    "name": span.name,
+                    "span_id": span.span_id,
+                    "parent_id": span.parent_id,
+                    "offset": span.start - self.root.start,
+                    "duration": span.duration,
+                    "attributes": dict(span.attributes),
+                    "error": span.error,
+                }
+                for span in sorted(tuple(self.spans), key=lambda span: span.start)
+            ],
+        }
+
+    def to_otlp_spans(self) -> List[dict]:
+        """Spans in the OpenTelemetry (OTLP/JSON) format."""
+        out = []
+        for span in (self.root,) + tuple(self.spans):
+            el = {
+                "traceId": self.trace_id,
+                "spanId": span.span_id,
+                "name": span.name,
+                "kind": 1,  # SPAN_KIND_INTERNAL
+                "startTimeUnixNano": str(int(self._unix_time(span.start) * 1e9)),
+                "endTimeUnixNano": str(int(self._unix_time(span.end) * 1e9)),
+                "attributes": [
+                    {"key": key, "value": {"stringValue": str(value)}}
+                    for (key, value) in span.attributes.items()
+                ],
+                "status": (
+                    {"code": 2, "message": span.error} if span.error else {"code": 0}
+                ),
+            }
+            if span.parent_id:
+                el["parentSpanId"] = span.parent_id
+            out.append(el)
+        return out
+
+
+class Tracer:
+    """Creates traces and keeps the last `max_traces` slow ones."""
+
+    def __init__(
+        self,
+        logger,
+        slow_threshold: float = DEFAULT_SLOW_THRESHOLD,
+        max_traces: int = DEFAULT_MAX_TRACES,
+    ):
+        self._logger = logger
+        self.slow_threshold = slow_threshold
+        self._slow_traces = collections.deque(maxlen=max_traces)
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def trace(self, name: str):
+        """Start a trace and make it current for the `with` block."""
+        trace = Trace(self, name)
+        token = _current_trace.set(trace)
+        try:
+            yield trace
+        finally:
+            _current_trace.reset(token)
+            trace.release()
+
+    def on_trace_finished(self, trace: Trace):
+        if trace.duration < self.slow_threshold:
+            return
+        with self._lock:
+            self._slow_traces.append(trace)
+        self._logger.info(
+            f"Slow {trace.name} ({trace.duration:.3f}s, trace {trace.trace_id}): "
+            + ", ".join(
+                f"{span['name']} {span['duration']:.3f}s"
+                for span in trace.to_dict()["spans"]
+            )
+        )
+
+    def slow_traces(self) -> List[Trace]:
+        """Recorded slow traces, the most recent first."""
+        with self._lock:
+            return list(reversed(self._slow_traces))
+
+    def clear(self):
+        with self._lock:
+            self._slow_traces.clear()
+
+    def to_dict(self) -> dict:
+        return {
+            "slow_threshold": self.slow_threshold,
+            "traces": [trace.to_dict() for trace in self.slow_traces()],
+        }
+
+    def to_otlp(self) -> dict:
+        """The slow traces as an OTLP/JSON `ExportTraceServiceRequest`."""
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            {
+                                "key": "service.name",
+                                "value": {"stringValue": "octoprint_psucontrol_meross"},
+                            }
+                        ]
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": __name__},
+                            "spans": [
+                                span
+                                for trace in self.slow_traces()
+                                for span in trace.to_otlp_spans()
+                            ],
+                        }
+                    ],
+                }
+            ]
+        }
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes):
+    """Record a span of the `with` block in the current trace (if there is one)."""
+    trace = _current_trace.get()
+    if trace is None:
+        yield None
+    else:
+        with trace.span(name, **attributes) as out:
+            yield out
+
+
+async def _run_in_trace(trace: Trace, awaitable: Awaitable, submitted_at: float):
+    _current_trace.set(trace)
+    trace.add_span("loop_wait", submitted_at, time.perf_counter())
+    return await awaitable
+
+
+def run_coroutine_threadsafe(coro, loop) -> Future:
+    """`asyncio.run_coroutine_threadsafe()` that carries the current trace over.
+
+    The time the coroutine spent waiting for the loop is recorded as a `loop_wait` span.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        return asyncio.run_coroutine_threadsafe(coro, loop)
+    future = asyncio.run_coroutine_threadsafe(
+        _run_in_trace(trace, coro, time.perf_counter()), loop
+    )
+    trace.attach(future)
+    return future
@@ -0,0 +1,445 @@
+"""Local stand-in for the Meross cloud (HTTP API + MQTT broker) with scripted smart plugs.
+
+Good enough for meross_iot to log in, discover the devices and switch them,
+so that the plugin can be benchmarked without the network (or a Meross account).
+"""
+
+import asyncio
+import dataclasses
+import hashlib
+import json
+import socket
+import ssl
+import struct
+import time
+
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+from aiohttp import web
+
+from octoprint_psucontrol_meross.threaded_worker import ThreadedWorker
+
+# Self-signed certificate (and its key) for CN=localhost, used by the MQTT broker
+CERT_FILE = Path(__file__).with_name("localhost.pem")
+
+USER_ID = "1000"
+USER_KEY = "benchmark-key"
+USER_EMAIL = "benchmark@example.com"
+USER_PASSWORD = "benchmark"
+
+PLUG_ABILITIES = {
+    "Appliance.System.All": {},
+    "Appliance.System.Ability": {},
+    "Appliance.System.Online": {},
+    "Appliance.Control.ToggleX": {},
+}
+
+
+@dataclasses.dataclass
+class FakeDevice:
+    """A single-channel smart plug."""
+
+    uuid: str
+    name: str
+    is_on: bool = False
+    online: bool = True  # As reported by the HTTP device list
+    responsive: bool = True  # False - never answers MQTT commands
+    latency: Optional[float] = None  # Overrides `FakeMerossCloud.mqtt_latency`
+    lan_reachable: bool = True  # False - the local HTTP endpoint fails every request
+    # Local HTTP endpoint (set by `FakeMerossCloud(lan=True)`)
+    lan_port: Optional[int] = None
+
+    @property
+    def dev_id(self) -> str:
+        """This plugin's ID of the device's (only) channel."""
+        return f"{self.uuid}::0"
+
+    def http_info(self, domain: str) -> dict:
+        return {
+            "uuid": self.uuid,
+            "onlineStatus": 1 if self.online else 2,
+            "devName": self.name,
+            "bindTime": 1600000000,
+            "deviceType": "mss310",
+            "subType": "un",
+            "channels": [{}],
+            "region": "eu",
+            "fmwareVersion": "2.1.4",
+            "hdwareVersion": "2.0.0",
+            "userDevIcon": "",
+            "iconType": 1,
+            "skillNumber": "",
+            "domain": domain,
+            "reservedDomain": domain,
+        }
+
+    def handle(self, method: str, namespace: str, payload: dict) -> Optional[dict]:
+        """Return the reply payload of a command (`None` for unsupported commands)."""
+        if (method, namespace) == ("GET", "Appliance.System.Ability"):
+            return {"ability": PLUG_ABILITIES}
+        elif (method, namespace) == ("GET", "Appliance.System.All"):
+            return {
+                "all": {
+                    "system": {
+                        "hardware": {
+                            "type": "mss310",
+                            "macAddress": "00:00:00:00:00:00",
+                        },
+                        "firmware": self.firmware(),
+                        "online": {"status": 1},
+                    },
+                    "digest": {"togglex": [self.togglex()]},
+                }
+            }
+        elif (method, namespace) == ("SET", "Appliance.Control.ToggleX"):
+            self.is_on = payload["togglex"]["onoff"] == 1
+            return {}
+        return None
+
+    def firmware(self) -> dict:
+        if self.lan_port is None:
+            return {}
+        # meross_iot puts the "IP" into `http://<innerIp>/config` as is
+        return {"innerIp": f"127.0.0.1:{self.lan_port}"}
+
+    def togglex(self) -> dict:
+        return {"channel": 0, "onoff": int(self.is_on), "lmTime": int(time.time())}
+
+
+def make_plugs(count: int, prefix: str = "plug") -> List[FakeDevice]:
+    return [
+        FakeDevice(
+            uuid=hashlib.md5(f"{prefix}{idx}".encode()).hexdigest(),
+            name=f"{prefix} {idx:03d}",
+        )
+        for idx in range(count)
+    ]
+
+
+def sign_header(message_id: str, timestamp: int) -> str:
+    return hashlib.md5(f"{message_id}{USER_KEY}{timestamp}".encode()).hexdigest()
+
+
+def _encode_remaining_length(length: int) -> bytes:
+    out = bytearray()
+    while True:
+        length, digit = divmod(length, 128)
+        out.append(digit | (0x80 if length else 0))
+        if not length:
+            return bytes(out)
+
+
+def _packet(first_byte: int, body: bytes) -> bytes:
+    return bytes([first_byte]) + _encode_remaining_length(len(body)) + body
+
+
+def _encode_str(value: str) -> bytes:
+    data = value.encode("utf8")
+    return struct.pack("!H", len(data)) + data
+
+
+def _decode_str(data: bytes, offset: int) -> Tuple[str, int]:
+    """Return (the string at `offset`, offset of the next field)."""
+    (length,) = struct.unpack_from("!H", data, offset)
+    (value,) = struct.unpack_from(f"!{length}s", data, offset + 2)
+    return (value.decode("utf8"), offset + 2 + length)
+
+
+class FakeMqttBroker:
+    """Bare-bones MQTT 3.1.1 broker (exact topic matches, QoS 0 delivery)."""
+
+    def __init__(self, cloud: "FakeMerossCloud"):
+        self.cloud = cloud
+        self.subscriptions: Dict[str, Set[asyncio.StreamWriter]] = {}
+
+    async def handle_client(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        try:
+            while True:
+                first_byte = (await reader.readexactly(1))[0]
+                length, multiplier = (0, 1)
+                while True:
+                    digit = (await reader.readexactly(1))[0]
+                    length += (digit & 0x7F) * multiplier
+                    multiplier *= 128
+                    if not digit & 0x80:
+                        break
+                body = await reader.readexactly(length)
+                if not self._handle_packet(writer, first_byte, body):
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ssl.SSLError):
+            pass
+        finally:
+            for writers in self.subscriptions.values():
+                writers.discard(writer)
+            writer.close()
+
+    def _handle_packet(self, writer, first_byte: int, body: bytes) -> bool:
+        packet_type = first_byte >> 4
+        if packet_type == 1:  # CONNECT
+            writer.write(_packet(0x20, b"\x00\x00"))
+        elif packet_type == 3:  # PUBLISH
+            qos = (first_byte >> 1) & 0x03
+            topic, offset = _decode_str(body, 0)
+            if qos:
+                (packet_id,) = struct.unpack_from("!H", body, offset)
+                writer.write(_packet(0x40, struct.pack("!H", packet_id)))  # PUBACK
+                offset += 2
+            self.cloud.on_publish(topic, body[offset:])
+        elif packet_type == 8:  # SUBSCRIBE
+            (packet_id,) = struct.unpack_from("!H", body)
+            offset, granted = (2, bytearray())
+            while offset < len(body):
+                topic, offset = _decode_str(body, offset)
+                granted.append(min(body[offset], 1))
+                offset += 1
+                self.subscriptions.setdefault(topic, set()).add(writer)
+            writer.write(_packet(0x90, struct.pack("!H", packet_id) + bytes(granted)))
+        elif packet_type == 10:  # UNSUBSCRIBE
+            writer.write(_packet(0xB0, body[:2]))
+        elif packet_type == 12:  # PINGREQ
+            writer.write(_packet(0xD0, b""))
+        elif packet_type == 14:  # DISCONNECT
+            return False
+        return True
+
+    def publish(self, topic: str, payload: bytes):
+        packet = _packet(0x30, _encode_str(topic) + payload)
+        for writer in tuple(self.subscriptions.get(topic, ())):
+            writer.write(packet)
+
+
+class FakeMerossCloud:
+    """Meross HTTP API + MQTT broker running on localhost (in its own thread).
+
+    `http_latency` and `mqtt_latency` (seconds) delay every HTTP response
+    and every device reply respectively.
+    With `lan=True` every device also listens on its own local HTTP
+    endpoint (replying after `lan_latency` seconds), like real plugs do.
+    """
+
+    def __init__(
+        self,
+        devices: List[FakeDevice],
+        http_latency: float = 0,
+        mqtt_latency: float = 0,
+        push_updates: bool = True,
+        lan: bool = False,
+        lan_latency: float = 0,
+    ):
+        self.devices = {device.uuid: device for device in devices}
+        self.http_latency = http_latency
+        self.mqtt_latency = mqtt_latency
+        # Send a PUSH notification after each state change
+        self.push_updates = push_updates
+        self.lan = lan
+        self.lan_latency = lan_latency
+        self.http_requests: Dict[str, int] = {}
+        self.mqtt_commands: Dict[str, int] = {}
+        self.lan_commands: Dict[str, int] = {}
+        self.broker = FakeMqttBroker(self)
+        self._worker = None
+        self._runner = None
+        self._lan_runners = []
+        self._mqtt_server = None
+        self.http_port = self.mqtt_port = None
+
+    @property
+    def api_base_url(self) -> str:
+        return f"http://127.0.0.1:{self.http_port}"
+
+    @property
+    def manager_kwargs(self) -> dict:
+        """`MerossManager` arguments pointing it to this broker."""
+        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        ssl_context.load_verify_locations(CERT_FILE)
+        return {
+            "mqtt_override_server": ("localhost", self.mqtt_port),
+            "mqtt_ssl_context": ssl_context,
+        }
+
+    def start(self) -> "FakeMerossCloud":
+        self._worker = ThreadedWorker()
+        asyncio.run_coroutine_threadsafe(self._start(), self._worker.loop).result()
+        return self
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._stop(), self._worker.loop).result()
+        self._worker.loop.call_soon_threadsafe(self._worker.loop.stop)
+
+    def __enter__(self) -> "FakeMerossCloud":
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    async def _start(self):
+        app = web.Application()
+        app.router.add_post("/v1/Auth/signIn", self._http_sign_in)
+        app.router.add_post("/v1/log/user", self._http_empty)
+        app.router.add_post("/v1/Profile/logout", self._http_empty)
+        app.router.add_post("/v1/Device/devList", self._http_dev_list)
+        app.router.add_post("/v1/Hub/getSubDevices", self._http_sub_devices)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        http_sock = socket.socket()
+        http_sock.bind(("127.0.0.1", 0))
+        self.http_port = http_sock.getsockname()[1]
+        await web.SockSite(self._runner, http_sock).start()
+
+        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ssl_context.load_cert_chain(CERT_FILE)
+        self._mqtt_server = await asyncio.start_server(
+            self.broker.handle_client, "127.0.0.1", 0, ssl=ssl_context
+        )
+        self.mqtt_port = self._mqtt_server.sockets[0].getsockname()[1]
+
+        if self.lan:
+            for device in self.devices.values():
+                device.lan_port = await self._start_lan_endpoint(device)
+
+    async def _start_lan_endpoint(self, device: FakeDevice) -> int:
+        async def _config(request):
+            return await self._lan_config(device, request)
+
+        app = web.Application()
+        app.router.add_post("/config", _config)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        self._lan_runners.append(runner)
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        await web.SockSite(runner, sock).start()
+        return sock.getsockname()[1]
+
+    async def _stop(self):
+        self._mqtt_server.close()
+        await self._runner.cleanup()
+        for runner in self._lan_runners:
+            await runner.cleanup()
+        tasks = [el for el in asyncio.all_tasks() if el is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _http_reply(self, request: web.Request, data) -> web.Response:
+        self.http_requests[request.path] = self.http_requests.get(request.path, 0) + 1
+        if self.http_latency:
+            await asyncio.sleep(self.http_latency)
+        return web.json_response({"apiStatus": 0, "info": "Success", "data": data})
+
+    async def _http_sign_in(self, request):
+        return await self._http_reply(
+            request,
+            {
+                "token": "benchmark-token",
+                "key": USER_KEY,
+                "userid": USER_ID,
+                "email": USER_EMAIL,
+                "domain": self.api_base_url,
+                "mqttDomain": "localhost",
+            },
+        )
+
+    async def _http_empty(self, request):
+        return await self._http_reply(request, {})
+
+    async def _http_dev_list(self, request):
+        domain = f"localhost:{self.mqtt_port}"
+        return await self._http_reply(
+            request, [device.http_info(domain) for device in self.devices.values()]
+        )
+
+    async def _http_sub_devices(self, request):
+        return await self._http_reply(request, [])
+
+    def on_publish(self, topic: str, payload: bytes):
+        """Route a message published by a client to the device it is addressed to."""
+        parts = topic.split("/")
+        if len(parts) != 4 or parts[1] != "appliance" or parts[3] != "subscribe":
+            return
+        device = self.devices.get(parts[2])
+        if device is None or not device.responsive:
+            return
+        message = json.loads(payload)
+        header = message["header"]
+        self.mqtt_commands[header["namespace"]] = (
+            self.mqtt_commands.get(header["namespace"], 0) + 1
+        )
+        asyncio.ensure_future(self._reply(device, header, message.get("payload") or {}))
+
+    async def _reply(self, device: FakeDevice, header: dict, payload: dict):
+        latency = self.mqtt_latency if device.latency is None else device.latency
+        if latency:
+            await asyncio.sleep(latency)
+        self.broker.publish(header["from"], self._handle(device, header, payload))
+
+    async def _lan_config(self, device: FakeDevice, request: web.Request):
+        """The device's local `POST /config` endpoint."""
+        if not device.lan_reachable:
+            raise web.HTTPServiceUnavailable()
+        message = json.loads(await request.read())
+        header = message["header"]
+        self.lan_commands[header["namespace"]] = (
+            self.lan_commands.get(header["namespace"], 0) + 1
+        )
+        if self.lan_latency:
+            await asyncio.sleep(self.lan_latency)
+        return web.Response(
+            body=self._handle(device, header, message.get("payload") or {}),
+            content_type="application/json",
+        )
+
+    def _handle(self, device: FakeDevice, header: dict, payload: dict) -> bytes:
+        """Execute a command, return the reply message."""
+        reply = device.handle(header["method"], header["namespace"], payload)
+        if reply is None:
+            method, reply = ("ERROR", {"error": {"code": 5000}})
+        else:
+            method = f"{header['method']}ACK"
+        if self.push_updates and header["namespace"] == "Appliance.Control.ToggleX":
+            asyncio.get_running_loop().call_soon(self.push, device)
+        return self._message(
+            device, header["messageId"], method, header["namespace"], reply
+        )
+
+    def push(self, device: FakeDevice):
+        """Send a ToggleX PUSH notification with the current device state."""
+        message_id = hashlib.md5(f"{device.uuid}{time.time()}".encode()).hexdigest()
+        self.broker.publish(
+            f"/app/{USER_ID}/subscribe",
+            self._message(
+                device,
+                message_id,
+                "PUSH",
+                "Appliance.Control.ToggleX",
+                {"togglex": [device.togglex()]},
+            ),
+        )
+
+    def _message(
+        self,
+        device: FakeDevice,
+        message_id: str,
+        method: str,
+        namespace: str,
+        payload: dict,
+    ) -> bytes:
+        timestamp = int(time.time())
+        return json.dumps(
+            {
+                "header": {
+                    "from": f"/appliance/{device.uuid}/publish",
+                    "messageId": message_id,
+                    "method": method,
+                    "namespace": namespace,
+                    "payloadVersion": 1,
+                    "sign": sign_header(message_id, timestamp),
+                    "timestamp": timestamp,
+                    "uuid": device.uuid,
+                },
+                "payload": payload,
+            }
+        ).encode("utf8")
@@ -0,0 +1,484 @@
+"""Offline benchmark of the plugin against `FakeMerossCloud`.
+
+    python test/benchmark/run_benchmark.py [--baseline test/benchmark/baseline.json]
+
+Prints p50/p95/p99 latencies and throughput of every scenario, optionally
+writing them to a JSON file (`--output`, `--save-baseline`). With `--baseline`
+the exit code is 1 if any scenario got slower than the baseline allows.
+`--compare-loops` runs the scenarios once per installed event loop implementation.
+"""
+
+import argparse
+import asyncio
+import dataclasses
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+from typing import Callable, Dict, List, Sequence
+
+from fake_meross_cloud import FakeMerossCloud, make_plugs, USER_EMAIL, USER_PASSWORD
+
+from octoprint_psucontrol_meross import meross_client
+from octoprint_psucontrol_meross.plugin import PSUControlMeross
+from octoprint_psucontrol_meross.threaded_worker import (
+    EVENT_LOOP_ASYNCIO,
+    EVENT_LOOP_AUTO,
+    EVENT_LOOP_UVLOOP,
+    get_loop_factory,
+)
+
+DEFAULT_BASELINE = Path(__file__).with_name("baseline.json")
+# Allowed slowdown (relative to the baseline) before a scenario counts as a regression
+DEFAULT_TOLERANCE = 1.0
+# Latency increase (in ms) that is always tolerated, sub-millisecond percentiles are mostly noise
+LATENCY_SLACK_MS = 1.0
+# Max time to wait for a state change to become visible via `get_psu_state()`
+SWITCH_TIMEOUT = 30
+
+
+class BenchmarkSettings:
+    """Stand-in for the OctoPrint plugin settings."""
+
+    def __init__(self, values: dict):
+        self.values = values
+
+    def get(self, path):
+        return self.values.get(path[0])
+
+    def get_int(self, path):
+        return int(self.values[path[0]])
+
+    def get_boolean(self, path):
+        return bool(self.values[path[0]])
+
+
+class BenchmarkPluginManager:
+    def get_helpers(self, name):
+        if name == "psucontrol":
+            return {"register_plugin": lambda plugin: None}
+        return None
+
+
+class BenchmarkPSUControlMeross(PSUControlMeross):
+    """The plugin, wired to a `FakeMerossCloud` outside of OctoPrint."""
+
+    event_loop = EVENT_LOOP_AUTO  # Worker loop implementation (`--loop`)
+
+    def __init__(
+        self, cloud: FakeMerossCloud, data_folder, target_device_ids: Sequence[str]
+    ):
+        super().__init__()
+        self.cloud = cloud
+        self._data_folder = str(data_folder)
+        self._logger = logging.getLogger("octoprint.plugins.psucontrol_meross")
+        self._plugin_manager = BenchmarkPluginManager()
+        self._settings = BenchmarkSettings(
+            {
+                "api_base_url": cloud.api_base_url,
+                "user_email": USER_EMAIL,
+                "user_password": USER_PASSWORD,
+                "target_device_ids": list(target_device_ids),
+                "state_max_age": meross_client.DEFAULT_STATE_MAX_AGE,
+                "lan_control": cloud.lan,
+                "event_loop": self.event_loop,
+            }
+        )
+
+    def initialize(self):
+        data_folder = Path(self.get_plugin_data_folder())
+        self.meross = meross_client.OctoprintPsuMerossClient(
+            cache_file=data_folder / "meross_cloud.sqlite3",
+            logger=self._logger.getChild("meross_client"),
+            manager_kwargs=self.cloud.manager_kwargs,
+            lan_control=self._settings.get_boolean(["lan_control"]),
+            event_loop=self._settings.get(["event_loop"]),
+        )
+
+    def start(self) -> "BenchmarkPSUControlMeross":
+        """Go through the OctoPrint startup sequence and wait for the warm-up."""
+        self.initialize()
+        self.on_settings_initialized()
+        self.on_startup("localhost", 5000)
+        self._start_warm_up().result()
+        return self
+
+    def stop(self):
+        """Disconnect from the broker and stop the worker loop (OctoPrint's shutdown)."""
+        self.on_shutdown()
+
+    def wait_for_state(self, is_on: bool):
+        deadline = time.monotonic() + SWITCH_TIMEOUT
+        while self.get_psu_state() != is_on:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"PSU did not switch {'on' if is_on else 'off'}")
+            time.sleep(0.001)
+
+
+def _timed(fn: Callable[[], object]) -> float:
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def scenario_cold_start(iterations: int, cloud_options: dict) -> List[float]:
+    """Startup with an empty cache until the first `get_psu_state()` answer."""
+    devices = make_plugs(1)
+    samples = []
+    with FakeMerossCloud(devices, **cloud_options) as cloud:
+        for _ in range(iterations):
+            with tempfile.TemporaryDirectory() as data_folder:
+                plugin = BenchmarkPSUControlMeross(
+                    cloud, data_folder, [devices[0].dev_id]
+                )
+                samples.append(_timed(lambda: plugin.start().get_psu_state()))
+                plugin.stop()
+    return samples
+
+
+def scenario_restart(iterations: int, cloud_options: dict) -> List[float]:
+    """Same as `cold_start`, but with the session and device inventory of the previous run."""
+    devices = make_plugs(1)
+    samples = []
+    with FakeMerossCloud(
+        devices, **cloud_options
+    ) as cloud, tempfile.TemporaryDirectory() as data_folder:
+        BenchmarkPSUControlMeross(
+            cloud, data_folder, [devices[0].dev_id]
+        ).start().stop()
+        for _ in range(iterations):
+            plugin = BenchmarkPSUControlMeross(cloud, data_folder, [devices[0].dev_id])
+            samples.append(_timed(lambda: plugin.start().get_psu_state()))
+            plugin.stop()
+    return samples
+
+
+def scenario_warm_polling(iterations: int, cloud_options: dict) -> List[float]:
+    """PSUControl polling `get_psu_state()` of a warmed up plugin."""
+    devices = make_plugs(1)
+    with FakeMerossCloud(
+        devices, **cloud_options
+    ) as cloud, tempfile.TemporaryDirectory() as data_folder:
+        plugin = BenchmarkPSUControlMeross(
+            cloud, data_folder, [devices[0].dev_id]
+        ).start()
+        try:
+            return [_timed(plugin.get_psu_state) for _ in range(iterations)]
+        finally:
+            plugin.stop()
+
+
+def scenario_loop_roundtrip(iterations: int, cloud_options: dict) -> List[float]:
+    """Round trips of an empty coroutine from a caller thread through the worker loop."""
+    devices = make_plugs(1)
+    with FakeMerossCloud(
+        devices, **cloud_options
+    ) as cloud, tempfile.TemporaryDirectory() as data_folder:
+        plugin = BenchmarkPSUControlMeross(
+            cloud, data_folder, [devices[0].dev_id]
+        ).start()
+        loop = plugin.meross.worker.loop
+        try:
+            return [
+                _timed(
+                    lambda: asyncio.run_coroutine_threadsafe(
+                        asyncio.sleep(0), loop
+                    ).result()
+                )
+                for _ in range(iterations)
+            ]
+        finally:
+            plugin.stop()
+
+
+def _switch_samples(plugin: BenchmarkPSUControlMeross, iterations: int) -> List[float]:
+    """Switch the PSU on/off until `get_psu_state()` reports the new state."""
+    samples = []
+    for idx in range(iterations):
+        if idx % 2:
+            samples.append(
+                _timed(lambda: (plugin.turn_psu_off(), plugin.wait_for_state(False)))
+            )
+        else:
+            samples.append(
+                _timed(lambda: (plugin.turn_psu_on(), plugin.wait_for_state(True)))
+            )
+    return samples
+
+
+def scenario_group_switch_50(iterations: int, cloud_options: dict) -> List[float]:
+    """Switch a group of 50 plugs on/off until `get_psu_state()` reports the new state."""
+    devices = make_plugs(50)
+    with FakeMerossCloud(
+        devices, **cloud_options
+    ) as cloud, tempfile.TemporaryDirectory() as data_folder:
+        plugin = BenchmarkPSUControlMeross(
+            cloud, data_folder, [el.dev_id for el in devices]
+        ).start()
+        try:
+            return _switch_samples(plugin, iterations)
+        finally:
+            plugin.stop()
+
+
+def scenario_lan_switch(iterations: int, cloud_options: dict) -> List[float]:
+    """Switch a plug on/off over its local HTTP endpoint (LAN control)."""
+    devices = make_plugs(1)
+    with FakeMerossCloud(
+        devices, lan=True, **cloud_options
+    ) as cloud, tempfile.TemporaryDirectory() as data_folder:
+        plugin = BenchmarkPSUControlMeross(
+            cloud, data_folder, [devices[0].dev_id]
+        ).start()
+        try:
+            return _switch_samples(plugin, iterations)
+        finally:
+            plugin.stop()
+
+
+def scenario_discovery_timeout(iterations: int, cloud_options: dict) -> List[float]:
+    """Startup when one of the account's devices is listed online but never answers."""
+    devices = make_plugs(2)
+    devices[1].responsive = False
+    samples = []
+    with FakeMerossCloud(devices, **cloud_options) as cloud:
+        for _ in range(iterations):
+            with tempfile.TemporaryDirectory() as data_folder:
+                plugin = BenchmarkPSUControlMeross(
+                    cloud, data_folder, [devices[0].dev_id]
+                )
+                samples.append(_timed(lambda: plugin.start().get_psu_state()))
+                plugin.stop()
+    return samples
+
+
+@dataclasses.dataclass
+class Scenario:
+    name: str
+    run: Callable[[int, dict], List[float]]
+    iterations: int
+    quick_iterations: int  # For `--quick` (smoke test) runs
+
+
+SCENARIOS = {
+    el.name: el
+    for el in (
+        Scenario("cold_start", scenario_cold_start, iterations=10, quick_iterations=1),
+        Scenario("restart", scenario_restart, iterations=10, quick_iterations=1),
+        Scenario(
+            "warm_polling", scenario_warm_polling, iterations=2000, quick_iterations=10
+        ),
+        Scenario(
+            "loop_roundtrip",
+            scenario_loop_roundtrip,
+            iterations=5000,
+            quick_iterations=10,
+        ),
+        Scenario(
+            "group_switch_50",
+            scenario_group_switch_50,
+            iterations=20,
+            quick_iterations=2,
+        ),
+        Scenario("lan_switch", scenario_lan_switch, iterations=50, quick_iterations=2),
+        Scenario(
+            "discovery_timeout",
+            scenario_discovery_timeout,
+            iterations=2,
+            quick_iterations=1,
+        ),
+    )
+}
+
+
+def percentile(sorted_samples: Sequence[float], pct: float) -> float:
+    """Linearly interpolated percentile (`statistics.quantiles()` needs python 3.8)."""
+    pos = (len(sorted_samples) - 1) * pct / 100
+    low = int(pos)
+    high = min(low + 1, len(sorted_samples) - 1)
+    return sorted_samples[low] + (sorted_samples[high] - sorted_samples[low]) * (
+        pos - low
+    )
+
+
+def summarise(samples: Sequence[float]) -> Dict[str, float]:
+    """Latency percentiles (in milliseconds) and throughput (operations per second)."""
+    sorted_samples = sorted(samples)
+    return {
+        "n": len(samples),
+        "p50_ms": percentile(sorted_samples, 50) * 1000,
+        "p95_ms": percentile(sorted_samples, 95) * 1000,
+        "p99_ms": percentile(sorted_samples, 99) * 1000,
+        "throughput_per_s": len(samples) / sum(samples),
+    }
+
+
+def run_scenarios(
+    names: Sequence[str],
+    cloud_options: dict,
+    quick: bool = False,
+    event_loop: str = EVENT_LOOP_AUTO,
+) -> dict:
+    BenchmarkPSUControlMeross.event_loop = event_loop
+    results = {}
+    for name in names:
+        scenario = SCENARIOS[name]
+        iterations = scenario.quick_iterations if quick else scenario.iterations
+        results[name] = summarise(scenario.run(iterations, cloud_options))
+    return {
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "cloud_options": cloud_options,
+            "event_loop": get_loop_factory(event_loop)[0],
+        },
+        "scenarios": results,
+    }
+
+
+def compare_loops(
+    names: Sequence[str], cloud_options: dict, quick: bool = False
+) -> Dict[str, dict]:
+    """{loop implementation: `run_scenarios()` results} of the installed implementations."""
+    out = {}
+    for event_loop in (EVENT_LOOP_ASYNCIO, EVENT_LOOP_UVLOOP):
+        if get_loop_factory(event_loop)[0] != event_loop:
+            print(f"{event_loop} is not installed, skipped.")
+            continue
+        out[event_loop] = run_scenarios(names, cloud_options, quick, event_loop)
+    return out
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    """Return descriptions of the metrics that regressed compared to the baseline."""
+    regressions = []
+    for name, stats in results["scenarios"].items():
+        base_stats = baseline["scenarios"].get(name)
+        if base_stats is None:
+            continue
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            if stats[key] > max(
+                base_stats[key] * (1 + tolerance), base_stats[key] + LATENCY_SLACK_MS
+            ):
+                regressions.append(
+                    f"{name}.{key}: {stats[key]:.2f} > {base_stats[key]:.2f}"
+                )
+        if stats["throughput_per_s"] < base_stats["throughput_per_s"] / (1 + tolerance):
+            regressions.append(
+                f"{name}.throughput_per_s: {stats['throughput_per_s']:.2f} < {base_stats['throughput_per_s']:.2f}"
+            )
+    return regressions
+
+
+def print_results(results: dict):
+    print(f"event loop: {results['environment']['event_loop']}")
+    print(
+        f"{'scenario':20} {'n':>6} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} {'ops/s':>10}"
+    )
+    for name, stats in results["scenarios"].items():
+        print(
+            f"{name:20} {stats['n']:>6} {stats['p50_ms']:>10.2f} {stats['p95_ms']:>10.2f} "
+            f"{stats['p99_ms']:>10.2f} {stats['throughput_per_s']:>10.2f}"
+        )
+
+
+def get_argument_parser():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        choices=sorted(SCENARIOS),
+        help="Scenario to run (can be repeated, defaults to all of them)",
+    )
+    parser.add_argument(
+        "--http-latency",
+        type=float,
+        default=0.02,
+        help="Fake HTTP API latency (seconds)",
+    )
+    parser.add_argument(
+        "--mqtt-latency",
+        type=float,
+        default=0.01,
+        help="Fake device reply latency (seconds)",
+    )
+    parser.add_argument(
+        "--quick",
+        action="store_true",
+        help="Run a single iteration or so of each scenario",
+    )
+    parser.add_argument(
+        "--loop",
+        choices=[EVENT_LOOP_AUTO, EVENT_LOOP_ASYNCIO, EVENT_LOOP_UVLOOP],
+        default=EVENT_LOOP_AUTO,
+        help="Worker event loop implementation",
+    )
+    parser.add_argument(
+        "--compare-loops",
+        action="store_true",
+        help="Run the scenarios with each installed event loop (no baseline checks)",
+    )
+    parser.add_argument(
+        "--output", type=Path, help="Write the results to this JSON file"
+    )
+    parser.add_argument(
+        "--baseline",
+        type=Path,
+        nargs="?",
+        const=DEFAULT_BASELINE,
+        help=f"Compare the results to this JSON file (defaults to {DEFAULT_BASELINE.name})",
+    )
+    parser.add_argument(
+        "--save-baseline", type=Path, help="Write the results as a new baseline"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=DEFAULT_TOLERANCE,
+        help="Allowed relative slowdown before a metric counts as a regression",
+    )
+    return parser
+
+
+def main(args) -> int:
+    names = args.scenario or list(SCENARIOS)
+    cloud_options = {
+        "http_latency": args.http_latency,
+        "mqtt_latency": args.mqtt_latency,
+    }
+    if args.compare_loops:
+        by_loop = compare_loops(names, cloud_options, quick=args.quick)
+        for results in by_loop.values():
+            print_results(results)
+        if args.output:
+            args.output.write_text(json.dumps(by_loop, indent=2, sort_keys=True))
+        return 0
+    results = run_scenarios(
+        names, cloud_options, quick=args.quick, event_loop=args.loop
+    )
+    print_results(results)
+    for fname in (args.output, args.save_baseline):
+        if fname:
+            fname.write_text(json.dumps(results, indent=2, sort_keys=True))
+    if args.baseline:
+        regressions = compare(
+            results, json.loads(args.baseline.read_text()), args.tolerance
+        )
+        for el in regressions:
+            print(f"REGRESSION {el}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.ERROR)
+    # Expected timeouts of the `discovery_timeout` scenario
+    logging.getLogger("meross_iot").setLevel(logging.CRITICAL)
+    sys.exit(main(get_argument_parser().parse_args()))
@@ -0,0 +1,98 @@
+import pytest
+import run_benchmark
+
+
+def test_summarise():
+    stats = run_benchmark.summarise([0.004, 0.001, 0.002, 0.003])
+    assert stats["n"] == 4
+    assert stats["p50_ms"] == pytest.approx(2.5)
+    assert stats["p99_ms"] == pytest.approx(3.97)
+    assert stats["throughput_per_s"] == pytest.approx(400)
+
+
+def test_compare():
+    baseline = {
+        "scenarios": {
+            "fast": {
+                "p50_ms": 0.01,
+                "p95_ms": 0.02,
+                "p99_ms": 0.03,
+                "throughput_per_s": 100,
+            },
+            "slow": {
+                "p50_ms": 100,
+                "p95_ms": 200,
+                "p99_ms": 300,
+                "throughput_per_s": 10,
+            },
+        }
+    }
+    results = {
+        "scenarios": {
+            # Within the absolute slack
+            "fast": {
+                "p50_ms": 0.5,
+                "p95_ms": 0.5,
+                "p99_ms": 0.5,
+                "throughput_per_s": 100,
+            },
+            "slow": {
+                "p50_ms": 250,
+                "p95_ms": 300,
+                "p99_ms": 400,
+                "throughput_per_s": 4,
+            },
+            "new": {"p50_ms": 1, "p95_ms": 1, "p99_ms": 1, "throughput_per_s": 1},
+        }
+    }
+    regressions = run_benchmark.compare(results, baseline, tolerance=1.0)
+    assert [el.split(":")[0] for el in regressions] == [
+        "slow.p50_ms",
+        "slow.throughput_per_s",
+    ]
+
+
+def test_quick_run():
+    """All scenarios (bar the slow `discovery_timeout`) work against the fake cloud."""
+    names = [
+        "cold_start",
+        "restart",
+        "warm_polling",
+        "loop_roundtrip",
+        "group_switch_50",
+    ]
+    results = run_benchmark.run_scenarios(
+        names, {"http_latency": 0, "mqtt_latency": 0}, quick=True
+    )
+    assert sorted(results["scenarios"]) == sorted(names)
+    for stats in results["scenarios"].values():
+        assert stats["n"] > 0
+        assert stats["p99_ms"] >= stats["p50_ms"] > 0
+
+
+def test_lan_transport(tmp_path):
+    """Commands go over the local HTTP endpoint, the cloud is the fallback."""
+    devices = run_benchmark.make_plugs(1)
+    with run_benchmark.FakeMerossCloud(devices, lan=True) as cloud:
+        plugin = run_benchmark.BenchmarkPSUControlMeross(
+            cloud, tmp_path, [devices[0].dev_id]
+        ).start()
+        try:
+            plugin.turn_psu_on()
+            plugin.wait_for_state(True)
+            assert devices[0].is_on
+            assert cloud.lan_commands["Appliance.Control.ToggleX"] == 1
+            assert "Appliance.Control.ToggleX" not in cloud.mqtt_commands
+
+            devices[0].lan_reachable = False
+            plugin.turn_psu_off()
+            plugin.wait_for_state(False)
+            assert not devices[0].is_on
+            assert cloud.mqtt_commands["Appliance.Control.ToggleX"] == 1
+
+            stats = plugin.meross.transport_stats()[devices[0].uuid]
+            assert stats["lan"]["failures"] == 1
+            assert stats["lan"]["successes"] >= 1
+            assert stats["cloud"]["successes"] >= 1
+        finally:
+            plugin.stop()
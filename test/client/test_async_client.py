@@ -1,4 +1,7 @@
+import asyncio
+import concurrent.futures
 import logging
+import time
 import unittest.mock
 
 import asyncmock
@@ -6,7 +9,14 @@ import meross_iot.http_api
 import pytest
 import pytest_asyncio
 
+from meross_iot.device_factory import build_meross_device_from_abilities
+from meross_iot.model.enums import Namespace as MerossEvtNamespace, OnlineStatus
+from meross_iot.model.http.device import HttpDeviceInfo
+from meross_iot.model.push.generic import GenericPushNotification
+
 from octoprint_psucontrol_meross import meross_client
+from octoprint_psucontrol_meross.cache import MerossCache
+from octoprint_psucontrol_meross.device_state import StateSource
 
 
 @pytest.fixture
@@ -21,7 +31,11 @@ def cache_file(tmp_path):
 
 @pytest.fixture
 def mock_meross_cache_cls(mocker):
-    return mocker.patch.object(meross_client, "MerossCache")
+    out = mocker.patch.object(meross_client, "MerossCache")
+    out.return_value.run_in_executor = mocker.AsyncMock(
+        side_effect=lambda fn, *args, **kwargs: fn(*args, **kwargs)
+    )
+    return out
 
 
 @pytest.fixture
@@ -44,21 +58,43 @@ async def mock_meross_iot_http_client():
 async def test_client(
     tmp_path, logger, mock_meross_cache_cls, mock_meross_iot_http_client
 ):
+    meross_client.import_meross_iot()
     return meross_client._OctoprintPsuMerossClientAsync(tmp_path, logger)
 
 
-#@pytest.mark.asyncio
-#async def test_login(test_client, mock_meross_iot_http_client, mock_meross_cache):
+@pytest.fixture
+def plug(mocker):
+    info = HttpDeviceInfo(
+        uuid="plug-uuid",
+        online_status=OnlineStatus.ONLINE,
+        dev_name="Printer",
+        device_type="mss310",
+        channels=[{}],
+        fmware_version="1",
+        hdware_version="1",
+        domain="mqtt.example.com",
+        reserved_domain="mqtt.example.com",
+    )
+    return build_meross_device_from_abilities(
+        info,
+        {"Appliance.System.All": {}, "Appliance.Control.ToggleX": {}},
+        mocker.MagicMock(),
+    )
+
+
+# @pytest.mark.asyncio
+# async def test_login(test_client, mock_meross_iot_http_client, mock_meross_cache):
 #    mock_meross_cache.get_cloud_session_token.return_value = None
 #    await test_client.login("api_url", "testuser", "password", raise_exc=True)
 
-    # Argumente aus dem Mock-Aufruf abrufen
+# Argumente aus dem Mock-Aufruf abrufen
 #    args, kwargs = mock_meross_iot_http_client.async_from_user_password.call_args
-    # api_base_url aus den Keyword-Argumenten abrufen
+# api_base_url aus den Keyword-Argumenten abrufen
 #    api_base_url = kwargs.get('api_base_url')
 
 #    assert api_base_url == "https://api_url"
 
+
 class TestLogout:
     @pytest_asyncio.fixture
     def test_client(self, test_client, mock_meross_iot_http_client):
@@ -70,3 +106,539 @@ class TestLogout:
     async def test_logout(self, test_client, mock_meross_iot_http_client):
         await test_client.logout()
         mock_meross_iot_http_client.async_logout.assert_called_once_with()
+
+
+class TestPushStateUpdates:
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize(
+        "namespace, raw_data, expected",
+        [
+            (
+                MerossEvtNamespace.CONTROL_TOGGLEX,
+                {"togglex": {"channel": 0, "onoff": 1}},
+                True,
+            ),
+            (
+                MerossEvtNamespace.SYSTEM_ALL,
+                {"all": {"digest": {"togglex": [{"channel": 0, "onoff": 0}]}}},
+                False,
+            ),
+        ],
+    )
+    async def test_togglex(self, test_client, namespace, raw_data, expected):
+        evt = GenericPushNotification(namespace, "dev-uuid", raw_data)
+        await test_client._on_manager_event(evt, [], None)
+        state = test_client.state_table.get("dev-uuid::0")
+        assert state.is_on is expected
+        assert state.source is StateSource.PUSH
+
+    @pytest.mark.asyncio
+    async def test_offline(self, test_client):
+        test_client.state_table.update("dev-uuid", 0, True, StateSource.POLL)
+        evt = GenericPushNotification(
+            MerossEvtNamespace.SYSTEM_ONLINE,
+            "dev-uuid",
+            {"online": {"status": OnlineStatus.OFFLINE.value}},
+        )
+        await test_client._on_manager_event(evt, [], None)
+        assert test_client.state_table.get("dev-uuid::0") is None
+
+
+class TestDeviceRegistryUpdates:
+    @pytest.fixture
+    def known_device(self, mocker, test_client):
+        device = mocker.Mock(uuid="dev-uuid", online_status=OnlineStatus.ONLINE)
+        test_client.device_registry.sync([device])
+        return device
+
+    @pytest.fixture
+    def discovery_flush(self, mocker, test_client):
+        return mocker.patch.object(test_client.async_device_discovery, "flush")
+
+    @pytest.mark.asyncio
+    async def test_known_device_toggle(
+        self, test_client, known_device, discovery_flush
+    ):
+        evt = GenericPushNotification(
+            MerossEvtNamespace.CONTROL_TOGGLEX,
+            "dev-uuid",
+            {"togglex": {"channel": 0, "onoff": 1}},
+        )
+        await test_client._on_manager_event(evt, [], None)
+        assert not discovery_flush.called
+        assert test_client.device_registry.device_version("dev-uuid") == 1
+
+    @pytest.mark.asyncio
+    async def test_unknown_device(self, test_client, known_device, discovery_flush):
+        evt = GenericPushNotification(
+            MerossEvtNamespace.CONTROL_TOGGLEX,
+            "other-uuid",
+            {"togglex": {"channel": 0, "onoff": 1}},
+        )
+        await test_client._on_manager_event(evt, [], None)
+        discovery_flush.assert_called_once_with()
+
+    @pytest.mark.asyncio
+    async def test_known_device_offline(
+        self, test_client, known_device, discovery_flush
+    ):
+        evt = GenericPushNotification(
+            MerossEvtNamespace.SYSTEM_ONLINE,
+            "dev-uuid",
+            {"online": {"status": OnlineStatus.OFFLINE.value}},
+        )
+        await test_client._on_manager_event(evt, [], None)
+        assert not discovery_flush.called
+        assert test_client.device_registry.online_status("dev-uuid") is (
+            OnlineStatus.OFFLINE
+        )
+        assert test_client.device_registry.device_version("dev-uuid") == 2
+
+
+class TestInventorySnapshot:
+    """The device inventory is persisted and restored on the next login."""
+
+    @pytest.fixture
+    def meross_cache(self, tmp_path, logger):
+        return MerossCache(tmp_path / "cache.sqlite3", logger=logger)
+
+    @pytest.fixture
+    def discovery_done(self):
+        return asyncio.Event()
+
+    @pytest.fixture
+    def mock_manager_cls(self, mocker, discovery_done):
+        manager = mocker.MagicMock(name="mock_manager")
+        manager.async_init = mocker.AsyncMock()
+        manager.async_execute_cmd = mocker.AsyncMock(
+            return_value={
+                "all": {
+                    "system": {"online": {"status": 1}},
+                    "digest": {"togglex": [{"channel": 0, "onoff": 0}]},
+                }
+            }
+        )
+
+        async def _slow_discovery():
+            # Simulates a slow cloud, never completes unless released
+            await discovery_done.wait()
+            return []
+
+        manager.async_device_discovery.side_effect = _slow_discovery
+        return mocker.patch.object(meross_client, "MerossManager", return_value=manager)
+
+    @pytest.fixture
+    def make_client(
+        self,
+        tmp_path,
+        logger,
+        meross_cache,
+        mock_meross_cache_cls,
+        mock_meross_iot_http_client,
+    ):
+        mock_meross_iot_http_client.cloud_credentials = {"token": "tok"}
+
+        def _make_client():
+            out = meross_client._OctoprintPsuMerossClientAsync(tmp_path, logger)
+            out._cache = meross_cache
+            return out
+
+        return _make_client
+
+    @pytest.mark.asyncio
+    async def test_startup_to_first_command(
+        self, make_client, meross_cache, mock_manager_cls, discovery_done, plug
+    ):
+        # Previous run: the plug had been discovered and turned on
+        old_client = make_client()
+        await old_client.login(["api"], "user", "pwd", raise_exc=True)
+        old_client.device_registry.sync([plug])
+        old_client.state_table.update("plug-uuid", 0, True, StateSource.COMMAND)
+        await old_client._save_inventory()
+
+        start = time.perf_counter()
+        client = make_client()
+        assert await client.login(["api"], "user", "pwd", raise_exc=True)
+        assert client.state_table.get("plug-uuid::0").source is StateSource.SNAPSHOT
+        assert await client.set_devices_states(["plug-uuid::0"], False)
+        elapsed = time.perf_counter() - start
+
+        # The command did not wait for the (still running) discovery
+        assert not discovery_done.is_set()
+        assert elapsed < 1.0, f"Startup to first command took {elapsed:.3f}s"
+        assert client.state_table.get("plug-uuid::0").is_on is False
+        discovery_done.set()
+
+        # The command's state change is saved later (batched with the next ones)
+        inventory = meross_cache.get_device_inventory("user")
+        assert inventory["states"]["plug-uuid::0"][0] is True
+        assert client._inventory_save_handle is not None
+        await client._save_inventory()
+        inventory = meross_cache.get_device_inventory("user")
+        assert inventory["states"]["plug-uuid::0"][0] is False
+        assert client._inventory_save_handle is None
+
+
+class TestWarmUp:
+    @pytest.fixture
+    def mock_manager(self, mocker, plug):
+        out = mocker.MagicMock(name="mock_manager")
+        out.async_init = mocker.AsyncMock()
+        out.async_device_discovery = mocker.AsyncMock(return_value=[plug])
+        mocker.patch.object(meross_client, "MerossManager", return_value=out)
+        return out
+
+    @pytest.fixture
+    def logged_in_client(self, test_client, mock_meross_iot_http_client):
+        test_client.api_client = mock_meross_iot_http_client
+        return test_client
+
+    @pytest.fixture
+    def plug_update(self, mocker, plug):
+        return mocker.patch.object(plug, "async_update", mocker.AsyncMock())
+
+    @pytest.mark.asyncio
+    async def test_warm_up(self, logged_in_client, mock_manager, plug_update):
+        login = concurrent.futures.Future()
+        login.set_result(True)
+        warm_up = asyncio.ensure_future(
+            logged_in_client.warm_up(login, ["plug-uuid::0"])
+        )
+        # A command arriving during the warm-up joins the in-flight work
+        handles = await logged_in_client.get_device_handles(["plug-uuid::0"])
+        assert await warm_up
+        assert [(device.uuid, channel) for (device, channel) in handles] == [
+            ("plug-uuid", 0)
+        ]
+        assert logged_in_client.is_warmed_up
+        assert list(logged_in_client.warm_up_timings) == [
+            "login",
+            "manager",
+            "discovery",
+            "prefetch",
+        ]
+        mock_manager.async_device_discovery.assert_called_once()
+        plug_update.assert_called_once()
+
+    @pytest.mark.asyncio
+    async def test_failed_phase(self, logged_in_client, mock_manager):
+        mock_manager.async_device_discovery.side_effect = RuntimeError("Cloud is down")
+        login = concurrent.futures.Future()
+        login.set_result(True)
+        with pytest.raises(RuntimeError):
+            await logged_in_client.warm_up(login, ["plug-uuid::0"])
+        assert logged_in_client.warm_up_failed_phase == "discovery"
+        assert not logged_in_client.is_warmed_up
+
+    def test_failure_logged(self, tmp_path, logger_mock):
+        client = meross_client.OctoprintPsuMerossClient(
+            cache_file=tmp_path / "cache.db", logger=logger_mock
+        )
+        client._async_client.warm_up_failed_phase = "discovery"
+        future = concurrent.futures.Future()
+        future.set_exception(RuntimeError("Cloud is down"))
+        client._on_warm_up_done(future)
+        client.close()
+        assert "discovery phase" in logger_mock.error.call_args[0][0]
+
+    @pytest.mark.asyncio
+    async def test_not_logged_in(self, test_client, mock_manager):
+        login = concurrent.futures.Future()
+        login.set_result(False)
+        assert not await test_client.warm_up(login, ["plug-uuid::0"])
+        assert not test_client.is_warmed_up
+        assert not mock_manager.async_device_discovery.called
+
+
+class TestDeadlines:
+    @pytest.fixture
+    def slow_plug(self, mocker, plug):
+        """A second plug whose update never finishes."""
+        out = build_meross_device_from_abilities(
+            HttpDeviceInfo(
+                uuid="slow-uuid",
+                online_status=OnlineStatus.ONLINE,
+                dev_name="Lights",
+                device_type="mss310",
+                channels=[{}],
+                fmware_version="1",
+                hdware_version="1",
+                domain="mqtt.example.com",
+                reserved_domain="mqtt.example.com",
+            ),
+            {"Appliance.System.All": {}, "Appliance.Control.ToggleX": {}},
+            mocker.MagicMock(),
+        )
+
+        async def _never():
+            await asyncio.Event().wait()
+
+        mocker.patch.object(out, "async_update", side_effect=_never)
+        return out
+
+    @pytest.fixture
+    def client(self, mocker, test_client, mock_meross_iot_http_client, plug, slow_plug):
+        manager = mocker.MagicMock(name="mock_manager")
+        manager.async_init = mocker.AsyncMock()
+        manager.async_device_discovery = mocker.AsyncMock(
+            return_value=[plug, slow_plug]
+        )
+        mocker.patch.object(meross_client, "MerossManager", return_value=manager)
+        mocker.patch.object(plug, "async_update", mocker.AsyncMock())
+        mocker.patch.object(plug, "async_turn_on", mocker.AsyncMock())
+        test_client.api_client = mock_meross_iot_http_client
+        return test_client
+
+    @pytest.mark.asyncio
+    async def test_partial_results(self, client, plug):
+        start = time.monotonic()
+        rv = await client.set_devices_states(
+            ["plug-uuid::0", "slow-uuid::0"], True, deadline=meross_client.Deadline(0.2)
+        )
+        assert time.monotonic() - start < 1
+        assert not rv
+        results = rv.asdict()
+        assert results["plug-uuid::0"]["success"]
+        assert not results["slow-uuid::0"]["success"]
+        assert "budget" in results["slow-uuid::0"]["error"]
+        plug.async_turn_on.assert_called_once_with(channel=0)
+
+    @pytest.mark.asyncio
+    async def test_circuit_breaker(self, client, slow_plug):
+        for _ in range(3):
+            await client.set_devices_states(
+                ["slow-uuid::0"], True, deadline=meross_client.Deadline(0.05)
+            )
+        assert client.get_breaker("slow-uuid").state == "open"
+        # Fails fast now
+        start = time.monotonic()
+        rv = await client.set_devices_states(["slow-uuid::0"], True)
+        assert time.monotonic() - start < 0.1
+        (result,) = rv.devices
+        assert (result.success, result.attempts) == (False, 0)
+
+
+class TestStateReads:
+    @pytest.fixture
+    def client(self, mocker, tmp_path, logger):
+        mocker.patch.object(
+            meross_client._OctoprintPsuMerossClientAsync, "is_authenticated", True
+        )
+        return meross_client.OctoprintPsuMerossClient(
+            cache_file=tmp_path / "cache.db", logger=logger
+        )
+
+    @pytest.fixture
+    def scheduled(self, mocker):
+        """Device queries scheduled on the worker loop (never run)."""
+        out = []
+
+        def _schedule(coro, loop):
+            coro.close()
+            out.append(concurrent.futures.Future())
+            return out[-1]
+
+        mocker.patch.object(
+            meross_client.tracing, "run_coroutine_threadsafe", side_effect=_schedule
+        )
+        return out
+
+    def test_single_refresh(self, client, scheduled):
+        group = ["plug-uuid::0", "plug-uuid::1"]
+        assert client.is_on(group) is False
+        # Per-channel reads don't schedule queries of their own
+        assert client.channel_states(group) == {dev_id: None for dev_id in group}
+        assert client.is_on(group[:1]) is False
+        assert len(scheduled) == 1
+
+    def test_group_results_kept_apart(self, client, scheduled):
+        state_table = client._async_client.state_table
+        state_table.update("plug-uuid", 0, True, StateSource.POLL)
+        state_table.update("plug-uuid", 1, False, StateSource.POLL)
+        assert client.is_on(["plug-uuid::0"]) is True
+        assert client.is_on(["plug-uuid::0", "plug-uuid::1"]) is False
+        assert client.is_on(["plug-uuid::0"]) is True
+        assert not scheduled
+
+
+class TestRestart:
+    def test_blocked_loop(self, mocker, tmp_path, logger_mock):
+        client = meross_client.OctoprintPsuMerossClient(
+            cache_file=tmp_path / "cache.db", logger=logger_mock
+        )
+        client.lan_control = False
+        old_client = client._async_client
+        # Logged in on the loop that is about to be abandoned
+        old_client.api_client = mocker.Mock(name="old_api_client")
+        client.worker.loop.call_soon_threadsafe(time.sleep, 1)
+
+        assert not client.restart(timeout=0.1)
+        assert client._async_client is not old_client
+        assert not client.is_authenticated
+        assert not client.lan_control  # Carried over
+
+        login = mocker.patch.object(
+            meross_client._OctoprintPsuMerossClientAsync,
+            "login",
+            mocker.AsyncMock(return_value=True),
+        )
+        assert client.login("https://iot.meross.com", "user", "password").result(5)
+        login.assert_awaited_once()
+        assert client.close()
+
+
+class TestGetStates:
+    @pytest.fixture
+    def client(self, mocker, test_client, mock_meross_iot_http_client, plug):
+        manager = mocker.MagicMock(name="mock_manager")
+        manager.async_init = mocker.AsyncMock()
+        manager.async_device_discovery = mocker.AsyncMock(return_value=[plug])
+        mocker.patch.object(meross_client, "MerossManager", return_value=manager)
+        mocker.patch.object(plug, "async_update", mocker.AsyncMock())
+        mocker.patch.object(plug, "is_on", side_effect=lambda channel: channel == 1)
+        test_client.api_client = mock_meross_iot_http_client
+        return test_client
+
+    @pytest.mark.asyncio
+    async def test_one_update_per_device(self, client, plug):
+        client.state_table.update("other-uuid", 0, True, StateSource.PUSH)
+        states = await client.get_states(
+            ["plug-uuid::0", "plug-uuid::1", "other-uuid::0"]
+        )
+        plug.async_update.assert_called_once()
+        assert states["plug-uuid::0"]["state"] == "off"
+        assert states["plug-uuid::1"] == {
+            "state": "on",
+            "online": True,
+            "age": states["plug-uuid::1"]["age"],
+            "source": "poll",
+        }
+        # Served from the state table
+        assert states["other-uuid::0"]["source"] == "push"
+        assert states["other-uuid::0"]["online"] is None  # Not a discovered device
+
+    @pytest.mark.asyncio
+    async def test_stale_states_queried(self, client, plug):
+        dev_ids = ["plug-uuid::0", "plug-uuid::1"]
+        await client.get_states(dev_ids, max_age=0.01)
+        plug.async_update.assert_called_once()
+
+        await asyncio.sleep(0.02)  # Both entries expire
+        states = await client.get_states(dev_ids, max_age=0.01)
+        assert plug.async_update.call_count == 2  # Once for both channels
+        assert states["plug-uuid::1"]["source"] == "poll"
+        assert states["plug-uuid::1"]["age"] < 0.01
+
+    @pytest.mark.asyncio
+    async def test_fresh_states_not_queried(self, client, plug):
+        client.state_table.update("plug-uuid", 0, True, StateSource.PUSH)
+        states = await client.get_states(["plug-uuid::0"])
+        plug.async_update.assert_not_called()
+        assert states["plug-uuid::0"]["state"] == "on"
+
+    @pytest.mark.asyncio
+    async def test_is_on_polls_stale_devices(self, client, plug):
+        assert await client.is_on(["plug-uuid::1"]) is True
+        # Updated by the device lookup, and fresh for the next call
+        assert await client.is_on(["plug-uuid::1"]) is True
+        plug.async_update.assert_called_once()
+
+        assert await client.is_on(["plug-uuid::1"], max_age=0) is True
+        assert plug.async_update.call_count == 2
+        assert client.state_table.get("plug-uuid::1").source is StateSource.POLL
+
+
+class TestRegionLogin:
+    @pytest.mark.asyncio
+    async def test_next_region(
+        self, mocker, test_client, mock_meross_iot_http_client, mock_meross_cache
+    ):
+        mock_meross_cache.get_cloud_session_token.return_value = None
+        mocker.patch.object(
+            test_client.region_selector,
+            "order",
+            mocker.AsyncMock(return_value=["iotx-us.meross.com", "iotx-eu.meross.com"]),
+        )
+        remember = mocker.patch.object(
+            test_client.region_selector, "remember", mocker.AsyncMock()
+        )
+        mock_meross_iot_http_client.async_from_user_password.side_effect = [
+            asyncio.TimeoutError(),
+            mock_meross_iot_http_client,
+        ]
+        urls = ["iotx-eu.meross.com", "iotx-us.meross.com"]
+        assert await test_client.login(urls, "user", "password", raise_exc=True)
+        calls = mock_meross_iot_http_client.async_from_user_password.call_args_list
+        assert [el[1]["api_base_url"] for el in calls] == [
+            "iotx-us.meross.com",
+            "iotx-eu.meross.com",
+        ]
+        assert remember.call_args[0][:3] == ("user", urls, "iotx-eu.meross.com")
+
+    @pytest.mark.asyncio
+    async def test_bad_credentials(
+        self, mocker, test_client, mock_meross_iot_http_client, mock_meross_cache
+    ):
+        from meross_iot.model.http.exception import BadLoginException
+
+        mock_meross_cache.get_cloud_session_token.return_value = None
+        mocker.patch.object(
+            test_client.region_selector,
+            "order",
+            mocker.AsyncMock(return_value=["iotx-us.meross.com", "iotx-eu.meross.com"]),
+        )
+        mock_meross_iot_http_client.async_from_user_password.side_effect = (
+            BadLoginException("Wrong password")
+        )
+        with pytest.raises(BadLoginException):
+            await test_client.login(
+                ["iotx-eu.meross.com", "iotx-us.meross.com"], "user", "x", True
+            )
+        # Not retried against the other regions
+        assert mock_meross_iot_http_client.async_from_user_password.call_count == 1
+
+
+class TestSessionRefresh:
+    @pytest.fixture
+    def mock_manager(self, mocker):
+        out = mocker.MagicMock(name="mock_manager")
+        out.async_init = mocker.AsyncMock()
+        mocker.patch.object(meross_client, "MerossManager", return_value=out)
+        return out
+
+    @pytest.mark.asyncio
+    async def test_refresh_keeps_manager(
+        self,
+        mocker,
+        test_client,
+        mock_meross_iot_http_client,
+        mock_meross_cache,
+        mock_manager,
+    ):
+        mock_meross_cache.get_cloud_session_token.return_value = None
+        mock_meross_cache.get_session_name_key.return_value = "session-key"
+        mock_meross_cache.set_cloud_session_token.return_value = "session-key"
+        assert await test_client.login(["iotx-eu.meross.com"], "user", "pwd", True)
+        assert test_client.session_supervisor.running
+        manager = await test_client.get_manager()
+        old_client = test_client.api_client
+
+        new_client = mocker.MagicMock(name="new_http_client")
+        new_client.async_logout = mocker.AsyncMock()
+        mock_meross_iot_http_client.async_from_user_password.return_value = new_client
+        mock_meross_cache.set_cloud_session_token.reset_mock()
+        assert await test_client._refresh_session()
+
+        assert test_client.api_client is new_client
+        assert await test_client.get_manager() is manager
+        assert manager._http_client is new_client
+        mock_meross_cache.set_cloud_session_token.assert_called_once_with(
+            "user", "pwd", new_client.cloud_credentials
+        )
+        old_client.async_logout.assert_called_once_with()
+        # Already logged in (no extra login for the commands)
+        assert await test_client.login(["iotx-eu.meross.com"], "user", "pwd", True)
+        assert mock_meross_iot_http_client.async_from_user_password.call_count == 2
+
+        await test_client.logout()
+        assert not test_client.session_supervisor.running
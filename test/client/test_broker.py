@@ -0,0 +1,197 @@
+import asyncio
+
+import pytest
+import pytest_asyncio
+
+from octoprint_psucontrol_meross import broker, meross_client
+from octoprint_psucontrol_meross.device_registry import DeviceRegistry
+from octoprint_psucontrol_meross.device_state import DeviceStateTable, StateSource
+from octoprint_psucontrol_meross.exc import BrokerError, DeadlineExceededError
+from octoprint_psucontrol_meross.resilience import (
+    CommandResult,
+    Deadline,
+    DeviceResult,
+)
+
+
+@pytest.fixture
+def socket_path(tmp_path):
+    return tmp_path / "broker.sock"
+
+
+@pytest.fixture
+def session(mocker):
+    """The broker's `_OctoprintPsuMerossClientAsync`."""
+    out = mocker.MagicMock(name="session")
+    out.state_table = DeviceStateTable()
+    out.device_registry = DeviceRegistry()
+    out._describe_channels.side_effect = lambda dev_ids: {
+        dev_id: {"state": "on", "online": True, "age": 1.0, "source": "push"}
+        for dev_id in dev_ids
+    }
+    out.is_authenticated = False
+    out._session_user = out._session_password = None
+    out.login = mocker.AsyncMock(return_value=True)
+    out.is_on = mocker.AsyncMock(return_value=True)
+    out.set_devices_states = mocker.AsyncMock(
+        return_value=CommandResult(
+            devices=(
+                DeviceResult("plug::0", True, 0.1),
+                DeviceResult("lamp::0", False, 0.2, error="Timeout"),
+            )
+        )
+    )
+    return out
+
+
+@pytest_asyncio.fixture
+async def server(socket_path, session, logger_mock):
+    out = broker.BrokerServer(socket_path, logger=logger_mock, client=session)
+    await out.start()
+    yield out
+    await out.close()
+
+
+@pytest.fixture
+def pushed():
+    return []
+
+
+@pytest.fixture
+def client(socket_path, logger_mock, pushed):
+    return broker.BrokerAsyncClient(
+        socket_path, logger=logger_mock, on_state_push=pushed.append
+    )
+
+
+@pytest.mark.asyncio
+async def test_calls(server, client, session):
+    session.state_table.update("plug", 0, True, StateSource.PUSH)
+    assert await client.login("iotx-eu.meross.com", "user", "password", True)
+    assert client.is_authenticated
+    # Subscribed on connect, the broker's states are mirrored
+    assert client.state_table.get("plug::0").is_on
+
+    assert await client.is_on(["plug::0"], Deadline(5)) is True
+    assert session.is_on.call_args[0][0] == ["plug::0"]
+    assert session.is_on.call_args[0][1].remaining() <= 5
+
+    rv = await client.set_devices_states(["plug::0", "lamp::0"], True)
+    assert not rv
+    assert [el.dev_id for el in rv.failed] == ["lamp::0"]
+    assert rv.failed[0].error == "Timeout"
+
+    session.is_on.side_effect = RuntimeError("Not authenticated")
+    with pytest.raises(BrokerError, match="Not authenticated"):
+        await client.is_on(["plug::0"])
+
+
+@pytest.mark.asyncio
+async def test_other_account_rejected(server, client, session, socket_path):
+    assert socket_path.stat().st_mode & 0o777 == 0o600
+    session.is_authenticated = True
+    session._session_user = "owner@example.com"
+    session._session_password = "pwd"
+    assert await client.login("iotx-eu.meross.com", "Owner@example.com", "pwd", True)
+    with pytest.raises(BrokerError, match="another account"):
+        await client.login("iotx-eu.meross.com", "other@example.com", "pwd", True)
+    # A stale password must not re-login (and log out) the shared session either
+    with pytest.raises(BrokerError, match="Wrong password"):
+        await client.login("iotx-eu.meross.com", "owner@example.com", "old", True)
+    assert session.login.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_events(server, client, pushed):
+    await client.login("iotx-eu.meross.com", "user", "password", True)
+    server.broadcast(
+        {
+            "states": {
+                "plug::1": {"state": "off", "online": True, "age": 0, "source": "poll"}
+            }
+        }
+    )
+    for _ in range(100):
+        if client.state_table.get("plug::1"):
+            break
+        await asyncio.sleep(0.01)
+    assert client.state_table.get("plug::1").is_on is False
+    assert pushed[-1]["states"]["plug::1"]["state"] == "off"
+
+
+@pytest.mark.asyncio
+async def test_broker_gone(server, client):
+    await client.login("iotx-eu.meross.com", "user", "password", True)
+    await server.close()
+    for _ in range(100):
+        if not client.is_authenticated:
+            break
+        await asyncio.sleep(0.01)
+    assert not client.is_authenticated
+    with pytest.raises(BrokerError):
+        await client.is_on(["plug::0"])
+
+
+def test_in_process_fallback(socket_path, tmp_path, logger_mock):
+    assert not broker.broker_available(socket_path)
+    client = meross_client.OctoprintPsuMerossClient(
+        cache_file=tmp_path / "cache.db", logger=logger_mock, broker_socket=socket_path
+    )
+    assert not client.broker_mode
+
+
+@pytest.mark.asyncio
+async def test_runtime_fallback(server, socket_path, tmp_path, logger_mock):
+    client = meross_client.OctoprintPsuMerossClient(
+        cache_file=tmp_path / "cache.db", logger=logger_mock, broker_socket=socket_path
+    )
+    try:
+        assert client.broker_mode
+        await server.close()
+        socket_path.unlink()
+        # The failed (re)connect switches to an in-process client
+        assert not await asyncio.wrap_future(
+            client.login("iotx-eu.meross.com", "user", "password")
+        )
+        assert not client.broker_mode
+        assert "psucontrol_meross_worker_loop_lag_seconds" in client.metrics.snapshot()
+    finally:
+        client.close()
+
+
+@pytest.mark.asyncio
+async def test_transport_stats_timeout(server, client, mocker):
+    await client.login("iotx-eu.meross.com", "user", "password", True)
+    mocker.patch.object(broker, "DEFAULT_CALL_BUDGET", 0.01)
+    # The answer can not arrive while this (the client's) loop is blocked
+    with pytest.raises(DeadlineExceededError):
+        client.transport.asdict()
+
+
+@pytest.mark.asyncio
+async def test_lan_control_forwarded(server, session, socket_path, logger_mock):
+    session.transport.lan_enabled = True
+    client = broker.BrokerAsyncClient(
+        socket_path, logger=logger_mock, lan_control=False
+    )
+    assert not client.transport.lan_enabled
+    # Sent on connect
+    await client.login("iotx-eu.meross.com", "user", "password", True)
+    assert session.transport.lan_enabled is False
+
+    client.transport.lan_enabled = True
+    for _ in range(100):
+        if session.transport.lan_enabled:
+            break
+        await asyncio.sleep(0.01)
+    assert session.transport.lan_enabled is True
+    await client.close()
+
+
+@pytest.mark.asyncio
+async def test_client_close(server, client):
+    await client.login("iotx-eu.meross.com", "user", "password", True)
+    await client.close()
+    assert not client.is_authenticated
+    # Reconnects on the next call
+    assert await client.login("iotx-eu.meross.com", "user", "password", True)
@@ -0,0 +1,98 @@
+import asyncio
+
+import pytest
+
+from octoprint_psucontrol_meross.command_queue import CommandQueue, TOGGLE
+
+
+class FakeDevices:
+    def __init__(self):
+        self.states = {}
+        self.sent = []
+        self.release: asyncio.Event = None  # Blocks the commands until set
+
+    async def execute(self, dev_id: str, state: bool):
+        self.sent.append((dev_id, state))
+        if self.release is not None:
+            await self.release.wait()
+        if dev_id == "broken::0":
+            raise RuntimeError("No ack")
+        if state == TOGGLE:
+            state = not self.states.get(dev_id, False)
+        self.states[dev_id] = state
+
+    def state_matches(self, dev_id: str, state: bool) -> bool:
+        return self.states.get(dev_id) == state
+
+
+@pytest.fixture
+def devices():
+    return FakeDevices()
+
+
+@pytest.fixture
+def queue(devices, logger_mock):
+    return CommandQueue(devices.execute, devices.state_matches, logger=logger_mock)
+
+
+@pytest.mark.asyncio
+async def test_last_write_wins(queue, devices):
+    devices.release = asyncio.Event()
+    first = asyncio.ensure_future(queue.submit("plug::0", True))
+    await asyncio.sleep(0)  # The first command is being sent
+    superseded = [
+        asyncio.ensure_future(queue.submit("plug::0", state))
+        for state in (False, True, False)
+    ]
+    other = asyncio.ensure_future(queue.submit("other::0", True))
+    await asyncio.sleep(0)
+    assert queue.depth == 3  # Running + queued command of plug::0 and other::0
+
+    devices.release.set()
+    await asyncio.gather(first, other, *superseded)
+    assert devices.sent == [("plug::0", True), ("other::0", True), ("plug::0", False)]
+    assert devices.states == {"plug::0": False, "other::0": True}
+    assert (queue.coalesced, queue.depth) == (2, 0)
+
+
+@pytest.mark.asyncio
+async def test_toggles_in_order(queue, devices):
+    devices.release = asyncio.Event()
+    running = asyncio.ensure_future(queue.submit("plug::0", True))
+    await asyncio.sleep(0)
+    queued = [
+        asyncio.ensure_future(queue.submit("plug::0", state))
+        for state in (TOGGLE, False, True, TOGGLE, TOGGLE)
+    ]
+    await asyncio.sleep(0)
+    assert queue.depth == 5  # The toggles are not coalesced
+
+    devices.release.set()
+    await asyncio.gather(running, *queued)
+    assert devices.sent == [
+        ("plug::0", True),
+        ("plug::0", TOGGLE),
+        ("plug::0", True),  # False replaced by True
+        ("plug::0", TOGGLE),
+        ("plug::0", TOGGLE),
+    ]
+    assert devices.states == {"plug::0": True}
+    assert (queue.coalesced, queue.skipped) == (1, 0)
+
+
+@pytest.mark.asyncio
+async def test_skip_known_state(queue, devices):
+    await queue.submit("plug::0", True)
+    await queue.submit("plug::0", True)
+    assert devices.sent == [("plug::0", True)]
+    assert queue.skipped == 1
+
+
+@pytest.mark.asyncio
+async def test_error(queue, devices):
+    with pytest.raises(RuntimeError):
+        await queue.submit("broken::0", True)
+    # The queue keeps working
+    with pytest.raises(RuntimeError):
+        await queue.submit("broken::0", True)
+    assert len(devices.sent) == 2
@@ -0,0 +1,95 @@
+import json
+
+import pytest
+
+from octoprint_psucontrol_meross.device_registry import DeviceRegistry
+
+
+@pytest.fixture
+def make_device(mocker):
+    def _make_device(uuid, online_status="online"):
+        return mocker.Mock(
+            name=f"device_{uuid}", uuid=uuid, online_status=online_status
+        )
+
+    return _make_device
+
+
+@pytest.fixture
+def registry():
+    return DeviceRegistry()
+
+
+def test_sync(registry, make_device):
+    dev_a, dev_b = make_device("a"), make_device("b")
+    assert registry.sync([dev_a, dev_b]) == {"a", "b"}
+    assert registry.get("a") is dev_a
+    assert registry.generation == 1
+
+    # Same device objects - nothing changed
+    assert registry.sync([dev_a, dev_b]) == set()
+    assert registry.generation == 1
+    assert registry.device_version("a") == 1
+
+    dev_c = make_device("c")
+    assert registry.sync([dev_a, dev_c]) == {"b", "c"}
+    assert "b" not in registry
+    assert registry.device_version("a") == 1
+    assert registry.device_version("b") == 2
+
+
+def test_set_online_status(registry, make_device):
+    registry.sync([make_device("a")])
+    assert not registry.set_online_status("unknown", "offline")
+    assert not registry.set_online_status("a", "online")
+    assert registry.set_online_status("a", "offline")
+    assert registry.online_status("a") == "offline"
+    assert registry.device_version("a") == 2
+
+
+def test_index(registry, make_device, mocker):
+    def _channel(index, name=None):
+        out = mocker.Mock(index=index, is_master_channel=(index == 0))
+        out.name = name
+        return out
+
+    strip = make_device("strip")
+    strip.name = "Strip"
+    strip.channels = [_channel(0), _channel(1, "Outlet 1")]
+    plug = make_device("plug")
+    plug.name = "Printer plug"
+    plug.channels = [_channel(0)]
+    registry.sync([strip, plug])
+
+    index = registry.index
+    assert index.devices["plug"] is plug
+    assert index.channels["strip::1"] is strip.channels[1]
+    assert index.handle_dicts == (
+        {"name": "Printer plug", "dev_id": "plug::0"},
+        {"name": "Strip", "dev_id": "strip::0"},
+        {"name": "Strip: Outlet 1", "dev_id": "strip::1"},
+    )
+    # Reused until the registry changes
+    assert registry.index is index
+    registry.set_online_status("plug", "offline")
+    assert registry.index is not index
+    assert registry.index.etag != index.etag
+
+
+def test_index_select(registry, make_device, mocker):
+    devices = []
+    for idx in range(5):
+        device = make_device(f"uuid{idx}")
+        device.name = f"Plug {idx}" if idx % 2 else f"Lamp {idx}"
+        device.channels = [mocker.Mock(index=0, is_master_channel=True)]
+        devices.append(device)
+    registry.sync(devices)
+    index = registry.index
+
+    total, page = index.select(offset=1, limit=2)
+    assert total == 5
+    assert [json.loads(el)["name"] for el in page] == ["Lamp 2", "Lamp 4"]
+    total, page = index.select(query="plug")
+    assert total == 2
+    assert [json.loads(el)["dev_id"] for el in page] == ["uuid1::0", "uuid3::0"]
+    assert index.select(query="UUID4::") == (1, (index.handle_jsons[2],))
@@ -0,0 +1,76 @@
+import pytest
+
+from octoprint_psucontrol_meross import device_state
+from octoprint_psucontrol_meross.device_state import DeviceStateTable, StateSource
+
+
+@pytest.fixture
+def monotonic(mocker):
+    out = mocker.patch.object(device_state.time, "monotonic")
+    out.return_value = 1000.0
+    return out
+
+
+@pytest.fixture
+def table():
+    return DeviceStateTable()
+
+
+def test_update_get(table):
+    assert table.get("uuid::0") is None
+    table.update("uuid", 0, 1, StateSource.POLL)
+    state = table.get("uuid::0")
+    assert state.is_on is True
+    assert state.source is StateSource.POLL
+
+
+@pytest.mark.parametrize(
+    "payload, expected",
+    [
+        ({"channel": 0, "onoff": 1}, {"uuid::0": True}),
+        (
+            [{"channel": 0, "onoff": 0}, {"channel": 2, "onoff": 1}],
+            {"uuid::0": False, "uuid::2": True},
+        ),
+        (None, {}),
+        ([{"onoff": 1}], {}),
+    ],
+)
+def test_update_from_togglex(table, payload, expected):
+    assert table.update_from_togglex("uuid", payload, StateSource.PUSH) == len(expected)
+    for dev_id, is_on in expected.items():
+        assert table.get(dev_id).is_on is is_on
+
+
+def test_get_fresh(table, monotonic):
+    table.update("uuid", 0, True, StateSource.PUSH)
+    table.update("uuid", 1, False, StateSource.PUSH)
+    assert table.get_fresh(["uuid::0", "uuid::1"], max_age=10) is not None
+    assert table.get_fresh(["uuid::0", "uuid::2"], max_age=10) is None
+    monotonic.return_value += 11
+    assert table.get_fresh(["uuid::0"], max_age=10) is None
+
+
+def test_invalidate_device(table):
+    table.update("uuid", 0, True, StateSource.PUSH)
+    table.update("uuid2", 0, True, StateSource.PUSH)
+    table.invalidate_device("uuid")
+    assert table.get_many(["uuid::0", "uuid2::0"])[0] is None
+    assert table.get("uuid2::0").is_on
+
+
+def test_group_state(table, monotonic):
+    table.update("uuid", 0, True, StateSource.PUSH, age=5)
+    table.update("uuid", 1, True, StateSource.POLL)
+    group = table.group_state(["uuid::1", "uuid::0"])
+    assert group.is_on
+    assert group.age == 5  # Of the oldest channel state
+    table.update("uuid", 1, False, StateSource.PUSH)
+    assert not table.group_state(["uuid::0", "uuid::1"]).is_on
+    assert table.group_state(["uuid::0"]).is_on  # Groups don't interfere
+    assert table.group_state(["uuid::0", "uuid::2"]) is None
+
+    table.invalidate_device("uuid")
+    assert table.group_state(["uuid::0", "uuid::1"]) is None
+    assert not table.last_group_state(["uuid::1", "uuid::0"]).is_on
+    assert table.last_group_state(["uuid::0"]).is_on
@@ -0,0 +1,91 @@
+import asyncio
+import socket
+
+import pytest
+import pytest_asyncio
+
+from aiohttp import web
+
+from octoprint_psucontrol_meross import region
+from octoprint_psucontrol_meross.cache import MerossCache
+from octoprint_psucontrol_meross.region import RegionSelector
+
+
+@pytest_asyncio.fixture
+async def regions():
+    """{name: base url} of local region stand-ins (and an unreachable one)."""
+    runners = []
+    out = {}
+    for name, delay in [("slow", 0.2), ("fast", 0.0)]:
+
+        async def _root(request, delay=delay):
+            await asyncio.sleep(delay)
+            return web.Response(status=404)
+
+        app = web.Application()
+        app.router.add_get("/", _root)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        await web.SockSite(runner, sock).start()
+        runners.append(runner)
+        out[name] = f"http://127.0.0.1:{sock.getsockname()[1]}"
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        out["down"] = f"http://127.0.0.1:{sock.getsockname()[1]}"
+    yield out
+    for runner in runners:
+        await runner.cleanup()
+
+
+@pytest.fixture
+def selector(tmp_path, logger_mock):
+    cache = MerossCache(tmp_path / "cache.db", logger=logger_mock)
+    return RegionSelector(cache, logger=logger_mock)
+
+
+@pytest.mark.asyncio
+async def test_order(selector, regions):
+    urls = [regions["down"], regions["slow"], regions["fast"]]
+    assert await selector.order("user", urls) == [
+        regions["fast"],
+        regions["slow"],
+        regions["down"],  # Still tried, as the last resort
+    ]
+    assert selector.probes == 3
+
+    # The choice is cached
+    await selector.remember("user", urls, regions["slow"], login_latency=0.3)
+    assert (await selector.order("user", urls))[0] == regions["slow"]
+    assert selector.probes == 3
+
+
+@pytest.mark.asyncio
+async def test_reprobe_on_degradation(selector, regions, mocker):
+    mocker.patch.object(region, "REPROBE_INTERVAL", 0)
+    urls = [regions["slow"], regions["fast"]]
+    await selector.remember("user", urls, regions["slow"], login_latency=0.3)
+    for _ in range(region.BASELINE_SAMPLES):
+        selector.observe(0.2)
+    assert selector.probes == 0
+    selector.observe(0.2)
+    selector.observe(0.8)
+    assert not selector.degraded
+    selector.observe(5)  # The cloud got a lot slower
+    assert selector.degraded
+    await selector._reprobe_task
+    assert selector.probes == 2
+    # Picked for the next login
+    assert (await selector.order("user", urls))[0] == regions["fast"]
+
+
+@pytest.mark.asyncio
+async def test_reprobe_on_slow_login(selector, regions, mocker):
+    urls = [regions["slow"], regions["fast"]]
+    await selector.remember("user", urls, regions["slow"], login_latency=0.3)
+    await selector.remember("user", urls, regions["slow"], login_latency=0.4)
+    assert selector._reprobe_task is None
+    await selector.remember("user", urls, regions["slow"], login_latency=3)
+    await selector._reprobe_task
+    assert (await selector.order("user", urls))[0] == regions["fast"]
@@ -0,0 +1,90 @@
+import asyncio
+import concurrent.futures
+import time
+
+import pytest
+
+from octoprint_psucontrol_meross import resilience
+from octoprint_psucontrol_meross.exc import DeadlineExceededError
+from octoprint_psucontrol_meross.resilience import (
+    CircuitBreaker,
+    Deadline,
+    run_device_call,
+)
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(mocker):
+    mocker.patch.object(resilience, "backoff_delay", return_value=0)
+
+
+def test_deadline_result():
+    deadline = Deadline(0.05)
+    start = time.monotonic()
+    with pytest.raises(DeadlineExceededError):
+        deadline.result(concurrent.futures.Future(), grace=0)
+    assert time.monotonic() - start < 0.5
+    assert deadline.expired
+
+
+def test_circuit_breaker(mocker):
+    now = mocker.patch.object(resilience.time, "monotonic", return_value=100)
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert (breaker.state, breaker.allow()) == ("open", False)
+
+    now.return_value = 110
+    assert breaker.state == "half_open"
+    assert breaker.allow()
+    assert not breaker.allow()  # Only a single trial call
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+    now.return_value = 120
+    assert breaker.allow()
+    breaker.record_success()
+    assert (breaker.state, breaker.allow()) == ("closed", True)
+
+
+def test_circuit_breaker_trial_per_channel(mocker):
+    now = mocker.patch.object(resilience.time, "monotonic", return_value=100)
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10)
+    breaker.record_failure("strip::0")
+    now.return_value = 110
+    assert breaker.allow("strip::0")
+    assert breaker.allow("strip::1")
+    assert not breaker.allow("strip::0")
+    breaker.release("strip::0")  # Cancelled
+    assert breaker.allow("strip::0")
+
+
+@pytest.mark.asyncio
+async def test_retries(mocker):
+    fn = mocker.AsyncMock(side_effect=[OSError("lost"), OSError("lost"), "ok"])
+    breaker = CircuitBreaker(failure_threshold=5)
+    result = await run_device_call("plug::0", fn, Deadline(1), breaker)
+    assert (result.success, result.attempts, result.error) == (True, 3, None)
+    assert breaker.failures == 0
+
+
+@pytest.mark.asyncio
+async def test_failed_call_counts_once(mocker):
+    fn = mocker.AsyncMock(side_effect=OSError("lost"))
+    breaker = CircuitBreaker(failure_threshold=3)
+    result = await run_device_call("plug::0", fn, Deadline(1), breaker)
+    assert (result.success, result.attempts) == (False, 3)
+    assert (breaker.failures, breaker.state) == (1, "closed")
+
+
+@pytest.mark.asyncio
+async def test_deadline_exceeded():
+    async def _never():
+        await asyncio.Event().wait()
+
+    result = await run_device_call(
+        "plug::0", _never, Deadline(0.05), CircuitBreaker(), max_attempts=1
+    )
+    assert not result.success
+    assert "budget" in result.error
@@ -0,0 +1,140 @@
+import datetime
+
+import pytest
+
+from octoprint_psucontrol_meross import session_supervisor
+from octoprint_psucontrol_meross.session_supervisor import SessionSupervisor
+
+
+class FakeMqttClient:
+    def __init__(self):
+        self.connected = True
+        self.reconnect_calls = 0
+        self.fail = False
+        self.loop_running = True
+
+    def is_connected(self):
+        return self.connected
+
+    def reconnect(self):
+        assert not self.loop_running, "Reconnecting under paho's network thread"
+        self.reconnect_calls += 1
+        if self.fail:
+            raise OSError("Network is unreachable")
+        self.connected = True
+
+    def loop_start(self):
+        self.loop_running = True
+
+    def loop_stop(self):
+        self.loop_running = False
+
+
+@pytest.fixture
+def creds(mocker):
+    return mocker.Mock(issued_on=session_supervisor._utcnow())
+
+
+@pytest.fixture
+def mqtt_client():
+    return FakeMqttClient()
+
+
+@pytest.fixture
+def supervisor(mocker, creds, mqtt_client, logger_mock):
+    return SessionSupervisor(
+        get_credentials=lambda: creds,
+        verify=mocker.AsyncMock(return_value=True),
+        refresh=mocker.AsyncMock(return_value=True),
+        get_mqtt_clients=lambda: {"mqtt.example.com:443": mqtt_client},
+        logger=logger_mock,
+        token_refresh_age=60 * 60,
+    )
+
+
+@pytest.fixture
+def clock(mocker):
+    """Controls `time.monotonic()` of the supervisor."""
+    out = mocker.Mock(return_value=1000.0)
+    mocker.patch.object(session_supervisor.time, "monotonic", out)
+    return out
+
+
+@pytest.mark.asyncio
+async def test_token_checks(supervisor, clock):
+    supervisor.start(verified=True)
+    supervisor.stop()
+    await supervisor.check()
+    supervisor.verify.assert_not_called()  # Just issued
+
+    clock.return_value += session_supervisor.TOKEN_CHECK_INTERVAL
+    await supervisor.check()
+    supervisor.verify.assert_called_once()
+    supervisor.refresh.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_refresh_old_token(supervisor, creds, clock):
+    supervisor.start(verified=True)
+    supervisor.stop()
+    creds.issued_on -= datetime.timedelta(hours=2)
+    await supervisor.check()
+    supervisor.refresh.assert_called_once()
+    assert supervisor.refreshes == 1
+
+
+@pytest.mark.asyncio
+async def test_rejected_token(supervisor, clock, mocker):
+    mocker.patch.object(session_supervisor, "backoff_delay", return_value=10)
+    supervisor.start(verified=False)  # A restored session
+    supervisor.stop()
+    supervisor.verify.return_value = False
+    supervisor.refresh.side_effect = [RuntimeError("Cloud is down"), True]
+
+    await supervisor.check()
+    assert supervisor.refresh_failures == 1
+    await supervisor.check()  # Backing off
+    assert supervisor.refresh.call_count == 1
+
+    clock.return_value += 10
+    await supervisor.check()
+    assert supervisor.refresh.call_count == 2
+    assert supervisor.refreshes == 1
+    # Not checked again straight after the refresh
+    await supervisor.check()
+    assert supervisor.verify.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_mqtt_reconnect(supervisor, mqtt_client, clock, mocker):
+    mocker.patch.object(session_supervisor, "backoff_delay", return_value=10)
+    supervisor.start(verified=True)
+    supervisor.stop()
+    mqtt_client.connected = False
+    mqtt_client.fail = True
+    await supervisor.check()
+    assert mqtt_client.reconnect_calls == 0  # Left to paho for a while
+
+    clock.return_value += session_supervisor.MQTT_RECONNECT_GRACE
+    await supervisor.check()
+    assert mqtt_client.reconnect_calls == 1
+    assert supervisor.reconnect_failures == 1
+    assert mqtt_client.loop_running  # paho keeps retrying on its own
+    await supervisor.check()
+    assert mqtt_client.reconnect_calls == 1  # Backing off
+
+    mqtt_client.fail = False
+    clock.return_value += 10
+    await supervisor.check()
+    assert mqtt_client.reconnect_calls == 2
+    assert supervisor.reconnects == 1
+    assert mqtt_client.connected
+    assert mqtt_client.loop_running
+
+
+@pytest.mark.asyncio
+async def test_logged_out(supervisor, mocker):
+    supervisor.get_credentials = lambda: None
+    await supervisor.check()
+    supervisor.verify.assert_not_called()
+    assert supervisor.token_age is None
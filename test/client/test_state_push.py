@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+
+from octoprint_psucontrol_meross.device_registry import DeviceRegistry
+from octoprint_psucontrol_meross.device_state import DeviceStateTable, StateSource
+from octoprint_psucontrol_meross.state_push import StatePushPublisher
+
+
+@pytest.fixture
+def state_table():
+    return DeviceStateTable()
+
+
+@pytest.fixture
+def registry(mocker):
+    out = DeviceRegistry()
+    device = mocker.Mock(uuid="plug", online_status="online")
+    device.name = "Plug"
+    device.channels = [mocker.Mock(index=0, is_master_channel=True)]
+    out.sync([device])
+    return out
+
+
+@pytest.fixture
+def sent():
+    return []
+
+
+@pytest.fixture
+def publisher(state_table, registry, sent, logger_mock):
+    def _describe(dev_ids):
+        states = state_table.get_many(dev_ids)
+        return {
+            dev_id: {
+                "state": None if state is None else ("on" if state.is_on else "off"),
+                "online": registry.online_status(dev_id.split("::")[0]) == "online",
+            }
+            for (dev_id, state) in zip(dev_ids, states)
+        }
+
+    out = StatePushPublisher(
+        send=sent.append,
+        describe=_describe,
+        get_index=(lambda: registry.index),
+        logger=logger_mock,
+        interval=0.05,
+    )
+    state_table.on_change = out.channels_changed
+    registry.on_change = out.devices_changed
+    return out
+
+
+@pytest.mark.asyncio
+async def test_batched_deltas(publisher, state_table, sent):
+    state_table.update("plug", 0, True, StateSource.PUSH)
+    state_table.update("plug", 0, False, StateSource.PUSH)
+    state_table.update("strip", 1, True, StateSource.POLL)
+    await asyncio.sleep(0.01)
+    (message,) = sent
+    assert message["states"] == {
+        "plug::0": {"state": "off", "online": True},
+        "strip::1": {"state": "on", "online": False},
+    }
+    assert message["devices"] == ({"name": "Plug", "dev_id": "plug::0"},)
+
+    # Rate limited, and unchanged states are not sent again
+    state_table.update("plug", 0, False, StateSource.POLL)
+    state_table.update("strip", 1, False, StateSource.POLL)
+    await asyncio.sleep(0.01)
+    assert len(sent) == 1
+    await asyncio.sleep(0.06)
+    assert sent[1] == {"states": {"strip::1": {"state": "off", "online": False}}}
+
+
+@pytest.mark.asyncio
+async def test_device_changes(publisher, state_table, registry, sent):
+    state_table.update("plug", 0, True, StateSource.PUSH)
+    await asyncio.sleep(0.01)
+    sent.clear()
+    await asyncio.sleep(0.05)
+
+    registry.set_online_status("plug", "offline")
+    await asyncio.sleep(0.01)
+    assert sent == [{"states": {"plug::0": {"state": "on", "online": False}}}]
+
+    await asyncio.sleep(0.05)
+    registry.sync(())  # The device is gone
+    state_table.clear()
+    await asyncio.sleep(0.01)
+    assert sent[1] == {
+        "states": {"plug::0": {"state": None, "online": False}},
+        "devices": (),
+    }
@@ -0,0 +1,86 @@
+import pytest
+
+from octoprint_psucontrol_meross.transport import (
+    CommandPath,
+    DeviceRoute,
+    DeviceTransport,
+)
+
+
+@pytest.fixture
+def manager(mocker):
+    out = mocker.MagicMock(name="manager")
+    out.async_execute_cmd = out.cloud_execute = mocker.AsyncMock(
+        return_value={"cloud": True}
+    )
+    out._device_registry.lookup_base_by_uuid.return_value.lan_ip = "10.0.0.2"
+    return out
+
+
+@pytest.fixture
+def transport(logger_mock, manager, mocker):
+    out = DeviceTransport(logger=logger_mock, on_command=mocker.MagicMock())
+    out._async_execute_lan = mocker.AsyncMock(return_value={"lan": True})
+    out.install(manager)
+    return out
+
+
+async def _toggle(manager):
+    return await manager.async_execute_cmd(
+        destination_device_uuid="uuid",
+        method="SET",
+        namespace="Appliance.Control.ToggleX",
+        payload={},
+        timeout=5,
+        mqtt_hostname="mqtt",
+        mqtt_port=443,
+    )
+
+
+@pytest.mark.asyncio
+async def test_lan_first(transport, manager):
+    assert await _toggle(manager) == {"lan": True}
+    assert transport._async_execute_lan.call_args[0][-1] == 1.0  # LAN timeout
+    transport.on_command.assert_called_once_with(CommandPath.LAN, True)
+    assert transport.asdict()["uuid"]["lan"]["successes"] == 1
+    manager.cloud_execute.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_cloud_fallback(transport, manager):
+    transport._async_execute_lan.side_effect = OSError("unreachable")
+    assert await _toggle(manager) == {"cloud": True}
+    assert manager.cloud_execute.call_args[1]["mqtt_hostname"] == "mqtt"
+    assert await _toggle(manager) == {"cloud": True}
+    # The LAN is not retried straight away
+    assert transport._async_execute_lan.call_count == 1
+    stats = transport.asdict()["uuid"]
+    assert (stats["lan"]["failures"], stats["cloud"]["successes"]) == (1, 2)
+
+
+@pytest.mark.asyncio
+async def test_sticks_to_faster_path(transport, manager):
+    route = transport.routes["uuid"] = DeviceRoute()
+    route.cloud.latency = 0  # The cloud can't get any faster
+    assert await _toggle(manager) == {"lan": True}
+    assert route.faster_path is CommandPath.CLOUD
+    assert await _toggle(manager) == {"cloud": True}
+
+
+@pytest.mark.asyncio
+async def test_http_session_reused(logger_mock):
+    transport = DeviceTransport(logger=logger_mock)
+    session = transport._get_http_session()
+    assert transport._get_http_session() is session
+    await transport.close()
+    assert session.closed
+    # Reopened on the next LAN command
+    assert transport._get_http_session() is not session
+    await transport.close()
+
+
+@pytest.mark.asyncio
+async def test_lan_disabled(transport, manager):
+    transport.lan_enabled = False
+    assert await _toggle(manager) == {"cloud": True}
+    transport._async_execute_lan.assert_not_called()
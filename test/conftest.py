@@ -4,5 +4,6 @@ import pytest
 @pytest.fixture
 def logger_mock(mocker):
     return mocker.MagicMock(
-        name="mock_logger", spec=["warning", "info", "debug", "getChild"]
+        name="mock_logger",
+        spec=["exception", "error", "warning", "info", "debug", "getChild"],
     )
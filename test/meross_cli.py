@@ -15,7 +15,9 @@ def main(args):
         cache_file=cache_fname,
         logger=logging.getLogger("OctoprintPsuMerossClient"),
     )
-    login_rv = client.login(args["username"], args["password"], sync=True)
+    login_rv = client.login(
+        args["api_base_url"], args["username"], args["password"]
+    ).result()
     print(f"Login result: {login_rv!r}")
     mode = args["mode"]
     if mode == "list":
@@ -23,36 +25,35 @@ def main(args):
         for el in client.list_devices():
             print(el)
     elif mode == "control":
-        client.set_device_state(
-            args["uuid"],
-            state=bool(args["state"]),
-        )
+        client.set_devices_states([args["uuid"]], state=bool(args["state"])).result()
     elif mode == "is_on":
         for _ in range(100):
-            print(client.is_on(args["uuid"]))
+            print(client.is_on([args["uuid"]], sync=True))
             time.sleep(10)
     elif mode == "test0":
         # I have one device downstream from another.
         upstream_dev = "1812079276197125182534298f18d174::0"
         downstream_dev = "21033062638419258h1848e1e9685d07::0"
         # turn off upstream
-        client.set_device_state(upstream_dev, 0)
+        client.set_devices_states([upstream_dev], False).result()
         print("Upstream OFF")
         time.sleep(20)
         # attempt to turn the downstream dev on
         # (should fail as the dev isn't powered)
         print("Trying to turn downstream ON (should fail)")
-        client.set_device_state(downstream_dev, 1)
+        client.set_devices_states([downstream_dev], True).result()
         time.sleep(5)
-        client.set_device_state(upstream_dev, 1)
+        client.set_devices_states([upstream_dev], True).result()
         print("Upstream ON (downstream should come online)")
         time.sleep(50)
         # attempt to turn the downstream dev on
         # (should succeed as the upstream is now ON)
         print("Turning downstream ON")
-        client.set_device_state(downstream_dev, 1)
+        client.set_devices_states([downstream_dev], True).result()
     elif mode == "test1":
-        client.set_device_state("1812079276197125182534298f18d174::0", 0)
+        client.set_devices_states(
+            ["1812079276197125182534298f18d174::0"], False
+        ).result()
         # just idle for a while
         time.sleep(240)
     else:
@@ -63,9 +64,14 @@ def get_argument_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("--username", required=True, help="Meross cloud username")
     parser.add_argument("--password", required=True, help="Meross cloud password")
+    parser.add_argument(
+        "--api-base-url",
+        default="iotx-eu.meross.com",
+        help="Meross cloud API server",
+    )
     parser.add_argument(
         "--cache-fname",
-        default="./meross_cloud_cache.tmp",
+        default="./meross_cloud_cache.sqlite3",
         help="Cache file for meross cloud auth",
     )
     subp = parser.add_subparsers(title="mode")
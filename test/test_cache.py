@@ -0,0 +1,169 @@
+import asyncio
+import threading
+
+import pytest
+
+from octoprint_psucontrol_meross import cache
+from octoprint_psucontrol_meross.cache import AsyncCachedObject, MerossCache
+from octoprint_psucontrol_meross.exc import CacheGetError, MerossCacheError
+
+
+class SlowLoader:
+    """`get_object` stand-in that blocks until released."""
+
+    def __init__(self, rv="value", exc=None):
+        self.rv = rv
+        self.exc = exc
+        self.calls = 0
+        self.release = asyncio.Event()
+
+    async def __call__(self):
+        self.calls += 1
+        await self.release.wait()
+        if self.exc:
+            raise self.exc
+        return self.rv
+
+
+def make_cache(loader, **kwargs):
+    return AsyncCachedObject(
+        enabled=lambda: True, get_key=lambda: "key", get_object=loader, **kwargs
+    )
+
+
+@pytest.mark.asyncio
+async def test_concurrent_misses_coalesced():
+    loader = SlowLoader()
+    cache_obj = make_cache(loader)
+    tasks = [asyncio.ensure_future(cache_obj()) for _ in range(5)]
+    await asyncio.sleep(0)
+    loader.release.set()
+    assert await asyncio.gather(*tasks) == ["value"] * 5
+    assert loader.calls == 1
+    assert cache_obj.coalesced_loads == 4
+    # Cached now
+    assert await cache_obj() == "value"
+    assert loader.calls == 1
+    assert (cache_obj.hits, cache_obj.misses) == (1, 5)
+
+
+@pytest.mark.asyncio
+async def test_failure_propagates_to_all_waiters():
+    loader = SlowLoader(exc=CacheGetError("boom"))
+    cache_obj = make_cache(loader)
+    tasks = [asyncio.ensure_future(cache_obj(default="dflt")) for _ in range(3)]
+    tasks.append(asyncio.ensure_future(cache_obj()))
+    await asyncio.sleep(0)
+    loader.release.set()
+    rv = await asyncio.gather(*tasks, return_exceptions=True)
+    assert rv[:3] == ["dflt"] * 3
+    assert isinstance(rv[3], CacheGetError)
+    assert loader.calls == 1
+
+
+@pytest.mark.asyncio
+async def test_flush_discards_inflight_load():
+    loader = SlowLoader()
+    cache_obj = make_cache(loader)
+    first = asyncio.ensure_future(cache_obj())
+    await asyncio.sleep(0)
+    cache_obj.flush()
+    second = asyncio.ensure_future(cache_obj())
+    await asyncio.sleep(0)
+    loader.release.set()
+    await asyncio.gather(first, second)
+    assert loader.calls == 2
+    assert cache_obj.coalesced_loads == 0
+
+
+@pytest.fixture
+def monotonic(mocker):
+    mocker.patch.object(cache.random, "uniform", return_value=0)
+    out = mocker.patch.object(cache.time, "monotonic")
+    out.return_value = 1000.0
+    return out
+
+
+@pytest.mark.asyncio
+async def test_stale_while_revalidate(monotonic):
+    values = iter(["v1", "v2"])
+    cache_obj = make_cache(lambda: next(values), soft_timeout=10, timeout=100)
+    assert await cache_obj() == "v1"
+    monotonic.return_value += 11
+    # Past the soft timeout: stale value returned, refresh runs in the background
+    assert await cache_obj() == "v1"
+    await asyncio.sleep(0)
+    assert await cache_obj() == "v2"
+
+
+@pytest.mark.asyncio
+async def test_hard_timeout_blocks(monotonic):
+    values = iter(["v1", "v2"])
+    cache_obj = make_cache(lambda: next(values), soft_timeout=10, timeout=100)
+    assert await cache_obj() == "v1"
+    monotonic.return_value += 101
+    assert await cache_obj() == "v2"
+
+
+@pytest.mark.asyncio
+async def test_failed_background_refresh_keeps_value(monotonic):
+    loader = SlowLoader(rv="v1")
+    loader.release.set()
+    cache_obj = make_cache(loader, soft_timeout=10, timeout=100)
+    assert await cache_obj() == "v1"
+    loader.exc = CacheGetError("boom")
+    monotonic.return_value += 11
+    assert await cache_obj() == "v1"
+    await asyncio.sleep(0)
+    assert await cache_obj() == "v1"
+    assert loader.calls == 2
+
+
+class TestMerossCache:
+    @pytest.fixture
+    def cache_file(self, tmp_path):
+        return tmp_path / "cache.sqlite3"
+
+    @pytest.fixture
+    def meross_cache(self, cache_file, logger_mock):
+        return MerossCache(cache_file, logger=logger_mock)
+
+    def test_session_token(self, meross_cache, cache_file, logger_mock):
+        assert meross_cache.get_cloud_session_token("user", "pwd") is None
+        meross_cache.set_cloud_session_token("user", "pwd", {"token": "x"})
+        # Visible to other connections
+        other_cache = MerossCache(cache_file, logger=logger_mock)
+        assert other_cache.get_cloud_session_token("user", "pwd") == {"token": "x"}
+        meross_cache.delete_cloud_session_token("user", "pwd")
+        assert other_cache.get_cloud_session_token("user", "pwd") is None
+
+    def test_expiry(self, meross_cache, mocker):
+        now = mocker.patch.object(cache.time, "time", return_value=1000.0)
+        meross_cache.set_many({"a": 1, "b": 2}, ttl=10)
+        meross_cache.set("c", 3)
+        assert meross_cache.get("a") == 1
+        now.return_value += 11
+        assert meross_cache.get("a") is None
+        assert meross_cache.purge_expired() == 1  # "b"
+        assert meross_cache.get("c") == 3
+
+    def test_corrupted_file(self, cache_file, logger_mock):
+        cache_file.write_bytes(b"definitely not an sqlite file" * 100)
+        meross_cache = MerossCache(cache_file, logger=logger_mock)
+        meross_cache.set("a", 1)
+        assert meross_cache.get("a") == 1
+
+    def test_version_mismatch(self, meross_cache, cache_file, logger_mock):
+        with meross_cache._transaction() as conn:
+            conn.execute("UPDATE schema_version SET version = 42")
+        with pytest.raises(MerossCacheError):
+            MerossCache(cache_file, logger=logger_mock)
+
+    @pytest.mark.asyncio
+    async def test_run_in_executor(self, meross_cache):
+        loop_thread = threading.get_ident()
+        await meross_cache.run_in_executor(meross_cache.set, "key", "value", ttl=60)
+        assert await meross_cache.run_in_executor(meross_cache.get, "key") == "value"
+        assert await meross_cache.run_in_executor(threading.get_ident) != loop_thread
+        meross_cache.shutdown_executor()
+        assert meross_cache.get("key") == "value"  # A new connection of this thread
@@ -0,0 +1,45 @@
+"""Guard the plugin's import cost (measured with `python -X importtime`)."""
+
+import subprocess
+import sys
+
+import pytest
+
+# Cumulative import time (in microseconds) the plugin package may add on top of
+#  the OctoPrint/flask modules that are already loaded when plugins get imported.
+IMPORT_BUDGET_US = 150_000
+
+# Heavy dependencies that must only be imported on the first login
+LAZY_TOP_LEVEL_MODULES = ("meross_iot", "paho", "aiohttp")
+
+
+def measure_import(module: str, preload=("octoprint.plugin", "flask")):
+    """Return {module name: cumulative import time in us} of `import <module>`."""
+    code = "; ".join(f"import {name}" for name in preload + (module,))
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    out = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _self_us, cumulative_us, name = line.split(":", 1)[1].split("|")
+        out[name.strip()] = int(cumulative_us)
+    return out
+
+
+@pytest.fixture(scope="module")
+def import_times():
+    return measure_import("octoprint_psucontrol_meross")
+
+
+def test_heavy_dependencies_not_imported(import_times):
+    loaded = {name.split(".")[0] for name in import_times}
+    assert loaded.isdisjoint(LAZY_TOP_LEVEL_MODULES)
+
+
+def test_import_budget(import_times):
+    assert import_times["octoprint_psucontrol_meross"] < IMPORT_BUDGET_US
@@ -4,6 +4,8 @@ import unittest.mock
 
 import pytest
 
+from meross_iot.model.credentials import MerossCloudCreds
+
 import octoprint_psucontrol_meross
 
 
@@ -28,28 +30,38 @@ def mocked_meross_http_client(mocker):
         spec=True,
         new_callable=GhettoAsyncMock,
     )
+    # Has to be picklable to be stored in the cache
+    out.async_from_user_password.return_value.cloud_credentials = MerossCloudCreds(
+        token="token",
+        key="key",
+        user_id="user_id",
+        user_email="user@example.com",
+        issued_on="2021-01-01T00:00:00",
+        domain="iotx-eu.meross.com",
+        mqtt_domain="mqtt-eu.meross.com",
+    )
     return out
 
 
-@pytest.fixture
-def mock_data_dir(fs):
-    return fs.create_dir("/unittest")
+@pytest.fixture(autouse=True)
+def is_admin(mocker):
+    """`Permissions.ADMIN.can()` of the current (mock) request."""
+    from octoprint.access.permissions import Permissions
+
+    return mocker.patch.object(Permissions.ADMIN, "can", return_value=True)
 
 
 @pytest.fixture
-def mock_shelve_data():
-    """Just a fixutre for the actual shelve data dict."""
-    return {}
+def mock_data_dir(tmp_path):
+    # A real directory, as sqlite can not operate on a fake filesystem
+    out = tmp_path / "unittest"
+    out.mkdir()
+    return out
 
 
-@pytest.fixture(autouse=True)
-def mock_shelve_open(mocker, mock_shelve_data):
-    shelve_mock = mocker.MagicMock(
-        name="shelve_open_mock", spec=dict, wraps=mock_shelve_data
-    )
-    shelve_mock.__getitem__.side_effect = mock_shelve_data.__getitem__
-    shelve_mock.__setitem__.side_effect = mock_shelve_data.__setitem__
-    return mocker.patch("shelve.open", return_value=shelve_mock)
+@pytest.fixture
+def meross_cache(octoprint_psu_meross_plugin):
+    return octoprint_psu_meross_plugin.meross._async_client._cache
 
 
 @pytest.fixture
@@ -66,7 +78,7 @@ def mock_plugin_settings(mocker):
 @pytest.fixture
 def octoprint_psu_meross_plugin_raw(mock_data_dir, logger_mock, mock_plugin_settings):
     out = octoprint_psucontrol_meross.plugin.PSUControlMeross()
-    out._data_folder = mock_data_dir.path
+    out._data_folder = mock_data_dir
     out._logger = logger_mock
     out._settings = mock_plugin_settings
     return out
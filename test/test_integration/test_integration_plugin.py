@@ -1,8 +1,34 @@
-def test_init(mock_shelve_data, octoprint_psu_meross_plugin_raw, mock_shelve_open):
-    assert mock_shelve_data.get("__CACHE_VERSION__") is None
+import shelve
+import sqlite3
+
+import flask
+import pytest
+import werkzeug.exceptions
+
+from octoprint_psucontrol_meross.device_registry import DeviceIndex
+from octoprint_psucontrol_meross.device_state import StateSource
+from octoprint_psucontrol_meross.exc import DeadlineExceededError
+
+
+def test_init(octoprint_psu_meross_plugin_raw, mock_data_dir):
+    cache_file = mock_data_dir / "meross_cloud.sqlite3"
+    assert not cache_file.exists()
     octoprint_psu_meross_plugin_raw.initialize()
-    assert mock_shelve_data.get("__CACHE_VERSION__") == 1
-    mock_shelve_open.assert_called_once_with("/unittest/meross_cloud.cache")
+    conn = sqlite3.connect(cache_file)
+    assert conn.execute("SELECT version FROM schema_version").fetchall() == [(2,)]
+    assert conn.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+
+
+def test_init_migrates_shelve(octoprint_psu_meross_plugin_raw, mock_data_dir):
+    legacy_file = mock_data_dir / "meross_cloud.cache"
+    with shelve.open(str(legacy_file)) as legacy_cache:
+        legacy_cache["__CACHE_VERSION__"] = 1
+        legacy_cache["_meross_token_abc"] = {"token": "old"}
+    octoprint_psu_meross_plugin_raw.initialize()
+    cache = octoprint_psu_meross_plugin_raw.meross._async_client._cache
+    assert cache.get("_meross_token_abc") == {"token": "old"}
+    assert cache.get("__CACHE_VERSION__") is None
+    assert not list(mock_data_dir.glob("meross_cloud.cache*"))
 
 
 def test_on_settings_initialized(
@@ -10,7 +36,7 @@ def test_on_settings_initialized(
     mocked_meross_http_client,
     threaded_loop,
     mock_plugin_settings,
-    mock_shelve_data,
+    meross_cache,
 ):
     octoprint_psu_meross_plugin.on_settings_initialized()
     threaded_loop.wait_all_futures()
@@ -20,9 +46,253 @@ def test_on_settings_initialized(
         email="settings::user_email::value",
         password="settings::user_password::value",
     )
-    assert (
-        mock_shelve_data[
+    assert vars(
+        meross_cache.get(
             "_meross_token_925c4eff75c595b75f84a1ec4733616b557aeea72cf643c4b3d354b15ca41b9e"
-        ]
-        == mocked_meross_http_client.async_from_user_password.return_value.cloud_credentials
+        )
+    ) == vars(
+        mocked_meross_http_client.async_from_user_password.return_value.cloud_credentials
+    )
+
+
+def test_ensure_login_fast_path(
+    octoprint_psu_meross_plugin,
+    mocked_meross_http_client,
+    threaded_loop,
+    run_coroutine_threadsafe,
+):
+    octoprint_psu_meross_plugin.on_settings_initialized()
+    threaded_loop.wait_all_futures()
+    assert run_coroutine_threadsafe.call_count == 1
+
+    # Already logged in with the same credentials: resolved without the worker thread
+    assert octoprint_psu_meross_plugin._ensure_meross_login().result() is True
+    assert run_coroutine_threadsafe.call_count == 1
+    assert mocked_meross_http_client.async_from_user_password.call_count == 1
+
+
+def test_auto_region_resolved_once(
+    octoprint_psu_meross_plugin, mock_plugin_settings, mocker
+):
+    settings = {
+        "api_base_url": "auto",
+        "api_urls": [
+            {"name": "Europe", "url": "iotx-eu.meross.com"},
+            {"name": "US", "url": "iotx-us.meross.com"},
+            {"name": "Automatic (lowest latency)", "url": "auto"},
+        ],
+    }
+    mock_plugin_settings.get.side_effect = lambda path: settings.get(path[0], "")
+    login = mocker.patch.object(octoprint_psu_meross_plugin.meross, "login")
+    octoprint_psu_meross_plugin._login_settings = None
+    for _ in range(3):
+        octoprint_psu_meross_plugin._ensure_meross_login()
+    assert login.call_args[0][0] == ["iotx-eu.meross.com", "iotx-us.meross.com"]
+    # Not re-read on every PSU state poll
+    api_urls_reads = [
+        el for el in mock_plugin_settings.get.call_args_list if el[0][0] == ["api_urls"]
+    ]
+    assert len(api_urls_reads) == 1
+
+
+def test_settings_save_relogin(
+    octoprint_psu_meross_plugin,
+    mocked_meross_http_client,
+    threaded_loop,
+    run_coroutine_threadsafe,
+    mock_plugin_settings,
+    mocker,
+):
+    mocker.patch("octoprint.plugin.SettingsPlugin.on_settings_save")
+    octoprint_psu_meross_plugin.on_settings_initialized()
+    threaded_loop.wait_all_futures()
+
+    octoprint_psu_meross_plugin.on_settings_save({})
+    assert run_coroutine_threadsafe.call_count == 1  # Unchanged credentials
+
+    mock_plugin_settings.get.side_effect = lambda path: (
+        [] if path == ["target_device_ids"] else f"new::{path[0]}"
+    )
+    octoprint_psu_meross_plugin.on_settings_save({})
+    threaded_loop.wait_all_futures()
+    # A new login followed by the warm-up
+    assert run_coroutine_threadsafe.call_count == 3
+    assert mocked_meross_http_client.async_from_user_password.call_count == 2
+    assert octoprint_psu_meross_plugin.meross.warm_up_timings
+
+
+def test_api_get_metrics(octoprint_psu_meross_plugin, threaded_loop):
+    octoprint_psu_meross_plugin.on_settings_initialized()
+    threaded_loop.wait_all_futures()
+
+    app = flask.Flask(__name__)
+    with app.test_request_context("/?resource=metrics"):
+        response = octoprint_psu_meross_plugin.on_api_get(flask.request)
+    assert response.content_type.startswith("text/plain; version=0.0.4")
+    text = response.get_data(as_text=True)
+    assert 'psucontrol_meross_logins_total{result="success"} 1' in text
+    assert "# TYPE psucontrol_meross_command_duration_seconds histogram" in text
+
+    with app.test_request_context("/?resource=metrics&format=json"):
+        response = octoprint_psu_meross_plugin.on_api_get(flask.request)
+    snapshot = response.get_json()
+    assert snapshot["psucontrol_meross_logins_total"]["samples"] == [
+        {"labels": {"result": "success"}, "value": 1}
+    ]
+
+
+def test_api_get_traces(octoprint_psu_meross_plugin, threaded_loop):
+    tracer = octoprint_psu_meross_plugin.meross.tracer
+    tracer.slow_threshold = 0  # Keep every trace
+    app = flask.Flask(__name__)
+    with app.app_context():
+        octoprint_psu_meross_plugin.on_api_command(
+            "try_login",
+            {
+                "api_base_url": "iotx-eu.meross.com",
+                "user_email": "user@example.com",
+                "user_password": "password",
+            },
+        )
+    threaded_loop.wait_all_futures()
+
+    with app.test_request_context("/?resource=traces"):
+        response = octoprint_psu_meross_plugin.on_api_get(flask.request)
+    (trace,) = response.get_json()["traces"]
+    assert trace["name"] == "api_command:try_login"
+    span_names = [span["name"] for span in trace["spans"]]
+    assert span_names == ["ensure_login", "loop_wait", "login"]
+
+    with app.test_request_context("/?resource=traces&format=otlp"):
+        response = octoprint_psu_meross_plugin.on_api_get(flask.request)
+    (resource_spans,) = response.get_json()["resourceSpans"]
+    assert len(resource_spans["scopeSpans"][0]["spans"]) == len(span_names) + 1
+
+
+def test_api_get_states(octoprint_psu_meross_plugin, threaded_loop):
+    state_table = octoprint_psu_meross_plugin.meross._async_client.state_table
+    state_table.update("uuid", 0, True, StateSource.PUSH)
+    app = flask.Flask(__name__)
+    with app.test_request_context("/?resource=states&ids=uuid::0&max_age=60"):
+        response = octoprint_psu_meross_plugin.on_api_get(flask.request)
+    states = response.get_json()["states"]
+    assert (states["uuid::0"]["state"], states["uuid::0"]["source"]) == ("on", "push")
+
+    with app.test_request_context("/?resource=states&ids=not-a-channel"):
+        with pytest.raises(werkzeug.exceptions.BadRequest):
+            octoprint_psu_meross_plugin.on_api_get(flask.request)
+
+
+def test_api_get_unknown_target_state(octoprint_psu_meross_plugin, mocker):
+    meross = octoprint_psu_meross_plugin.meross
+    mocker.patch.object(
+        meross, "channel_states", return_value={"a::0": True, "b::0": None}
     )
+    app = flask.Flask(__name__)
+    with app.test_request_context("/"):
+        response = octoprint_psu_meross_plugin.on_api_get(flask.request)
+    assert response.get_json()["target_devices"] == [
+        {"id": "a::0", "state": "on"},
+        {"id": "b::0", "state": None},  # Not "off"
+    ]
+
+
+def test_api_get_cloud_timeout(octoprint_psu_meross_plugin, mocker):
+    meross = octoprint_psu_meross_plugin.meross
+    mocker.patch.object(
+        type(meross), "is_authenticated", new_callable=mocker.PropertyMock
+    ).return_value = True
+    mocker.patch.object(meross, "channel_states", return_value={})
+    timeout = DeadlineExceededError("No result within the 20s budget")
+    mocker.patch.object(meross, "list_devices", side_effect=timeout)
+    mocker.patch.object(meross, "transport_stats", side_effect=timeout)
+    app = flask.Flask(__name__)
+    for url in ("/", "/?resource=transport"):
+        with app.test_request_context(url):
+            with pytest.raises(werkzeug.exceptions.GatewayTimeout):
+                octoprint_psu_meross_plugin.on_api_get(flask.request)
+
+
+def test_admin_only_api(octoprint_psu_meross_plugin, is_admin):
+    is_admin.return_value = False
+    app = flask.Flask(__name__)
+    for resource in ("metrics", "traces", "transport", "worker"):
+        with app.test_request_context(f"/?resource={resource}"):
+            with pytest.raises(werkzeug.exceptions.Forbidden):
+                octoprint_psu_meross_plugin.on_api_get(flask.request)
+    with app.app_context():
+        with pytest.raises(werkzeug.exceptions.Forbidden):
+            octoprint_psu_meross_plugin.on_api_command("restart_worker", {})
+    assert octoprint_psu_meross_plugin.meross.worker.restarts == 0
+
+    # The regular settings page request and the states snapshot are not restricted
+    with app.test_request_context("/"):
+        assert octoprint_psu_meross_plugin.on_api_get(flask.request).get_json()
+    state_table = octoprint_psu_meross_plugin.meross._async_client.state_table
+    state_table.update("uuid", 0, True, StateSource.PUSH)
+    with app.test_request_context("/?resource=states&ids=uuid::0&max_age=60"):
+        assert octoprint_psu_meross_plugin.on_api_get(flask.request).get_json()
+
+
+def test_api_list_devices(octoprint_psu_meross_plugin, mocker):
+    meross = octoprint_psu_meross_plugin.meross
+    mocker.patch.object(meross, "login", return_value=meross._done_future(True))
+    devices = []
+    for uuid, name in [("a", "Printer"), ("b", "Lamp"), ("c", "Printer 2")]:
+        device = mocker.Mock(uuid=uuid, channels=[mocker.Mock(is_master_channel=True)])
+        device.name = name
+        device.channels[0].index = 0
+        devices.append(device)
+    index = DeviceIndex.build(1, devices)
+    mocker.patch.object(meross, "device_index", return_value=index)
+    payload = {
+        "api_base_url": "iotx-eu.meross.com",
+        "user_email": "user@example.com",
+        "user_password": "password",
+        "query": "printer",
+        "limit": 1,
+    }
+
+    app = flask.Flask(__name__)
+    with app.test_request_context("/"):
+        response = octoprint_psu_meross_plugin.on_api_command("list_devices", payload)
+    data = response.get_json()
+    assert (data["error"], data["total"]) == (False, 2)
+    assert data["devices"] == [{"name": "Printer", "dev_id": "a::0"}]
+    etag = response.headers["ETag"]
+
+    with app.test_request_context("/", headers={"If-None-Match": etag}):
+        response = octoprint_psu_meross_plugin.on_api_command("list_devices", payload)
+    assert response.status_code == 304
+    # Another page
+    with app.test_request_context("/", headers={"If-None-Match": etag}):
+        response = octoprint_psu_meross_plugin.on_api_command(
+            "list_devices", dict(payload, offset=1)
+        )
+    assert response.get_json()["devices"] == [{"name": "Printer 2", "dev_id": "c::0"}]
+
+
+def test_shutdown_and_restart(
+    octoprint_psu_meross_plugin, mocked_meross_http_client, threaded_loop
+):
+    octoprint_psu_meross_plugin.on_settings_initialized()
+    threaded_loop.wait_all_futures()
+    meross = octoprint_psu_meross_plugin.meross
+    assert meross.is_authenticated
+
+    app = flask.Flask(__name__)
+    with app.test_request_context("/?resource=worker"):
+        stats = octoprint_psu_meross_plugin.on_api_get(flask.request).get_json()
+    assert stats["running"] and stats["restarts"] == 0
+
+    octoprint_psu_meross_plugin.on_shutdown()
+    assert not meross.worker.running
+    assert not meross.is_authenticated
+
+    with app.app_context():
+        response = octoprint_psu_meross_plugin.on_api_command("restart_worker", {})
+    assert response.get_json()["rv"]["restarts"] == 1
+    assert octoprint_psu_meross_plugin._ensure_meross_login().result(5)
+    # The saved session is restored, no new login
+    assert mocked_meross_http_client.async_from_user_password.call_count == 1
+    assert mocked_meross_http_client.async_from_cloud_creds.called
@@ -0,0 +1,76 @@
+import pytest
+
+from octoprint_psucontrol_meross.metrics import MetricsRegistry
+
+
+@pytest.fixture
+def registry():
+    return MetricsRegistry(prefix="test_")
+
+
+def test_counter(registry):
+    counter = registry.counter("calls_total", "Calls.", ["result"])
+    counter.inc(result="ok")
+    counter.inc(2, result="ok")
+    counter.inc(result='"bad"')
+    assert counter.get(result="ok") == 3
+    assert registry.render_prometheus().splitlines() == [
+        "# HELP test_calls_total Calls.",
+        "# TYPE test_calls_total counter",
+        'test_calls_total{result="\\"bad\\""} 1',
+        'test_calls_total{result="ok"} 3',
+    ]
+    assert registry.snapshot()["test_calls_total"]["samples"][1] == {
+        "labels": {"result": "ok"},
+        "value": 3,
+    }
+
+
+def test_callback_counter(registry):
+    counter = registry.callback_counter(
+        "hits_total", "Hits.", ["cache"], lambda: {("a",): 1, ("b",): 2}
+    )
+    assert counter.get(cache="b") == 2
+    with pytest.raises(TypeError):
+        counter.inc(cache="a")
+
+
+def test_histogram(registry):
+    histogram = registry.histogram("duration_seconds", "Duration.", buckets=(0.1, 1))
+    histogram.observe(0.05)
+    histogram.observe(0.1)
+    histogram.observe(5)
+    assert registry.render_prometheus().splitlines()[2:] == [
+        'test_duration_seconds_bucket{le="0.1"} 2',
+        'test_duration_seconds_bucket{le="1"} 2',
+        'test_duration_seconds_bucket{le="+Inf"} 3',
+        "test_duration_seconds_sum 5.15",
+        "test_duration_seconds_count 3",
+    ]
+    (sample,) = registry.snapshot()["test_duration_seconds"]["samples"]
+    assert sample["count"] == 3
+    assert sample["buckets"] == [["0.1", 2], ["1", 2], ["+Inf", 3]]
+
+
+def test_histogram_time(registry, mocker):
+    histogram = registry.histogram("duration_seconds", "Duration.", ["command"])
+    mocker.patch("time.perf_counter", side_effect=[10.0, 10.5])
+    with histogram.time(command="is_on"):
+        pass
+    (sample,) = histogram.samples().values()
+    assert sample["sum"] == 0.5
+
+
+def test_duplicate_name(registry):
+    registry.counter("calls_total", "Calls.")
+    with pytest.raises(ValueError):
+        registry.counter("calls_total", "Calls.")
+
+
+def test_callback_gauge(registry):
+    registry.callback_gauge("queue_depth", "Depth.", [], lambda: {(): 3})
+    assert registry.render_prometheus().splitlines() == [
+        "# HELP test_queue_depth Depth.",
+        "# TYPE test_queue_depth gauge",
+        "test_queue_depth 3",
+    ]
@@ -21,10 +21,18 @@ def plugin_manager(mocker, psucontrol_plugin):
 
 
 @pytest.fixture
-def psucontrol_meross(logger_mock, plugin_manager, tmpdir):
+def plugin_settings(mocker):
+    out = mocker.MagicMock(name="mock_plugin_settings")
+    out.get.return_value = None  # Nothing configured
+    return out
+
+
+@pytest.fixture
+def psucontrol_meross(logger_mock, plugin_manager, plugin_settings, tmpdir):
     out = octoprint_psucontrol_meross.plugin.PSUControlMeross()
     out._logger = logger_mock
     out._plugin_manager = plugin_manager
+    out._settings = plugin_settings
     out._data_folder = tmpdir
     # Called by the plugin core after performing all injections.
     # Override this to initialize your implementation.
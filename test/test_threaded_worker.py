@@ -0,0 +1,108 @@
+import asyncio
+import gc
+import time
+import warnings
+
+import pytest
+
+from octoprint_psucontrol_meross import threaded_worker
+from octoprint_psucontrol_meross.threaded_worker import get_loop_factory, ThreadedWorker
+
+
+@pytest.fixture
+def worker(logger_mock):
+    out = ThreadedWorker(
+        logger=logger_mock, slow_callback_duration=0.05, heartbeat_interval=0.01
+    )
+    yield out
+    out.stop()
+
+
+def _wait_for(predicate, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "Timed out"
+        time.sleep(0.005)
+
+
+def test_loop_lag(worker, logger_mock):
+    _wait_for(lambda: worker.heartbeats > 2)
+    assert worker.stalls == 0
+
+    # A blocking call slipped into the loop
+    worker.loop.call_soon_threadsafe(time.sleep, 0.2)
+    _wait_for(lambda: worker.stalls)
+    assert worker.max_lag >= 0.15
+    assert "blocked" in logger_mock.warning.call_args[0][0]
+
+
+def test_current_lag_of_blocked_loop(worker):
+    worker.loop.call_soon_threadsafe(time.sleep, 0.3)
+    _wait_for(lambda: worker.current_lag >= 0.1)
+
+
+def test_loop_exceptions(worker, logger_mock):
+    async def _fail():
+        raise RuntimeError("Nobody awaits me")
+
+    def _start():
+        asyncio.ensure_future(_fail())
+
+    worker.loop.call_soon_threadsafe(_start)
+    # The exception is reported once the failed task is garbage collected
+    _wait_for(lambda: worker.loop_exceptions)
+    assert logger_mock.error.called
+
+
+def test_stop_and_restart(worker):
+    async def _forever():
+        await asyncio.Event().wait()
+
+    future = asyncio.run_coroutine_threadsafe(_forever(), worker.loop)
+    _wait_for(lambda: worker.pending_tasks() == 1)
+    assert worker.stats()["pending_tasks"] == 1
+
+    old_loop = worker.loop
+    assert worker.stop()
+    assert future.cancelled()
+    assert old_loop.is_closed()
+    assert not worker.running
+
+    worker.start()
+    assert worker.running
+    assert worker.loop is not old_loop
+    assert worker.restarts == 1
+    assert (
+        asyncio.run_coroutine_threadsafe(asyncio.sleep(0, "ok"), worker.loop).result(5)
+        == "ok"
+    )
+
+
+def test_stop_blocked_loop(worker, logger_mock):
+    worker.loop.call_soon_threadsafe(time.sleep, 0.3)
+    blocked_thread = worker.thread
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        assert not worker.stop(timeout=0.1)
+        assert not worker.running
+        worker.start()  # Replaces the blocked loop
+        assert (
+            asyncio.run_coroutine_threadsafe(
+                asyncio.sleep(0, "ok"), worker.loop
+            ).result(5)
+            == "ok"
+        )
+        # The abandoned loop finally gets to close
+        blocked_thread.join(5)
+        gc.collect()
+    assert not [el for el in caught if "never awaited" in str(el.message)]
+
+
+def test_loop_factory_fallback(mocker):
+    mocker.patch.dict("sys.modules", {"uvloop": None})  # Not installed
+    warning = mocker.patch.object(threaded_worker.logger, "warning")
+    assert get_loop_factory("auto") == ("asyncio", asyncio.new_event_loop)
+    warning.assert_not_called()
+    assert get_loop_factory("uvloop")[0] == "asyncio"
+    assert "not installed" in warning.call_args[0][0]
+    assert get_loop_factory("nope")[0] == "asyncio"
@@ -0,0 +1,78 @@
+import asyncio
+
+import pytest
+
+from octoprint_psucontrol_meross import tracing
+from octoprint_psucontrol_meross.threaded_worker import ThreadedWorker
+
+
+@pytest.fixture
+def tracer(logger_mock):
+    return tracing.Tracer(logger=logger_mock, slow_threshold=0, max_traces=2)
+
+
+def test_spans(tracer):
+    with tracer.trace("command") as trace:
+        with tracing.span("outer"):
+            with tracing.span("inner", device="uuid"):
+                pass
+        with pytest.raises(ValueError):
+            with tracing.span("failing"):
+                raise ValueError("oops")
+    assert tracing.current_trace() is None
+    assert trace.finished
+    spans = {span["name"]: span for span in trace.to_dict()["spans"]}
+    assert spans["outer"]["parent_id"] == trace.root.span_id
+    assert spans["inner"]["parent_id"] == spans["outer"]["span_id"]
+    assert spans["inner"]["attributes"] == {"device": "uuid"}
+    assert spans["failing"]["error"] == "ValueError('oops')"
+
+
+def test_span_without_trace():
+    with tracing.span("orphan") as span:
+        assert span is None
+
+
+def test_carried_to_worker_loop(tracer):
+    worker = ThreadedWorker()
+
+    async def _command():
+        with tracing.span("device_call"):
+            await asyncio.sleep(0.01)
+        return tracing.current_trace()
+
+    with tracer.trace("command") as trace:
+        future = tracing.run_coroutine_threadsafe(_command(), worker.loop)
+        assert not trace.finished  # Waiting for the future
+    assert future.result(timeout=5) is trace
+    assert trace.finished
+    assert [span["name"] for span in trace.to_dict()["spans"]] == [
+        "loop_wait",
+        "device_call",
+    ]
+    assert trace.duration >= 0.01
+
+
+def test_slow_trace_ring_buffer(tracer):
+    for name in ("first", "second", "third"):
+        with tracer.trace(name):
+            pass
+    assert [trace.name for trace in tracer.slow_traces()] == ["third", "second"]
+
+    tracer.slow_threshold = 60
+    with tracer.trace("fast"):
+        pass
+    assert len(tracer.slow_traces()) == 2
+
+
+def test_otlp_export(tracer):
+    with tracer.trace("command") as trace:
+        with tracing.span("login"):
+            pass
+    (resource_spans,) = tracer.to_otlp()["resourceSpans"]
+    (scope_spans,) = resource_spans["scopeSpans"]
+    root, login = scope_spans["spans"][:2]
+    assert root["traceId"] == login["traceId"] == trace.trace_id
+    assert "parentSpanId" not in root
+    assert login["parentSpanId"] == root["spanId"]
+    assert int(login["endTimeUnixNano"]) >= int(login["startTimeUnixNano"])